@@ -0,0 +1,97 @@
+# Micro-benchmark for the BioProject efetch parser on a recorded corpus of responses.
+# The corpus is every efetch/bioproject response in the response cache written by download_data.py. Without a cache,
+# a synthetic corpus is built from the record builders in lib/eutils_mock.py.
+# Measured on the synthetic corpus (250 responses of 20 projects, Python 2.7.18, one core of an Intel Xeon VM), the rule-based
+# parser is about 2x as fast as the exec-based one it replaced (1.7-2.8x over four runs on a noisy VM). That version is the default baseline,
+# read from git at baseline_commit, so running this script as it stands reproduces the comparison.
+import os
+import imp
+import time
+import shutil
+import tempfile
+import subprocess
+import StringIO
+import logging
+import lib.eutils_parser as eutils_parser
+import lib.eutils_cache as eutils_cache
+import lib.eutils_mock as eutils_mock
+
+#################################################################
+### Assign values to variables ##################################
+#################################################################
+cache_dir           = 'bioproject_files'
+cache_file          = 'eutils_cache.sqlite'     # Recorded responses (see download_data.py)
+baseline_file       = None                      # Optional path to an older copy of lib/eutils_parser.py to compare against
+baseline_commit     = '4c7bd11'                 # Otherwise lib/eutils_parser.py is taken from this commit (the last exec-based parser); None for no baseline
+repeats             = 3                         # The best of this many passes over the corpus is reported
+synthetic_docs      = 5000                      # Size of the synthetic corpus when there is no cache
+
+cache_file_path     = os.path.join(cache_dir, cache_file)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#################################################################
+###  Load the corpus  ###########################################
+#################################################################
+if os.path.exists(cache_file_path):
+    cache   = eutils_cache.response_cache(cache_file_path)
+    corpus  = [body for ids, body in cache.iter_bodies('efetch', 'bioproject')]
+    cache.close()
+    logger.info('Corpus: {0} cached responses from {1}'.format(len(corpus), cache_file_path))
+else:
+    records = [eutils_mock.bioproject_record(i, parents=[1], children=[i + 1], genome_links=[(10, 51)], organism_name='Homo sapiens',
+                                             species='9606', supergroup='Eukaryotes', organization='NHGRI',
+                                             data_stats=[('SRA', 'Mbases', '1,500'), ('SRA', 'Mbytes', '2,000')]) for i in range(synthetic_docs)]
+    corpus  = ['<?xml version="1.0"?>\n<RecordSet>' + ''.join(records[i:i + 20]) + '</RecordSet>' for i in range(0, len(records), 20)]
+    logger.info('Corpus: {0} synthetic responses of 20 projects'.format(len(corpus)))
+
+#################################################################
+###  Time the parsers  ##########################################
+#################################################################
+def best_time(parse_function):
+    """Return (best seconds per pass, results of the last pass)."""
+    best = None
+    for r in range(repeats):
+        start   = time.time()
+        results = [parse_function(body) for body in corpus]
+        elapsed = time.time() - start
+        if ( best is None ) or ( elapsed < best ): best = elapsed
+    return best, results
+
+current = eutils_parser.parser(db='bioproject', tool='efetch')
+timings = [
+    ('current (string)',    current.parse),
+    ('current (stream)',    lambda body: current.parse_stream(StringIO.StringIO(body))),]
+if baseline_file is not None:
+    baseline = imp.load_source('baseline_eutils_parser', baseline_file).parser(db='bioproject', tool='efetch')
+    timings.append(('baseline', baseline.parse))
+elif baseline_commit is not None:
+    try:
+        source = subprocess.check_output(['git', 'show', baseline_commit + ':lib/eutils_parser.py'], cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning('No baseline: could not read lib/eutils_parser.py at {0} from git ({1})'.format(baseline_commit, e))
+    else:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, 'eutils_parser.py'), 'wb') as f: f.write(source)
+            baseline = imp.load_source('baseline_eutils_parser', os.path.join(temp_dir, 'eutils_parser.py')).parser(db='bioproject', tool='efetch')
+        finally:
+            shutil.rmtree(temp_dir)
+        timings.append(('baseline ' + baseline_commit, baseline.parse))
+
+def comparable(results):
+    """Drop the document fingerprints and link provenance, which older parsers do not produce."""
+    for r in results:
+        for row in ( r or {} ).get('bp_nodes') or []: row.pop('doc_hash', None)
+        for row in ( r or {} ).get('links') or []: row.pop('listed_down', None); row.pop('listed_up', None)
+    return results
+
+reference = None
+for label, parse_function in timings:
+    seconds, results = best_time(parse_function)
+    count_docs = sum(len(r['bp_nodes']) for r in results if r is not None)
+    results = comparable(results)
+    if reference is None: reference = results
+    same = 'same output' if results == reference else 'OUTPUT DIFFERS'
+    logger.info('{0:<20} {1:8.3f} s  {2:10.0f} projects/s  {3}'.format(label, seconds, count_docs / seconds if seconds else 0, same))
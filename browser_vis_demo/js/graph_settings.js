@@ -2,7 +2,19 @@
 var sigInst = sigma.init($('#gexf-container')[0]); 
 var zoomDelay = 1.1; 
 
+// Level-of-detail tiles (written by make_gexf.py with tiles_dir set). Meta-nodes with a "tile" attribute stand for a whole 
+// organism group; the group's own file is loaded when the meta-node is clicked, or once it is drawn larger than 
+// tileExpandSize pixels after zooming in. Files without such nodes load as before. 
+var tileExpandSize = 20;        // Twice the largest node size the sliders start with
+var tileDir = '';           // Directory of the current file; tile files are named relative to it 
+var tiles = {};             // Meta-node ID -> 'loading' or the links leaving that group, once loaded 
+var tileEdgeIDs = {};       // IDs of the links already drawn from tiles 
+var shownNodes = null;      // Node ID -> true for the nodes in the graph, indexed when the first group is loaded 
+
+var graphFile;              // File currently shown 
+
 function setGEXF(gexf_file) {
+    tileDir = gexf_file.replace(/[^\/]*$/, '');
     // Set properties on sigInst (instantiated above) 
     sigInst.drawingProperties({
         defaultLabelColor: '#fff',
@@ -12,10 +24,61 @@ function setGEXF(gexf_file) {
         minRatio:.5 // Enable some, but not too much, zooming out. 
         });
     
-    sigInst.parseGexf(gexf_file);   // File being parsed (requires "sigma.parseGexf.js")
+    graphFile = gexf_file;
+    if ( /\.json$/.test(gexf_file) ) { 
+        loadGraphJSON(gexf_file);   // Compact JSON (written by lib/graph_json.py), no XML to parse 
+    } else {
+        sigInst.parseGexf(gexf_file);   // File being parsed (requires "sigma.parseGexf.js")
+    }
     //sigInst.draw();                 // Draw graph 
     }
 
+// Load a graph in the compact JSON format. Each node attribute is a column with one value per node, and repeated strings 
+// are stored once (categories) and referred to by number (codes), so the file is a fraction of the size of the GEXF. 
+function loadGraphJSON(json_file) {
+    $.ajax({url: json_file, dataType: 'json', success: function(data) {
+        if ( json_file!=graphFile ) { return; }     // Another graph was chosen while this one was loading 
+        addGraphJSON(data);
+        sigInst.draw();
+    }});
+}
+
+// Return a column's values (null where a node has none) 
+function columnValues(column) {
+    if ( !column.codes ) { return column.values; }
+    return column.codes.map( function(code) { return code==-1 ? null : column.categories[code]; });
+}
+
+function addGraphJSON(data) {
+    var nodes = {};
+    data.nodes.forEach( function(column) { nodes[column.id] = columnValues(column); });
+    var attributes = data.attributes.map( function(column) { return {attr:column.id, values:columnValues(column)}; });
+    var ids = nodes['id'].map(String);
+
+    for (var i=0; i<ids.length; i++) {
+        // Nodes take the form the GEXF parser gives them, so the rest of the viewer works on either 
+        var node = {
+            label:      nodes['label'][i], 
+            size:       nodes['size'] && nodes['size'][i]!=null ? nodes['size'][i] : 1,
+            x:          nodes['x'] && nodes['x'][i]!=null ? nodes['x'][i] : 100 - 200*Math.random(),
+            y:          nodes['y'] && nodes['y'][i]!=null ? nodes['y'][i] : 100 - 200*Math.random(),
+            attributes: []
+        };
+        if ( nodes['color'] && nodes['color'][i]!=null ) { node.color = nodes['color'][i]; }
+        attributes.forEach( function(att) {
+            if ( att.values[i]!=null ) { node.attributes.push({attr:att.attr, val:String(att.values[i])}); }
+        });
+        sigInst.addNode(ids[i], node);
+    }
+
+    var edges = data.edges;
+    for (var k=0; k<edges.source.length; k++) {
+        var edge = {};
+        if ( edges.weight ) { edge.weight = edges.weight[k]; }
+        sigInst.addEdge(k, ids[edges.source[k]], ids[edges.target[k]], edge);
+    }
+}
+
 function bindActions(){
     var popUp;
     
@@ -58,6 +121,10 @@ function bindActions(){
         }
         
         // Get the "Project Type" label and save it to a variable. 
+        if (  attrObj.hasOwnProperty('projects') ) { 
+            return_text += '<tr><td>Projects</td><td>' + attrObj['projects'] + ' (click to show)</td></tr>'
+        }
+        
         if (  attrObj.hasOwnProperty('project_type') ) { 
             return_text += '<tr><td>Project type</td><td>' + attrObj['project_type'] + '</td></tr>'
             var project_type = attrObj['project_type'] 
@@ -131,14 +198,24 @@ function bindActions(){
         popUp = false;
     }
     
-    // Open BioProject in new window only when the user releases the mouse button. 
+    // Open BioProject in new window only when the user releases the mouse button. Clicking a group of a tiled graph loads the group. 
     function unclickNode(event) {
         var bp_id = event.content[0]
+        if ( expandTile(bp_id) ) { 
+            hideNodeInfo();
+            return;
+        }
         window.open('http://www.ncbi.nlm.nih.gov/bioproject/' + bp_id); 
     }
 
     sigInst.bind('overnodes',showNodeInfo).bind('outnodes',hideNodeInfo);
     sigInst.bind('upnodes',unclickNode);
+
+    var tileTimer;
+    $('#gexf-container').bind('mousewheel DOMMouseScroll', function() {
+        clearTimeout(tileTimer);
+        tileTimer = setTimeout(expandVisibleTiles, 300);    // Once the zoom has settled 
+    });
 }
 
 // Set graph properties 
@@ -157,6 +234,117 @@ function setDrawingProperties(params) {
 function clearGEXF(){
     // Only possible because sigInst is declared globally outside of functions
     sigInst.emptyGraph();    
+    tiles = {};
+    tileEdgeIDs = {};
+    shownNodes = null;
+}
+
+// Return the value of a node's attribute, as stored by the GEXF parser 
+function nodeAttribute(node, attr) {
+    var attributes = node['attr']['attributes'] || [];
+    for (var i=0; i<attributes.length; i++) {
+        if (attributes[i]['attr']==attr) { return attributes[i]['val']; }
+    }
+    return undefined;
+}
+
+// Replace a meta-node by the nodes and links of its group. Returns false if the node is not a meta-node. 
+function expandTile(node_id) {
+    var meta;
+    sigInst.iterNodes(function(n){ meta = n; }, [node_id]);
+    var tile = meta && nodeAttribute(meta, 'tile');
+    if ( !tile ) { return false; }
+    if ( tiles[node_id] ) { return true; }     // Loading or loaded already 
+    tiles[node_id] = 'loading';
+    $.ajax({url: tileDir + tile, dataType: 'xml', success: function(xml) { addTile(node_id, meta, xml); }});
+    return true;
+}
+
+function addTile(node_id, meta, xml) {
+    var viz = 'http://www.gexf.net/1.2draft/viz';
+    function vizElement(element, name) {
+        var found = element.getElementsByTagNameNS(viz, name);
+        return found.length ? found[0] : null;
+    }
+    function attvalues(element) {
+        var values = element.getElementsByTagName('attvalue'), list = [];
+        for (var i=0; i<values.length; i++) {
+            list.push({attr:values[i].getAttribute('for'), val:values[i].getAttribute('value')});
+        }
+        return list;
+    }
+
+    // The meta-node and its links make way for the group 
+    nodeExists(node_id);       // Index the nodes before the graph changes 
+    sigInst.dropNode(node_id);
+    delete shownNodes[node_id];
+    var nodes = xml.getElementsByTagName('node');
+    for (var i=0; i<nodes.length; i++) {
+        var id = nodes[i].getAttribute('id');
+        var size = vizElement(nodes[i], 'size'), position = vizElement(nodes[i], 'position'), color = vizElement(nodes[i], 'color');
+        var node = {
+            label:      nodes[i].getAttribute('label') || id,
+            size:       size ? parseFloat(size.getAttribute('value')) : meta.size / 2,
+            // Without a layout in the file, the group's nodes are scattered around where its meta-node was 
+            x:          position ? parseFloat(position.getAttribute('x')) : meta.x + meta.size * (Math.random() - 0.5),
+            y:          position ? parseFloat(position.getAttribute('y')) : meta.y + meta.size * (Math.random() - 0.5),
+            attributes: attvalues(nodes[i])
+        };
+        if ( color ) { 
+            node.color = '#' + sigma.tools.rgbToHex(parseFloat(color.getAttribute('r')), parseFloat(color.getAttribute('g')), parseFloat(color.getAttribute('b'))); 
+        }
+        if ( !nodeExists(id) ) { 
+            sigInst.addNode(id, node);
+            shownNodes[id] = true;
+        }
+    }
+
+    // Links leaving the group are kept: they are drawn to whichever of their other end or its meta-node is shown 
+    var leaving = [];
+    var edges = xml.getElementsByTagName('edge');
+    for (var i=0; i<edges.length; i++) {
+        var group = attvalues(edges[i]);
+        leaving.push({source:edges[i].getAttribute('source'), target:edges[i].getAttribute('target'), group:group.length ? group[0]['val'] : null});
+    }
+    tiles[node_id] = leaving;
+    drawTileEdges();
+    sigInst.draw();
+}
+
+function nodeExists(id) {
+    if ( !shownNodes ) {
+        shownNodes = {};
+        sigInst.iterNodes(function(n){ shownNodes[n.id] = true; });
+    }
+    return shownNodes.hasOwnProperty(id);
+}
+
+function drawTileEdges() {
+    // Called after every group is loaded, as loading one may replace a meta-node that links of earlier groups point to 
+    for (var node_id in tiles) {
+        if ( tiles[node_id]=='loading' ) { continue; }
+        tiles[node_id].forEach( function(edge) {
+            var source = edge.source, target = edge.target;
+            if ( !nodeExists(source) ) { source = edge.group; }
+            if ( !nodeExists(target) ) { target = edge.group; }
+            var id = 'tile_' + source + '_' + target;
+            if ( tileEdgeIDs[id] || source==target || !nodeExists(source) || !nodeExists(target) ) { return; }
+            tileEdgeIDs[id] = true;
+            sigInst.addEdge(id, source, target);
+        });
+    }
+}
+
+// After zooming, load the groups whose meta-nodes are now drawn large and are on screen 
+function expandVisibleTiles() {
+    var width = $('#gexf-container').width(), height = $('#gexf-container').height();
+    var expand = [];
+    sigInst.iterNodes(function(n){
+        if ( n.displaySize > tileExpandSize && n.displayX > 0 && n.displayX < width && n.displayY > 0 && n.displayY < height ) {
+            expand.push(n.id);
+        }
+    });
+    expand.forEach(expandTile);
 }
 
 function zoomControl(direction, width, height) {
@@ -176,6 +364,7 @@ function zoomControl(direction, width, height) {
         height / 2, 
         ratio
     ); 
+    setTimeout(expandVisibleTiles, 300);    // Load the groups that are now drawn large, in a tiled graph 
     
     
 }
@@ -2,10 +2,14 @@
 # December, 2012. Chris Wellington
 
 import Queue
+import csv
 import logging
 import os
+import multiprocessing
 import lib.eutils as eutils
 import lib.bp_database as bp_database
+import lib.eutils_cache as eutils_cache
+import lib.crawler as crawler
 
 ################################################
 ###  Preliminary settings  #####################
@@ -14,12 +18,27 @@ import lib.bp_database as bp_database
 bp_data_dir         = 'bioproject_files'
 bp_list_file        = 'top-level_bps.csv'   # Top-level bioProjects to fetch recursively  
 db_file             = 'BioProjects.sqlite'  # SQLite database file 
-max_iterations      = 10                                    # Maximum depth for recursion 
+cache_file          = 'eutils_cache.sqlite' # Compressed copies of every record downloaded from NCBI, one per ID 
+cache_ttl_days      = 30                    # Cached records older than this are downloaded again 
+cache_max_mb        = 2048                  # Size cap for the cache; least recently used records are dropped first 
+reparse_from_cache  = False                 # Rebuild the database from cached responses only, with no network access. Start from an empty database file. 
+failed_ids_file     = 'failed_ids.csv'      # IDs that could not be downloaded even after retries (dead-letter list) 
+max_depth           = 10                                    # Maximum number of links followed away from the starting projects 
+resume_crawl        = False                                 # Continue an interrupted crawl from the crawl journal in the database instead of starting over from the seed file 
+refresh_mode        = None                                  # None, 'stale' (re-fetch projects older than refresh_age_days) or 'umbrella' (only such projects that have children) 
+refresh_age_days    = 7                                     # Age at which a saved project is re-fetched in refresh mode 
+api_key             = os.environ.get('NCBI_API_KEY')        # Optional NCBI API key; raises the request limit from 3 to 10 per second 
+rate_burst          = 3                                     # Number of requests that may go out back-to-back before rate limiting kicks in 
+eutils_url          = 'http://eutils.ncbi.nlm.nih.gov'      # Eutilities server. Point at lib/eutils_mock.py to run offline. 
+history_threshold   = 1000                                  # Upload frontiers at least this large once with epost and page through them (WebEnv) 
+parse_processes     = 0                                     # 0 parses BioProject responses in the download threads while they stream in; more parses whole responses in that many separate processes 
 
 # Break if the specified path does not exist 
 if not os.path.exists(bp_data_dir): raise SystemExit('Fatal error: The input directory "{0}" does not exist. The directory must exist and must contain a list of starting BP ids.'.format(bp_data_dir))
 bp_list_file_path   = os.path.join(bp_data_dir, bp_list_file)       # Input path for the list of BP ids from which we start
 db_file_path        = os.path.join(bp_data_dir, db_file)            # Input path for the database 
+cache_file_path     = os.path.join(bp_data_dir, cache_file)         # Path for the response cache 
+failed_ids_path     = os.path.join(bp_data_dir, failed_ids_file)    # Path for the dead-letter list 
 
 
 # Logging settings (user adjustable)
@@ -40,50 +59,66 @@ fh.setFormatter(fh_format); logger.addHandler(fh);
 ch.setFormatter(ch_format); logger.addHandler(ch);
 logger.info('#####-----  Program to download a defined list of BioProjects launched  -----#####')
 
+# The parser processes are forked first, before the database writer or any download worker starts a thread 
+parse_pool      = multiprocessing.Pool(parse_processes) if parse_processes > 0 else None 
+
 # Instantiate objects 
 queue_result    = Queue.Queue()                                             # Results returned from efetch operations 
 bp_db           = bp_database.init_db(db_file_path, bp_list_file_path, queue_result)          # The database being used to save data 
-efetch_bp       = eutils.eutils_download(db='bioproject', tool='efetch',   group_size=2,  max_threads=10, max_connections=20)
-esummary_genome = eutils.eutils_download(db='genome',     tool='esummary', group_size=50, max_threads=2,  max_connections=5)
+cache           = eutils_cache.response_cache(cache_file_path, ttl=cache_ttl_days*24*3600, max_bytes=cache_max_mb*1024**2)
+efetch_bp       = eutils.eutils_download(db='bioproject', tool='efetch',   group_size=10, min_group_size=1,  max_group_size=200, max_threads=10, max_connections=20, stream_parse=(parse_processes == 0), parse_processes=parse_processes, parse_pool=parse_pool, api_key=api_key, burst=rate_burst, history_threshold=history_threshold, base_url=eutils_url, cache=cache, cache_only=reparse_from_cache, cache_read=refresh_mode is None)
+esummary_genome = eutils.eutils_download(db='genome',     tool='esummary', group_size=50, min_group_size=10, max_group_size=500, max_threads=2,  max_connections=5,  api_key=api_key, burst=rate_burst, history_threshold=history_threshold, base_url=eutils_url, cache=cache, cache_only=reparse_from_cache)
+
+# Reparse mode: send every cached response through the parsers and stop. No crawling, no network. 
+if reparse_from_cache:
+    logger.info('Reparsing cached responses into the database; no downloads will be made') 
+    efetch_bp.reparse_cached(queue_result)
+    esummary_genome.reparse_cached(queue_result)
+    queue_result.join() 
+    if parse_pool is not None: parse_pool.close(); parse_pool.join()
+    logger.info('Reparse complete. Cache statistics: {0}'.format(cache.get_stats()))
+    raise SystemExit 
 
 ################################################
 ###  Begin operations  #########################
 ################################################
 
-# BioProject: Get IDs "below" (the "to" end of "from -> to" links) all current IDs 
-logger.info('Preparing to download BPs that are *below* the other IDs we fetched') 
-i = 0; count_to_fetch = 1; # Declare "while" conditions before the loop 
-while ( (count_to_fetch > 0) and (i <= max_iterations) ): 
-    logger.debug('Fetching BPs below. Current iteration number %s',i) 
-    i = i + 1                                               # Increment the iteration count 
-    bp_db.find_new(find_link_up=False, find_link_down=True) # Get the list of IDs that need to be fetched. 
-    count_existing  = bp_db.get_count_existing()            # The number of individual IDs already in the database 
-    count_to_fetch  = bp_db.get_count_to_fetch()            # The number of individual IDs to fetch. Used for flow control of the "while" loop. 
-    ids_to_fetch    = bp_db.get_ids_to_fetch()              # The actual ids to fetch 
-    logger.info('Downloaded BPs: {0};\tTo download: {1}'.format(count_existing, count_to_fetch))
-
-    efetch_bp.threaded_download(ids_to_fetch, queue_result) # Add each search string to the queue 
-    queue_result.join()        # Wait for all results to be saved before next iteration 
-
-    
-# BioProject: Get IDs "above" (the "from" end of "from -> to" links) all current IDs 
-logger.info('Preparing to download BPs that are *above* the other IDs we fetched') 
-i = 0; count_to_fetch = 1; # Declare "while" conditions before the loop 
-while ( (count_to_fetch > 0) and (i <= max_iterations) ): 
-    logger.debug('Fetching BPs above. Current iteration number %s',i) 
-    i = i + 1                                           # Increment the iteration count 
-    bp_db.find_new(find_link_up=True, find_link_down=False)                   # Get the list of IDs that need to be fetched. 
-    count_existing  = bp_db.get_count_existing()        # The number of individual IDs already in the database 
-    count_to_fetch  = bp_db.get_count_to_fetch()        # The number of individual IDs to fetch. Used for flow control of the "while" loop. 
-    ids_to_fetch    = bp_db.get_ids_to_fetch()          # The actual IDs to fetch
-    logger.info('Downloaded BPs: {0};\tTo download: {1}'.format(count_existing, count_to_fetch))
-    
-    efetch_bp.threaded_download(ids_to_fetch, queue_result, capture_links_down=False) # Add each search string to the queue 
-    queue_result.join()        # Wait for all results to be saved before next iteration 
-    
-# Genome: these nodes represent organism overview pages, but have been moved into their own database and must be handled separately. 
-genome_ids = bp_db.get_genome_ids()                 # From the database, get a list of genome_ids 
-esummary_genome.threaded_download(genome_ids, queue_result)  # Fetch and parse the associated files 
+# The crawler records every ID it schedules in the crawl journal (tbl_crawl_state) and checks new IDs against the database 
+crawl = crawler.crawler(efetch_bp, queue_result, max_depth=max_depth, genome_downloader=esummary_genome, journal=bp_db)
+
+if resume_crawl:
+    # Pick up the IDs that were pending or in flight when the previous run stopped, at their recorded depth and direction 
+    logger.info('Resuming crawl: {0} IDs scheduled from the crawl journal'.format(crawl.resume()))
+else:
+    # Start from the seed projects plus any IDs linked from projects already in the database but not yet downloaded. 
+    # Children are followed down and up; parents are only followed up. 
+    bp_db.reset_crawl_state()
+    bp_db.find_new(find_link_up=False, find_link_down=True); ids_down = set(map(str, bp_db.get_ids_to_fetch()))
+    bp_db.find_new(find_link_up=True, find_link_down=False); ids_up   = set(map(str, bp_db.get_ids_to_fetch()))
+    logger.info('Downloaded BPs: {0};\tTo download: {1}'.format(bp_db.get_count_existing(), len(ids_down | ids_up)))
+    crawl.add(ids_down, 'both')
+    crawl.add(ids_up, 'up')         # IDs in both sets were already added going down 
+    crawl.add_genomes(bp_db.get_genome_ids())     # Genome links saved by earlier runs; genome IDs found during the crawl are added as they appear 
+    if refresh_mode is not None:
+        # Re-fetch saved projects that are due (bypassing the response cache). Unchanged ones only get a new fetch time; changed ones have 
+        # their links and statistics replaced, and any new children are crawled. 
+        stale = bp_db.find_stale(refresh_age_days*24*3600, umbrella_only=(refresh_mode == 'umbrella'))
+        logger.info('Refresh ({0}): {1} saved projects are due to be re-fetched'.format(refresh_mode, len(stale)))
+        crawl.add(stale, 'both', check_journal=False)
+crawl.run()
 
 # Wait until all results have been saved 
-queue_result.join() # Wait until everything has been saved 
+queue_result.join() # Wait until everything has been saved
+bp_db.close_crawl_state()   # The crawl is complete; anything still in flight was not returned 
+bp_db.update_closure()      # Ancestor/descendant pairs and subtree totals for the exporters 
+efetch_bp.stop_workers(); esummary_genome.stop_workers()   # Let the download workers exit cleanly 
+if parse_pool is not None: parse_pool.close(); parse_pool.join()
+logger.info('Cache statistics: {0}'.format(cache.get_stats())) 
+
+# Record the IDs that failed for good so they can be inspected or retried 
+with open(failed_ids_path, 'wb') as f:
+    writer = csv.writer(f)
+    writer.writerow(['db', 'tool', 'id'])
+    for db, tool, downloader in (('bioproject', 'efetch', efetch_bp), ('genome', 'esummary', esummary_genome)):
+        for failed_id in downloader.get_dead_letter(): writer.writerow([db, tool, failed_id])
+
@@ -1,74 +1,333 @@
 # Python module to manage the BioProject database. 
 # Chris Wellington, August 15, 2012
 import threading        # Items are saved via a daemon thread 
+import os 
 import sqlite3          # Database support
 import csv              # Parse NCBI summary and/or the list of BPs to download  
+import time             # Time limit for each group commit 
+import Queue            # Drain several results at once 
 import logging 
-from sqlalchemy import Table, Column, Integer, String, Numeric, MetaData, ForeignKey, create_engine, select 
+from sqlalchemy import Table, Column, Index, Integer, String, Numeric, Float, MetaData, ForeignKey, create_engine, select, event, text, and_ 
 # Note on SQLAlchemy: we work directly with the SQLAlchemy core and _not_ the Object Relational Mapper (ORM). 
 
 logger = logging.getLogger(__name__)
 
+# Keys of each parsed result, the table they go to, and the label used in log messages 
+returned_items = [('bp_nodes', 'tbl_node', 'Atts'), ('links', 'tbl_link', 'Links'), ('aggregated_data', 'tbl_aggregated_data', 'Aggregated_data'),
+                  ('data_stats', 'tbl_data_stats', 'Data_stats'), ('submission_org', 'tbl_submission_org', 'Submission_org')]
+
+# Natural key of each table. Saving a row whose key is already present updates that row instead of adding a duplicate. 
+upsert_keys = {'tbl_node':['bp_id'], 'tbl_link':['id_from', 'id_to'], 'tbl_data_stats':['bp_id', 'db', 'unit'], 'tbl_submission_org':['bp_id', 'org_name', 'org_role']}
+# Columns that keep their stored value when a saved row leaves them NULL. Each end of a link reports it in its own document, 
+# and saving one report must not erase the other. 
+upsert_keep = {'tbl_link':['listed_down', 'listed_up']}
+# Key columns a document may leave out. SQLite treats NULLs as distinct in a unique index and in ON CONFLICT, so a row with a 
+# NULL key would be added again on every save; they are stored as '' instead. 
+key_sentinels = {'tbl_data_stats':['db', 'unit'], 'tbl_submission_org':['org_name', 'org_role']}
+native_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)      # INSERT ... ON CONFLICT DO UPDATE; older SQLite falls back to INSERT OR REPLACE 
+
+# Columns of tbl_node used to manage downloads rather than describing the project; exporters leave them out 
+bookkeeping_columns = ['fetched', 'doc_hash']
+
+# Values given to columns added by migrate_schema to the rows already in the table. Links saved before their source was recorded 
+# count as reported by both ends, so they are only dropped once both projects have been re-fetched without them. 
+migration_defaults = {('tbl_link', 'listed_down'):1, ('tbl_link', 'listed_up'):1}
+
+# Tables whose rows belong to a single project (by bp_id) and are replaced when a re-fetched project has changed. Links are handled separately. 
+project_child_tables = ['tbl_data_stats', 'tbl_aggregated_data', 'tbl_submission_org']
+
+# Crawl journal. Each ID moves pending -> in-flight -> done (or failed) and never back; a status only replaces those listed here. 
+crawl_status_replaces = {'pending':(), 'in-flight':('pending',), 'done':('pending', 'in-flight', 'failed'), 'failed':('pending', 'in-flight')}
+crawl_statuses = ['pending', 'in-flight', 'done', 'failed']
+crawl_state_fields = ['kind', 'crawl_id', 'status', 'depth', 'direction', 'updated']
+
+def upsert_statement(table_name, columns):
+    # Build the statement that saves rows with the given columns into a table, merging rows that share the table's key 
+    columns = list(columns)
+    values  = ', '.join(':' + col for col in columns)
+    if table_name not in upsert_keys:
+        return text('INSERT INTO {0} ({1}) VALUES ({2})'.format(table_name, ', '.join(columns), values))
+    key     = upsert_keys[table_name]
+    keep    = [col for col in upsert_keep.get(table_name, []) if col in columns]
+    if not native_upsert:
+        match   = ' AND '.join('{0} = :{0}'.format(col) for col in key)
+        values  = ', '.join('COALESCE(:{0}, (SELECT {0} FROM {1} WHERE {2}))'.format(col, table_name, match) if col in keep else ':' + col for col in columns)
+        return text('INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(table_name, ', '.join(columns), values))
+    updates = ', '.join(('{0} = COALESCE(excluded.{0}, {1}.{0})' if col in keep else '{0} = excluded.{0}').format(col, table_name) for col in columns if col not in key)
+    action  = 'DO UPDATE SET ' + updates if updates else 'DO NOTHING'
+    return text('INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT ({3}) {4}'.format(table_name, ', '.join(columns), values, ', '.join(key), action))
+
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    # Run on every new connection: WAL lets the readers work while the writer commits, and NORMAL only syncs at checkpoints 
+    cursor = dbapi_conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')      # 64 MB page cache 
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+def make_engine(db_file):
+    engine = create_engine('sqlite:///' + db_file, echo=False)
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+def make_metadata():
+    # The BioProject schema. Shared by the downloader (init_db) and the exporters. 
+    metadata = MetaData()
+    Table('tbl_node', metadata,
+            Column('bp_id', Integer, primary_key=True),
+            Column('genome_id', Integer),
+            Column('create_date', String), 
+            Column('accno', String),
+            Column('name', String),
+            Column('title', String),
+            Column('project_type', String),
+            Column('target_capture', String),
+            Column('target_material', String),
+            Column('target_sample_scope', String),
+            Column('organism_name', String),
+            Column('organism_supergroup', String),
+            Column('method', String),
+            Column('data_type', String),
+            Column('fetched', Float),                       # Time the project was last downloaded 
+            Column('doc_hash', String),                     # Fingerprint of the parsed document (see eutils_parser) 
+            Index('idx_node_project_type', 'project_type'),
+            Index('idx_node_genome_id', 'genome_id'),
+            Index('idx_node_fetched', 'fetched'),
+            )
+    Table('tbl_link', metadata,
+            Column('id_tbl_link', Integer, primary_key=True),
+            Column('id_from', Integer), 
+            Column('id_to', Integer), 
+            Column('link_genome_id', String), 
+            Column('listed_down', Integer),                 # 1 if the document of id_from lists the link (RelationGroup "Down") 
+            Column('listed_up', Integer),                   # 1 if the document of id_to lists the link (RelationGroup "Up") 
+            Index('ux_link', 'id_from', 'id_to', unique=True),      # Up and down crawls both report each edge 
+            Index('idx_link_to', 'id_to'),
+            Index('idx_link_genome_id', 'link_genome_id'),
+            )
+    Table('tbl_aggregated_data', metadata, 
+            Column('id_aggregated_data', Integer, primary_key=True),
+            Column('bp_id', Integer),
+            Column('label', String),
+            Column('int_count', Integer),
+            Column('str_database', String),
+            Column('str_url', String), 
+            Index('idx_aggregated_data_bp_id', 'bp_id'),
+            )
+    Table('tbl_data_stats', metadata, 
+            Column('id_data_stats', Integer, primary_key=True),
+            Column('bp_id', Integer),
+            Column('db', String),
+            Column('unit', String),
+            Column('val', Numeric),
+            Index('ux_data_stats', 'bp_id', 'db', 'unit', unique=True),
+            )
+    Table('tbl_submission_org', metadata,
+            Column('id_submission_org', Integer, primary_key=True),
+            Column('org_name', String),
+            Column('org_type', String),
+            Column('org_role', String),
+            Column('bp_id', Integer),
+            Index('ux_submission_org', 'bp_id', 'org_name', 'org_role', unique=True),
+            )
+    Table('tbl_crawl_state', metadata,
+            Column('kind', String, primary_key=True),       # 'bioproject' or 'genome' 
+            Column('crawl_id', Integer, primary_key=True),  # BioProject ID or genome ID 
+            Column('status', String),                       # 'pending', 'in-flight', 'done' or 'failed' 
+            Column('depth', Integer),                       # Links followed from the seed projects 
+            Column('direction', String),                    # 'both' or 'up' 
+            Column('updated', Float),
+            Index('idx_crawl_state_status', 'status'),
+            )
+    # Data statistics pivoted to one row per project and one REAL column per (db, unit), kept up to date by the saver. 
+    # The stat columns are added as new (db, unit) pairs appear; tbl_stats_columns names them. 
+    Table('tbl_stats_wide', metadata,
+            Column('bp_id', Integer, primary_key=True),
+            )
+    Table('tbl_stats_columns', metadata,
+            Column('col_name', String, primary_key=True),   # Column of tbl_stats_wide ("stat_1", ...) 
+            Column('db', String),
+            Column('unit', String),
+            Column('label', String),                        # "db: unit", the column title used by the exporters 
+            )
+    # Write counter, incremented by every transaction that changes exported data. db_export keys its on-disk cache on it. 
+    Table('tbl_db_version', metadata,
+            Column('id', Integer, primary_key=True),        # A single row, id 1 
+            Column('version', Integer),
+            Column('updated', Float),
+            )
+    # Transitive closure of tbl_link: one row for every project and each project below it (itself included), however many 
+    # paths connect them. Rebuilt by build_closure() once a download has finished. 
+    Table('tbl_closure', metadata,
+            Column('ancestor', Integer, primary_key=True),
+            Column('descendant', Integer, primary_key=True),
+            Index('idx_closure_descendant', 'descendant'),
+            )
+    # Data statistics summed over each project's whole subtree (from tbl_closure), with the same stat columns as tbl_stats_wide 
+    Table('tbl_stats_rollup', metadata,
+            Column('bp_id', Integer, primary_key=True),
+            )
+    return metadata
+
+def migrate_schema(engine, metadata):
+    # Create missing tables, and add columns and indexes that databases created by older versions lack (create_all() only adds them along with new tables) 
+    metadata.create_all(engine)
+    conn = engine.connect()
+    migrated = False
+    stats_changed = False
+    for table_name, columns in key_sentinels.items():
+        # Rows saved with NULL keys were never merged. Keep the last saved copy, as an upsert would have, then store the NULLs as '' 
+        has_null = ' OR '.join('{0} IS NULL'.format(col) for col in columns)
+        if conn.execute('SELECT 1 FROM {0} WHERE {1} LIMIT 1'.format(table_name, has_null)).fetchone() is None: continue 
+        migrated = True
+        stats_changed = stats_changed or ( table_name == 'tbl_data_stats' )
+        key = ', '.join("COALESCE({0}, '')".format(col) if col in columns else col for col in upsert_keys[table_name])
+        result = conn.execute('DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY {1})'.format(table_name, key))
+        logger.info("Migrating {0}: storing missing {1} as '', removed {2} duplicate rows".format(table_name, ' and '.join(columns), result.rowcount))
+        for col in columns: conn.execute("UPDATE {0} SET {1} = '' WHERE {1} IS NULL".format(table_name, col))
+    if stats_changed:
+        for col in key_sentinels['tbl_data_stats']: conn.execute("UPDATE tbl_stats_columns SET {0} = '' WHERE {0} IS NULL".format(col))
+    for table in metadata.sorted_tables:
+        existing = set(row[1] for row in conn.execute('PRAGMA table_info({0})'.format(table.name)))
+        for column in table.columns:
+            if column.name in existing: continue 
+            migrated = True
+            logger.info("Migrating {0}: adding column {1}".format(table.name, column.name))
+            conn.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table.name, column.name, column.type.compile(dialect=engine.dialect)))
+            if (table.name, column.name) in migration_defaults:
+                conn.execute('UPDATE {0} SET {1} = ?'.format(table.name, column.name), migration_defaults[(table.name, column.name)])
+        existing = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", table.name))
+        for index in table.indexes:
+            if index.name in existing: continue 
+            migrated = True
+            if index.unique:
+                # Keep the last saved copy of each duplicated row, as an upsert would have, so the unique index can be built 
+                key = ', '.join(col.name for col in index.columns)
+                result = conn.execute('DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY {1})'.format(table.name, key))
+                if result.rowcount: logger.info("Migrating {0}: removed {1} duplicate rows before adding unique index {2}".format(table.name, result.rowcount, index.name))
+            logger.info("Migrating {0}: adding index {1}".format(table.name, index.name))
+            index.create(conn)
+    if stats_changed and ( conn.execute('SELECT 1 FROM tbl_stats_columns LIMIT 1').fetchone() is not None ):
+        logger.info("Migrating tbl_stats_wide: rebuilding it after merging duplicate statistics")
+        trans = conn.begin()
+        stats_columns = load_stats_columns(conn)
+        add_stats_columns(conn, stats_columns, conn.execute('SELECT DISTINCT db, unit FROM tbl_data_stats').fetchall())
+        refresh_stats_wide(conn, stats_columns)
+        refresh_stats_rollup(conn, stats_columns)
+        trans.commit()
+    if ( conn.execute('SELECT 1 FROM tbl_stats_columns LIMIT 1').fetchone() is None ) and ( conn.execute('SELECT 1 FROM tbl_data_stats LIMIT 1').fetchone() is not None ):
+        logger.info("Migrating tbl_stats_wide: building it from tbl_data_stats")
+        trans = conn.begin()
+        stats_columns = load_stats_columns(conn)
+        add_stats_columns(conn, stats_columns, conn.execute('SELECT DISTINCT db, unit FROM tbl_data_stats').fetchall())
+        refresh_stats_wide(conn, stats_columns)
+        trans.commit()
+        migrated = True
+    if ( conn.execute('SELECT 1 FROM tbl_closure LIMIT 1').fetchone() is None ) and ( conn.execute('SELECT 1 FROM tbl_link LIMIT 1').fetchone() is not None ):
+        logger.info("Migrating tbl_closure: building it from tbl_link")
+        trans = conn.begin()
+        build_closure(conn)
+        refresh_stats_rollup(conn, load_stats_columns(conn))
+        trans.commit()
+        migrated = True
+    if migrated: bump_db_version(conn)
+    conn.close()
+
+def bump_db_version(conn):
+    # Count one more write. Call inside the transaction that makes the change. 
+    if conn.execute('UPDATE tbl_db_version SET version = version + 1, updated = ? WHERE id = 1', time.time()).rowcount == 0:
+        conn.execute('INSERT INTO tbl_db_version (id, version, updated) VALUES (1, 1, ?)', time.time())
+
+def read_db_version(db_file):
+    # Return the write counter of a database file, or None if it has none (created by an older version, or not a database yet). 
+    # Uses a plain connection, so checking whether a cached export is current costs one small query. 
+    if not os.path.exists(db_file): return None
+    conn = sqlite3.connect(db_file)
+    try:
+        row = conn.execute('SELECT version FROM tbl_db_version WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return row[0] if row is not None else 0
+
+def load_stats_columns(conn):
+    # Return {(db, unit): column name} for the columns of tbl_stats_wide 
+    return dict(((db, unit), col_name) for col_name, db, unit in conn.execute('SELECT col_name, db, unit FROM tbl_stats_columns'))
+
+def add_stats_columns(conn, stats_columns, pairs):
+    # Add a column to tbl_stats_wide for each new (db, unit) pair, updating stats_columns in place 
+    for db, unit in pairs:
+        if (db, unit) in stats_columns: continue 
+        col_name = 'stat_{0}'.format(len(stats_columns) + 1)
+        conn.execute('ALTER TABLE tbl_stats_wide ADD COLUMN {0} REAL'.format(col_name))
+        conn.execute('ALTER TABLE tbl_stats_rollup ADD COLUMN {0} REAL'.format(col_name))
+        conn.execute('INSERT INTO tbl_stats_columns (col_name, db, unit, label) VALUES (?,?,?,?)', col_name, db, unit, str(db) + ": " + str(unit))
+        stats_columns[(db, unit)] = col_name
+
+def refresh_stats_wide(conn, stats_columns, bp_ids=None):
+    # Rebuild the wide rows of the given projects (all projects if bp_ids is None) from tbl_data_stats 
+    if not stats_columns: return 
+    pairs   = stats_columns.items()
+    cols    = ', '.join(col_name for pair, col_name in pairs)
+    pivot   = ', '.join('MAX(CASE WHEN db IS ? AND unit IS ? THEN val END)' for pair in pairs)
+    params  = [x for (db, unit), col_name in pairs for x in (db, unit)]
+    insert  = 'INSERT INTO tbl_stats_wide (bp_id, {0}) SELECT bp_id, {1} FROM tbl_data_stats {2} GROUP BY bp_id'
+    if bp_ids is None:
+        conn.execute('DELETE FROM tbl_stats_wide')
+        conn.execute(insert.format(cols, pivot, ''), *params)
+        return 
+    bp_ids = list(bp_ids)
+    for i in range(0, len(bp_ids), 200):
+        chunk = bp_ids[i:i + 200]
+        marks = ','.join('?' * len(chunk))
+        conn.execute('DELETE FROM tbl_stats_wide WHERE bp_id IN ({0})'.format(marks), *chunk)
+        conn.execute(insert.format(cols, pivot, 'WHERE bp_id IN ({0})'.format(marks)), *(params + chunk))
+
+def build_closure(conn):
+    # Rebuild tbl_closure with a recursive query. UNION (not UNION ALL) keeps each (ancestor, descendant) pair once, so a project 
+    # reached through several parents is counted once and cycles in the links end the recursion instead of looping. 
+    conn.execute('DELETE FROM tbl_closure')
+    conn.execute("""INSERT INTO tbl_closure (ancestor, descendant) 
+                    WITH RECURSIVE closure(ancestor, descendant) AS (
+                        SELECT bp_id, bp_id FROM tbl_node 
+                        UNION 
+                        SELECT closure.ancestor, tbl_link.id_to FROM closure JOIN tbl_link ON tbl_link.id_from = closure.descendant) 
+                    SELECT ancestor, descendant FROM closure""")
+
+def refresh_stats_rollup(conn, stats_columns):
+    # Rebuild tbl_stats_rollup from tbl_closure and tbl_stats_wide. Projects with no statistics anywhere in their subtree get no row. 
+    conn.execute('DELETE FROM tbl_stats_rollup')
+    if not stats_columns: return 
+    existing = set(row[1] for row in conn.execute('PRAGMA table_info(tbl_stats_rollup)'))
+    for col_name in stats_columns.values():     # Databases from older versions have the wide table but not its roll-up columns 
+        if col_name not in existing: conn.execute('ALTER TABLE tbl_stats_rollup ADD COLUMN {0} REAL'.format(col_name))
+    cols    = stats_columns.values()
+    conn.execute('INSERT INTO tbl_stats_rollup (bp_id, {0}) SELECT c.ancestor, {1} FROM tbl_closure c JOIN tbl_stats_wide w ON w.bp_id = c.descendant '
+                 'GROUP BY c.ancestor'.format(', '.join(cols), ', '.join('SUM(w.{0})'.format(col_name) for col_name in cols)))
+
 
 # Launch and operate the SQLite database 
 class init_db:
-    def __init__(self, db_file, bp_list_file=None, queue_result=None):
+    def __init__(self, db_file, bp_list_file=None, queue_result=None, batch_rows=5000, batch_seconds=1.0):
         
         self._db_file = db_file # Make avaialble for the saving thread 
+        self._batch_rows    = batch_rows        # The saving thread commits once this many rows are waiting ... 
+        self._batch_seconds = batch_seconds     # ... or this many seconds after the first result of the batch arrived 
 
         logger.debug("Initializing database; connecting to run queries.")
 
         #  Initialize the database itself 
-        self._engine = create_engine('sqlite:///' + db_file, echo=False)
-        self._metadata = MetaData()
-        self._tbl_node = Table('tbl_node', self._metadata,
-                Column('bp_id', Integer, primary_key=True),
-                Column('genome_id', Integer),
-                Column('create_date', String), 
-                Column('accno', String),
-                Column('name', String),
-                Column('title', String),
-                Column('project_type', String),
-                Column('target_capture', String),
-                Column('target_material', String),
-                Column('target_sample_scope', String),
-                Column('organism_name', String),
-                Column('organism_supergroup', String),
-                Column('method', String),
-                Column('data_type', String),
-                )
-        self._tbl_link = Table('tbl_link', self._metadata,
-                Column('id_tbl_link', Integer, primary_key=True),
-                Column('id_from', Integer), 
-                Column('id_to', Integer), 
-                Column('link_genome_id', String), 
-                )
-        self._tbl_aggregated_data = Table('tbl_aggregated_data', self._metadata, 
-                Column('id_aggregated_data', Integer, primary_key=True),
-                Column('bp_id', Integer),
-                Column('label', String),
-                Column('int_count', Integer),
-                Column('str_database', String),
-                Column('str_url', String), 
-                )
-                
-        self._tbl_data_stats = Table('tbl_data_stats', self._metadata, 
-                Column('id_data_stats', Integer, primary_key=True),
-                Column('bp_id', Integer),
-                Column('db', String),
-                Column('unit', String),
-                Column('val', Numeric),
-                )
-        
-        self._tbl_sub_organization = Table('tbl_submission_org', self._metadata,
-                Column('id_submission_org', Integer, primary_key=True),
-                Column('org_name', String),
-                Column('org_type', String),
-                Column('org_role', String),
-                Column('bp_id', Integer),
-                )
-
-        self._metadata.create_all(self._engine) 
+        self._engine = make_engine(db_file)
+        self._metadata = make_metadata()
+        self._tbl_node              = self._metadata.tables['tbl_node']
+        self._tbl_link              = self._metadata.tables['tbl_link']
+        self._tbl_aggregated_data   = self._metadata.tables['tbl_aggregated_data']
+        self._tbl_data_stats        = self._metadata.tables['tbl_data_stats']
+        self._tbl_sub_organization  = self._metadata.tables['tbl_submission_org']
+        self._tbl_crawl_state       = self._metadata.tables['tbl_crawl_state']
+        migrate_schema(self._engine, self._metadata)
         self._conn = self._engine.connect()
         
         
@@ -93,6 +352,9 @@ class init_db:
     def get_ids_to_fetch(self): 
         return self._ids_to_fetch
 
+    def get_ids_top(self):
+        return self._bp_ids_top
+
     # Return *list* of all BioProjects in metadata database 
     def get_ids_existing_list(self):
         return self._bp_ids_existing
@@ -113,44 +375,85 @@ class init_db:
             bp_nodes.add(row[0])
         return bp_nodes
 
+    def find_existing_genomes(self):
+        # Find the genome IDs of all Organism Overview nodes in the database 
+        s = select([self._tbl_node.c.genome_id], self._tbl_node.c.project_type == 'Organism Overview')
+        return set(row[0] for row in self._conn.execute(s))
+
     def find_new(self, find_link_up=False, find_link_down=True):
-        # Find new non-Genome BioProjects that have not been downloaded in the specified directions (up or down) 
-        bp_nodes    = self.find_existing()   # All existing BP nodes 
-        bp_targets  = set()                 # BioProject targets of the selected direction 
-        s = select([self._tbl_link.c.id_from, self._tbl_link.c.id_to], self._tbl_link.c.link_genome_id == None)
-        result = self._conn.execute(s)
-        for row in result: 
-            if find_link_down:  bp_targets.add(row[1])
-            if find_link_up:    bp_targets.add(row[0]) 
+        # Find new non-Genome BioProjects that have not been downloaded in the specified directions (up or down). 
+        # Anti-join in SQL: link ends with no matching node. Both sides are indexed, so only the missing IDs reach Python. 
+        tbl_link, tbl_node = self._tbl_link, self._tbl_node
+        ids_to_fetch = set() 
+        ends = []
+        if find_link_down:  ends.append(tbl_link.c.id_to)
+        if find_link_up:    ends.append(tbl_link.c.id_from)
+        for end in ends:
+            s = select([end]).select_from(tbl_link.outerjoin(tbl_node, tbl_node.c.bp_id == end)).where(and_(tbl_link.c.link_genome_id == None, tbl_node.c.bp_id == None))
+            for row in self._conn.execute(s): ids_to_fetch.add(row[0])
         
-        for id in self._bp_ids_top: bp_targets.add(id)      # Add the top-level nodes from the initial seed file 
-        ids_to_fetch = bp_targets.difference(bp_nodes)      # Use set notation to find the difference between what we have and what we want.  
+        ids_to_fetch.update(self.filter_new('bioproject', self._bp_ids_top, check_journal=False))  # Add the top-level nodes from the initial seed file 
         
         self._ids_to_fetch   = ids_to_fetch 
         self._count_to_fetch = len(ids_to_fetch)
-        self._count_existing = len(bp_nodes) 
-        
-
+        self._count_existing = self._conn.execute('SELECT COUNT(*) FROM tbl_node').fetchone()[0]
 
     def get_genome_ids(self): 
-        # Find all Genome IDs that are included as source or target nodes on edges  
-        tbl_link = self._tbl_link # We reference it several times, so shorten the name 
-        downloaded_projects_set = set() 
-        result = []
-        
-        s = select([tbl_link.c.link_genome_id], tbl_link.c.link_genome_id != None,).distinct()
+        # Find all Genome IDs linked from saved projects that have no Organism Overview node yet 
+        tbl_link, tbl_node = self._tbl_link, self._tbl_node
+        join = tbl_link.outerjoin(tbl_node, and_(tbl_node.c.genome_id == tbl_link.c.link_genome_id, tbl_node.c.project_type == 'Organism Overview'))
+        s = select([tbl_link.c.link_genome_id]).select_from(join).where(and_(tbl_link.c.link_genome_id != None, tbl_node.c.bp_id == None))
+        return list(set(row[0] for row in self._conn.execute(s)))
 
-        genome_ids = self._conn.execute(s)
-        
-        s = select([self._tbl_node.c.bp_id])
-        downloaded_projects = self._conn.execute(s)
-        
-        for item in downloaded_projects: downloaded_projects_set.add(item[0]) # Make a unique set of all BP IDs we have. 
-        # Review each genome_id. If it is not saved, add it to the queue in the form of a list (genome_id, BioProject_id)
-        for g_id in genome_ids:
-            if g_id[0] not in downloaded_projects_set: result.append(g_id[0])
-        return result 
+    def find_stale(self, max_age, umbrella_only=False):
+        # Find projects last downloaded more than max_age seconds ago (or never timed). With umbrella_only, only projects with children, 
+        # whose child sets can grow. Uses the index on the fetch time. 
+        s = 'SELECT bp_id FROM tbl_node WHERE (fetched IS NULL OR fetched < ?) AND project_type != \'Organism Overview\''
+        if umbrella_only: s += ' AND EXISTS (SELECT 1 FROM tbl_link WHERE tbl_link.id_from = tbl_node.bp_id AND tbl_link.link_genome_id IS NULL)'
+        return [row[0] for row in self._conn.execute(s, time.time() - max_age)]
+
+    ##################################################
+    ### Crawl journal ################################
+    ##################################################
+    def filter_new(self, kind, id_list, check_journal=True):
+        # Return the IDs (as given) that have neither a node in the database nor, with check_journal, an entry in the crawl journal 
+        if kind == 'genome':    saved = 'SELECT genome_id FROM tbl_node WHERE project_type = \'Organism Overview\' AND genome_id IN ({0})'
+        else:                   saved = 'SELECT bp_id FROM tbl_node WHERE bp_id IN ({0})'
+        journal = 'SELECT crawl_id FROM tbl_crawl_state WHERE kind = ? AND crawl_id IN ({0})'
+        id_list = list(id_list)
+        found = set()
+        for i in range(0, len(id_list), 500):       # Stay below SQLite's limit on bound parameters 
+            chunk = [int(x) for x in id_list[i:i + 500]]
+            marks = ','.join('?' * len(chunk))
+            found.update(row[0] for row in self._conn.execute(saved.format(marks), *chunk))
+            if check_journal: found.update(row[0] for row in self._conn.execute(journal.format(marks), kind, *chunk))
+        return [x for x in id_list if int(x) not in found]
+
+    def get_crawl_state(self, statuses=('pending', 'in-flight')):
+        # Return (kind, crawl_id, depth, direction) for every journal entry with one of the given statuses 
+        s = select([self._tbl_crawl_state.c.kind, self._tbl_crawl_state.c.crawl_id, self._tbl_crawl_state.c.depth, self._tbl_crawl_state.c.direction], 
+                   self._tbl_crawl_state.c.status.in_(statuses))
+        return [tuple(row) for row in self._conn.execute(s)]
+
+    def reset_crawl_state(self):
+        # Forget the previous crawl. Called when a run starts over from the seed file instead of resuming. 
+        self._conn.execute(self._tbl_crawl_state.delete())
 
+    def close_crawl_state(self):
+        # After a complete crawl, IDs that were requested but never came back (e.g. withdrawn projects) are marked failed. Call once all results are saved. 
+        result = self._conn.execute(self._tbl_crawl_state.update().where(self._tbl_crawl_state.c.status.in_(crawl_status_replaces['failed'])).values(status='failed', updated=time.time()))
+        if result.rowcount: logger.info('{0} IDs were requested but not returned; marked failed in the crawl journal'.format(result.rowcount))
+
+    def update_closure(self):
+        # Rebuild the closure and the subtree totals after a download. Call once the saver has caught up (queue_result.join()). 
+        conn = self._engine.connect()
+        trans = conn.begin()
+        build_closure(conn)
+        refresh_stats_rollup(conn, load_stats_columns(conn))
+        bump_db_version(conn)
+        trans.commit()
+        logger.info("Closure rebuilt: {0} ancestor/descendant pairs".format(conn.execute('SELECT COUNT(*) FROM tbl_closure').fetchone()[0]))
+        conn.close()
 
     def close_db_connection(self):
         self._conn.close()
@@ -192,67 +495,134 @@ class init_db:
         self._bp_ids_top = list(bp_ids_unique)
 
     def save_returned(self, queue_result):
-        # Continue to pull results from the queue when they appear and to save them
+        # Continue to pull results from the queue when they appear and to save them. 
+        # Results are saved in groups: everything that arrives within batch_seconds (up to batch_rows rows) goes in one transaction. 
         logger.info("Thread to save values created")
         
-        engine = create_engine('sqlite:///' + self._db_file, echo=False)
-        metadata = MetaData(); metadata.reflect(engine)
-
-        # Connect to tables 
-        tbl_node                = Table("tbl_node", metadata, autoload=True)
-        tbl_link                = Table("tbl_link", metadata, autoload=True)
-        tbl_aggregated_data     = Table("tbl_aggregated_data", metadata, autoload=True)
-        tbl_data_stats          = Table("tbl_data_stats", metadata, autoload=True)
-        tbl_sub_organization    = Table("tbl_submission_org", metadata, autoload=True)
+        engine = make_engine(self._db_file)
         conn = engine.connect()
-        
-        # Insert connections 
-        node_ins      = tbl_node.insert()
-        link_ins      = tbl_link.insert()
-        aggr_ins      = tbl_aggregated_data.insert()
-        stats_ins     = tbl_data_stats.insert()
-        org_ins       = tbl_sub_organization.insert()
+
+        # Upsert statements, built once for each table and set of columns 
+        inserts = {}
+        self._stats_columns = None      # {(db, unit): column of tbl_stats_wide}, loaded with the first batch 
 
         while True:
-            returned_data = queue_result.get()
-            returned_status = [0]*5
-            returned_items = ["Attributes", "Links", "Aggregated data", "Data stats", "Submission orgs"]
-
-            # Assign "atts", "links", "submission_org", data_stats", and "aggregated_data"
-            try: atts = returned_data['bp_nodes']
-            except: atts = None  
-            
-            try: links = returned_data['links']
-            except: links = None  
-            
-            try: submission_org  = returned_data['submission_org']
-            except: submission_org = None
-            
-            try: data_stats = returned_data['data_stats']
-            except: data_stats = None 
-            
-            try: aggregated_data = returned_data['aggregated_data']
-            except: aggregated_data = None
-
-            # Collect attributes for each and load to database if there are data to be fetched 
-            if ( ( atts is not None )               and ( len(atts) > 0 ) ):             
-                logger.debug('Atts: {0}'.format(atts))
-                conn.execute(node_ins,     atts)
-            if ( ( links is not None )              and ( len(links) > 0 ) ):            
-                logger.debug('Links: {0}'.format(links))
-                conn.execute(link_ins,     links)
-            if ( ( aggregated_data is not None )    and ( len(aggregated_data) > 0 ) ):  
-                logger.debug('Aggregated_data: {0}'.format(aggregated_data))
-                conn.execute(aggr_ins,     aggregated_data)    
-            if ( ( data_stats is not None )         and ( len(data_stats) > 0 ) ):       
-                logger.debug('Data_stats: {0}'.format(data_stats))
-                conn.execute(stats_ins,    data_stats)    
-            if ( ( submission_org is not None )     and ( len(submission_org) > 0 ) ):   
-                logger.debug('Submission_org: {0}'.format(submission_org))
-                conn.execute(org_ins,      submission_org)
-
-            # Signal that the queue item was processed 
-            queue_result.task_done()
-
-
-       
+            batch       = [queue_result.get()]      # Block until there is something to save 
+            count_rows  = self.count_rows(batch[0])
+            deadline    = time.time() + self._batch_seconds
+            while count_rows < self._batch_rows:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                try:                returned_data = queue_result.get(timeout=remaining)
+                except Queue.Empty: break
+                batch.append(returned_data)
+                count_rows += self.count_rows(returned_data)
+
+            try:
+                self.save_batch(conn, inserts, batch)
+            except Exception as e:
+                # Save the results one at a time, so one bad result does not lose the rest of the batch 
+                logger.error("Error saving a batch of {0} results; saving them one at a time. Error: {1}".format(len(batch), e))
+                for returned_data in batch:
+                    try:                    self.save_batch(conn, inserts, [returned_data])
+                    except Exception as e:  logger.error("Result not saved: {0}. Error: {1}".format(returned_data, e))
+            finally:
+                # Signal that the queue items were processed, only now that they are committed 
+                for returned_data in batch: queue_result.task_done()
+
+    def count_rows(self, returned_data):
+        return sum(len(returned_data.get(key) or []) for key, table, label in returned_items) + len(returned_data.get('crawl_state') or [])
+
+    def save_crawl_state(self, conn, batch):
+        # Journal entries sent by the crawler, plus 'done' for every node saved in this batch, so a node and its status commit together 
+        now = time.time()
+        rows_by_status = {}
+        for returned_data in batch:
+            for row in returned_data.get('crawl_state') or []:
+                rows_by_status.setdefault(row['status'], []).append(dict(row, updated=now))
+            for row in returned_data.get('bp_nodes') or []:
+                if ( row.get('project_type') == 'Organism Overview' ) and ( row.get('genome_id') is not None ): kind, crawl_id = 'genome', row['genome_id']
+                else:                                                                                           kind, crawl_id = 'bioproject', row['bp_id']
+                rows_by_status.setdefault('done', []).append({'kind':kind, 'crawl_id':crawl_id, 'status':'done', 'depth':None, 'direction':None, 'updated':now})
+        for status in crawl_statuses:       # In order, so an ID found and saved within one batch keeps its depth and direction 
+            rows = rows_by_status.get(status)
+            if not rows: continue 
+            # New IDs are inserted; known IDs only move forward (see crawl_status_replaces) and keep their depth and direction 
+            conn.execute(text('INSERT OR IGNORE INTO tbl_crawl_state ({0}) VALUES ({1})'.format(', '.join(crawl_state_fields), ', '.join(':' + f for f in crawl_state_fields))), rows)
+            if crawl_status_replaces[status]:
+                conn.execute(text('UPDATE tbl_crawl_state SET status = :status, updated = :updated WHERE kind = :kind AND crawl_id = :crawl_id AND status IN ({0})'.format(
+                                  ', '.join("'{0}'".format(x) for x in crawl_status_replaces[status]))), rows)
+
+    def save_stats_wide(self, conn, batch, changed, unchanged):
+        # Bring tbl_stats_wide up to date for every project whose statistics were written or replaced in this batch 
+        if self._stats_columns is None: self._stats_columns = load_stats_columns(conn)
+        bp_ids = set(changed)
+        pairs  = set()
+        for returned_data in batch:
+            for row in returned_data.get('data_stats') or []:
+                if int(row['bp_id']) in unchanged: continue 
+                bp_ids.add(int(row['bp_id']))
+                pairs.add((row['db'], row['unit']))
+        if not bp_ids: return 
+        add_stats_columns(conn, self._stats_columns, pairs)
+        refresh_stats_wide(conn, self._stats_columns, bp_ids)
+
+    def replace_changed(self, conn, batch):
+        # Compare re-fetched projects with the stored ones by their fingerprint. Changed projects lose their old child rows and the links their 
+        # own document reported (the new ones are inserted in the same transaction); links also reported by the project at the other end stay. 
+        # Unchanged projects only get a new fetch time. Return the unchanged and the changed bp_ids. 
+        now = time.time()
+        hashes = {}
+        for returned_data in batch:
+            for row in returned_data.get('bp_nodes') or []:
+                if row.get('doc_hash') is None: continue 
+                row['fetched'] = now
+                hashes[int(row['bp_id'])] = row['doc_hash']
+        if not hashes: return set(), []
+
+        stored = {}
+        id_list = list(hashes)
+        for i in range(0, len(id_list), 500):
+            chunk = id_list[i:i + 500]
+            for bp_id, doc_hash in conn.execute('SELECT bp_id, doc_hash FROM tbl_node WHERE bp_id IN ({0})'.format(','.join('?' * len(chunk))), *chunk):
+                stored[bp_id] = doc_hash
+        unchanged   = set(bp_id for bp_id in stored if stored[bp_id] == hashes[bp_id])
+        changed     = [{'bp_id':bp_id} for bp_id in stored if stored[bp_id] != hashes[bp_id]]
+
+        if unchanged:
+            conn.execute(text('UPDATE tbl_node SET fetched = :fetched WHERE bp_id = :bp_id'), [{'fetched':now, 'bp_id':bp_id} for bp_id in unchanged])
+        if changed:
+            conn.execute(text('UPDATE tbl_link SET listed_down = NULL WHERE id_from = :bp_id'), changed)
+            conn.execute(text('UPDATE tbl_link SET listed_up = NULL WHERE id_to = :bp_id'), changed)
+            conn.execute(text('DELETE FROM tbl_link WHERE ( id_from = :bp_id OR id_to = :bp_id ) AND listed_down IS NULL AND listed_up IS NULL'), changed)
+            for table in project_child_tables: conn.execute(text('DELETE FROM {0} WHERE bp_id = :bp_id'.format(table)), changed)
+        logger.debug('Re-fetched projects: {0} unchanged, {1} changed'.format(len(unchanged), len(changed)))
+        return unchanged, [row['bp_id'] for row in changed]
+
+    def save_batch(self, conn, inserts, batch):
+        # Upsert every row of a batch of results in a single transaction, with one executemany per table and set of columns 
+        trans = conn.begin()
+        try:
+            unchanged, changed = self.replace_changed(conn, batch)
+            for key, table, label in returned_items:
+                # executemany needs the same columns in every row; genome summaries fill fewer node columns than projects 
+                rows_by_columns = {}
+                for returned_data in batch:
+                    for row in returned_data.get(key) or []: 
+                        for col in key_sentinels.get(table, ()):
+                            if row.get(col) is None: row[col] = ''
+                        if unchanged and ( table != 'tbl_link' ) and ( row.get('bp_id') is not None ) and ( int(row['bp_id']) in unchanged ): continue 
+                        rows_by_columns.setdefault(tuple(sorted(row)), []).append(row)
+                for columns, rows in rows_by_columns.items():
+                    if (table, columns) not in inserts: inserts[(table, columns)] = upsert_statement(table, columns)
+                    logger.debug('{0}: {1}'.format(label, rows))
+                    conn.execute(inserts[(table, columns)], rows)
+            self.save_stats_wide(conn, batch, changed, unchanged)
+            self.save_crawl_state(conn, batch)
+            if any(returned_data.get(key) for returned_data in batch for key, table, label in returned_items): bump_db_version(conn)   # Journal-only batches do not change exports 
+            trans.commit()
+        except:
+            trans.rollback()
+            self._stats_columns = None      # Columns added in the failed transaction are gone again 
+            raise 
+        logger.debug('Saved {0} results in one transaction'.format(len(batch)))
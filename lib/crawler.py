@@ -0,0 +1,161 @@
+# Crawl the BioProject graph outwards from a set of seed projects.
+# New IDs are scheduled as soon as the document that links to them is parsed, so there is no barrier between levels.
+# With a journal (bp_database.init_db), every scheduled ID is recorded in the database so an interrupted crawl can be resumed.
+
+import Queue                # Parsed results come back from the download workers
+import logging
+
+logger = logging.getLogger(__name__)
+
+class crawler:
+    """Pipelined frontier crawler on top of eutils_download.
+
+    Projects reached going down (children) are followed both down and up; projects reached going up (parents) are only
+    followed further up, so the crawl does not spread sideways into unrelated siblings.
+
+    Journal entries travel to the database on queue_result: IDs found in a document are recorded as pending in the same 
+    transaction as that document, IDs are marked in flight as a worker takes them, and the saver marks saved nodes done."""
+    def __init__(self, downloader, queue_result, known_ids=(), max_depth=10, genome_downloader=None, known_genome_ids=(), poll_interval=0.5, journal=None):
+        self._downloader        = downloader            # eutils_download for BioProject efetch
+        self._genome_downloader = genome_downloader     # Optional eutils_download for genome esummary; genome IDs are fetched as they are found
+        self._queue_result      = queue_result          # Results are passed on here (the database writer) after their links are read
+        self._max_depth         = max_depth             # Links are not followed beyond this many steps from the starting IDs
+        self._poll_interval     = poll_interval         # Seconds between checks for the end of the crawl
+        self._journal           = journal               # Optional bp_database.init_db; replaces known_ids with lookups in the database
+        self._unsaved_state     = []                    # Journal entries waiting to go out with the next result
+
+        self._seen              = set(str(x) for x in known_ids)            # Every ID fetched or scheduled
+        self._seen_genomes      = set(str(x) for x in known_genome_ids)
+        self._depth             = {}                    # ID -> depth, for scheduled IDs
+        self._direction         = {}                    # ID -> 'both', 'down' or 'up'
+        self._count_scheduled   = 0
+        self._count_parsed      = 0
+
+        # Parsed documents come back to the crawler first, then go on to queue_result
+        self._queue_crawl       = Queue.Queue()
+        on_take                 = self.mark_in_flight('bioproject') if journal is not None else None
+        self._frontier          = downloader.open_frontier(self._queue_crawl, on_take=on_take)
+        if genome_downloader is not None:
+            on_take             = self.mark_in_flight('genome') if journal is not None else None
+            self._genome_frontier = genome_downloader.open_frontier(queue_result, on_take=on_take)
+
+    ##################################################
+    ### Scheduling ###################################
+    ##################################################
+    def add(self, id_list, direction='both', depth=0, check_journal=True):
+        """Schedule IDs that have not been seen yet. Return the number scheduled."""
+        new_ids = []
+        for bp_id in id_list:
+            bp_id = str(bp_id)
+            if bp_id in self._seen: continue
+            self._seen.add(bp_id)
+            new_ids.append(bp_id)
+        if new_ids and check_journal and ( self._journal is not None ):
+            new_ids = self._journal.filter_new('bioproject', new_ids)     # Saved or journaled by an earlier run
+        for bp_id in new_ids:
+            self._depth[bp_id]      = depth
+            self._direction[bp_id]  = direction
+        if new_ids:
+            self.record_state('bioproject', new_ids, 'pending')
+            self._count_scheduled += len(new_ids)
+            self._frontier.add(new_ids)
+        return len(new_ids)
+
+    def add_genomes(self, genome_ids, check_journal=True):
+        """Schedule genome IDs that have not been seen yet. Ignored without a genome downloader."""
+        if self._genome_downloader is None: return 0
+        new_ids = [str(x) for x in genome_ids if str(x) not in self._seen_genomes]
+        self._seen_genomes.update(new_ids)
+        if new_ids and check_journal and ( self._journal is not None ):
+            new_ids = self._journal.filter_new('genome', new_ids)
+        if new_ids:
+            self.record_state('genome', new_ids, 'pending')
+            self._genome_frontier.add(new_ids)
+        return len(new_ids)
+
+    def resume(self):
+        """Schedule every journaled ID that was pending or in flight when the previous run stopped. Return the number scheduled."""
+        count = 0
+        groups = {}
+        for kind, crawl_id, depth, direction in self._journal.get_crawl_state(('pending', 'in-flight')):
+            groups.setdefault((kind, depth, direction), []).append(crawl_id)
+        for (kind, depth, direction), id_list in groups.items():
+            if kind == 'genome':    count += self.add_genomes(id_list, check_journal=False)
+            else:                   count += self.add(id_list, direction or 'both', depth or 0, check_journal=False)
+        return count
+
+    def expand(self, result):
+        """Schedule the projects linked from one parsed result, in one addition per depth and direction, so the many children 
+        of an umbrella project reach the frontier together (and can go through the history server)."""
+        fetched     = set(str(row['bp_id']) for row in result['bp_nodes'])
+        genome_ids  = []
+        linked      = {}                                # (depth, direction) -> IDs
+        for link in result['links'] or []:
+            if link['link_genome_id'] is not None:      # Links to Organism Overview pages go to the genome database
+                genome_ids.append(link['link_genome_id'])
+                continue
+            id_from, id_to = str(link['id_from']), str(link['id_to'])
+            if ( id_from in fetched ) and ( self._direction.get(id_from, 'both') != 'up' ):    # Child of a project reached going down
+                self.schedule_linked(linked, id_to, id_from, 'both')
+            if ( id_to in fetched ):                                                            # Parent of any fetched project
+                self.schedule_linked(linked, id_from, id_to, 'up')
+        if genome_ids: self.add_genomes(genome_ids)
+        for depth, direction in sorted(linked, key=lambda k: (k[0], k[1] != 'both')):          # An ID linked both ways is followed both ways
+            self.add(linked[(depth, direction)], direction, depth)
+
+    ##################################################
+    ### Journal ######################################
+    ##################################################
+    def state_rows(self, kind, id_list, status):
+        if kind == 'genome': return [{'kind':kind, 'crawl_id':int(x), 'status':status, 'depth':None, 'direction':None} for x in id_list]
+        return [{'kind':kind, 'crawl_id':int(x), 'status':status, 'depth':self._depth.get(x), 'direction':self._direction.get(x)} for x in id_list]
+
+    def record_state(self, kind, id_list, status):
+        # Held back until the next result goes to the database, so new IDs commit together with the document that links to them
+        if self._journal is not None: self._unsaved_state.extend(self.state_rows(kind, id_list, status))
+
+    def flush_state(self):
+        # Send held-back journal entries on their own, for IDs that were not found in a document (seeds and resumed IDs)
+        if self._unsaved_state: self._queue_result.put({'crawl_state':self._unsaved_state})
+        self._unsaved_state = []
+
+    def mark_in_flight(self, kind):
+        """Return the on_take callback for a frontier. Runs in the download workers."""
+        def on_take(id_list):
+            self._queue_result.put({'crawl_state':self.state_rows(kind, id_list, 'in-flight')})
+        return on_take
+
+    def schedule_linked(self, linked, bp_id, parent_id, direction):
+        # Collect a linked ID under its depth and direction, for expand to add
+        depth = self._depth.get(parent_id, 0) + 1
+        if depth > self._max_depth:
+            logger.debug('Depth limit reached; not following link from {0} to {1}'.format(parent_id, bp_id))
+            return
+        linked.setdefault((depth, direction), []).append(bp_id)
+
+    ##################################################
+    ### Run ##########################################
+    ##################################################
+    def run(self):
+        """Pass parsed results on to queue_result while scheduling their links, until no work is queued or in flight."""
+        logger.info('Crawl started with {0} IDs scheduled'.format(self._count_scheduled))
+        self.flush_state()
+        while True:
+            try:
+                result = self._queue_crawl.get(timeout=self._poll_interval)
+            except Queue.Empty:
+                # Workers put results before marking their task done, so an idle downloader and an empty queue mean we are finished
+                if self._downloader.is_idle() and self._queue_crawl.empty(): break
+                continue
+            self.expand(result)
+            if self._unsaved_state:
+                result['crawl_state'] = self._unsaved_state
+                self._unsaved_state = []
+            self._queue_result.put(result)
+            self._count_parsed += 1
+            if self._count_parsed % 100 == 0:
+                logger.info('Crawl progress: {0} documents parsed, {1} IDs scheduled'.format(self._count_parsed, self._count_scheduled))
+
+        if self._genome_downloader is not None:
+            self._genome_downloader.join()      # Genome IDs are all scheduled by now
+        logger.info('Crawl finished: {0} documents parsed, {1} IDs scheduled, {2} genome IDs scheduled'.format(self._count_parsed, self._count_scheduled, len(self._seen_genomes)))
@@ -5,18 +5,27 @@ import csv                              # Parse CSV input file (NCBI data report
 import datetime                         # Work with dates 
 import dateutil.relativedelta           # Add one month to the final date in the  time series 
 import logging 
+import os 
+import array                            # Typed columns of the graph model 
+import bisect 
+import cPickle                          # On-disk cache of the assembled export 
 from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, create_engine, select 
 from collections import defaultdict     # Quick way to get a dictionary of lists
+import bp_database                      # Schema and migration of the BioProject database 
+import graph_model                      # Compact graph shared by the exporters 
 
 logger = logging.getLogger(__name__)
 
+EXPORT_CACHE_VERSION = 2                # Change when the layout of the run_all() result changes, so old cache files are ignored 
+
 class db_export:
     """Provide access to bioproject data for exporters."""
     
     ###############################################
-    def __init__(self, db_file):
+    def __init__(self, db_file, cache_file=None):
         logger.debug("Initializing exporter module")
         self._db_file       = db_file           # The database of BioProject data 
+        self._cache_file    = cache_file        # Optional pickle of the run_all() and get_graph() results, reused while the database is unchanged. Each goes in its own file (see cache_path). 
 
     ##########################################################################################
     ##  Return values ########################################################################
@@ -38,12 +47,118 @@ class db_export:
         
     
     def run_all(self):
-        """Run all export functions and return the resulting data in a dictionary."""
+        """Run all export functions and return the resulting data in a dictionary.
+
+        With a cache file, the result is saved there along with the database's write counter, and later calls return the saved 
+        copy without querying the database for as long as the counter is unchanged."""
+        key = self.get_cache_key('run_all')      # Read before the export: a write made while we read is caught on the next run 
+        tmp_dict = self.load_cache('run_all', key)
+        if tmp_dict is not None:
+            self._atts_genome, self._atts_bp, self._hierarchy_genome = tmp_dict['attributes_genome'], tmp_dict['attributes_bp'], tmp_dict['hierarchy_genome']
+            self._edges, self._data_stats_cols = tmp_dict['edges'], tmp_dict['data_stats_cols']
+            return tmp_dict 
+
         self.get_db_rows()              # Export the database rows to class variables. 
         self.parse_genome_hierarchy()   # Process the hierarchies that place submission projects under organism (genome) projects. 
         
         tmp_dict = {'attributes_genome':self._atts_genome, 'attributes_bp':self._atts_bp, 'hierarchy_genome':self._hierarchy_genome, 'edges':self._edges, 'data_stats_cols':self._data_stats_cols}
+        self.save_cache('run_all', key, tmp_dict)
         return tmp_dict 
+
+    def get_graph(self):
+        """Return the graph as a graph_model.graph: typed columns and CSR adjacency, read with one pass over each table. 
+        Cached like run_all()."""
+        key = self.get_cache_key('graph')
+        graph = self.load_cache('graph', key)
+        if graph is not None: return graph 
+
+        engine = bp_database.make_engine(self._db_file)
+        metadata = bp_database.make_metadata()
+        bp_database.migrate_schema(engine, metadata)
+        tbl_node = metadata.tables["tbl_node"]
+        conn = engine.connect()
+
+        node_cols   = [col.name for col in tbl_node.c if col.name not in bp_database.bookkeeping_columns]
+        stats_cols  = conn.execute('SELECT col_name, label FROM tbl_stats_columns ORDER BY rowid').fetchall()
+
+        # Nodes: every saved project plus the link ends that were never downloaded, in bp_id order, with their data statistics 
+        bp_ids      = array.array('l')
+        saved       = array.array('b')
+        columns     = dict((col, graph_model.category_column() if col in graph_model.categorical_columns else []) for col in node_cols[1:])
+        stats       = dict((label, array.array('d')) for col_name, label in stats_cols)
+        s = ('SELECT ids.bp_id, n.bp_id IS NOT NULL, {0}{1} FROM (SELECT bp_id FROM tbl_node UNION SELECT id_from FROM tbl_link UNION SELECT id_to FROM tbl_link) ids '
+             'LEFT JOIN tbl_node n ON n.bp_id = ids.bp_id LEFT JOIN tbl_stats_wide w ON w.bp_id = ids.bp_id ORDER BY ids.bp_id').format(
+             ', '.join('n.' + col for col in node_cols[1:]), ''.join(', w.' + col_name for col_name, label in stats_cols))
+        nan = float('nan')
+        for line in conn.execute(s):
+            bp_ids.append(line[0])
+            saved.append(1 if line[1] else 0)
+            for col, value in zip(node_cols[1:], line[2:]):
+                columns[col].append(None if value is None else unicode(value))
+            for (col_name, label), value in zip(stats_cols, line[1 + len(node_cols):]):
+                stats[label].append(nan if value is None else float(value))
+
+        # Edges as pairs of node indices; bp_ids is sorted, so a binary search finds each end 
+        def index(bp_id): return bisect.bisect_left(bp_ids, bp_id)
+        edges = [(index(id_from), index(id_to)) for id_from, id_to in conn.execute('SELECT id_from, id_to FROM tbl_link')]
+        graph = graph_model.graph(bp_ids, saved, columns, node_cols, stats, [label for col_name, label in stats_cols], edges)
+
+        # Organisms carry the totals of the projects linked from them (0 where none has a value), as in parse_genome_hierarchy 
+        if stats_cols:
+            s = ("SELECT l.id_from, {0} FROM tbl_link l "
+                 "JOIN tbl_node g ON g.bp_id = l.id_from AND g.project_type = 'Organism Overview' "
+                 "LEFT JOIN tbl_stats_wide w ON w.bp_id = l.id_to "
+                 "GROUP BY l.id_from").format(', '.join('SUM(w.{0})'.format(col_name) for col_name, label in stats_cols))
+            for line in conn.execute(s):
+                i = graph.index(line[0])
+                for (col_name, label), total in zip(stats_cols, line[1:]): graph.stats[label][i] = 0 if total is None else total
+        conn.close()
+
+        self.save_cache('graph', key, graph)
+        return graph 
+
+    ##########################################################################################
+    ##  Export cache #########################################################################
+    ##########################################################################################
+    def get_cache_key(self, kind):
+        # None (no caching) without a cache file, or for databases that have no write counter yet. The database is migrated first: 
+        # a migration counts as a write, and would otherwise change the counter right after we read it. 
+        if self._cache_file is None: return None
+        if os.path.exists(self._db_file): bp_database.migrate_schema(bp_database.make_engine(self._db_file), bp_database.make_metadata())
+        version = bp_database.read_db_version(self._db_file)
+        if version is None: return None
+        return (EXPORT_CACHE_VERSION, kind, os.path.realpath(self._db_file), version)
+
+    def cache_path(self, kind):
+        # One file per kind of export, so exporters using different ones do not overwrite each other: "export_cache.graph.pickle" 
+        base, ext = os.path.splitext(self._cache_file)
+        return '{0}.{1}{2}'.format(base, kind, ext)
+
+    def load_cache(self, kind, key):
+        if key is None: return None
+        cache_file = self.cache_path(kind)
+        if not os.path.exists(cache_file): return None
+        try:
+            with open(cache_file, 'rb') as f:
+                if cPickle.load(f) != key:      # The key is pickled first, so a stale cache is rejected without reading the data 
+                    logger.info("Export cache {0} is out of date".format(cache_file))
+                    return None
+                data = cPickle.load(f)
+        except Exception as e:
+            logger.warning("Export cache {0} could not be read; reading the database. Error: {1}".format(cache_file, e))
+            return None
+        logger.info("Export read from cache {0}".format(cache_file))
+        return data
+
+    def save_cache(self, kind, key, data):
+        if key is None: return 
+        cache_file = self.cache_path(kind)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(cache_file): os.remove(cache_file)      # os.rename does not replace files on Windows 
+        os.rename(tmp_file, cache_file)
     
     ##########################################################################################
     ##  Get existing information #############################################################
@@ -51,26 +166,27 @@ class db_export:
     def get_db_rows(self): 
         """Fetch data from the database, exporting everything to class dictionaries (instead of returning values)."""
         # Establish the db connection  
-        engine = create_engine('sqlite:///' + self._db_file, echo=False)
-        metadata = MetaData(); metadata.reflect(engine)
-        tbl_node                = Table("tbl_node",  metadata, autoload=True)
-        tbl_stats               = Table("tbl_data_stats", metadata, autoload=True)
-        tbl_link                = Table("tbl_link",  metadata, autoload=True)
+        engine = bp_database.make_engine(self._db_file)
+        metadata = bp_database.make_metadata()
+        bp_database.migrate_schema(engine, metadata)   # Databases from older versions may still hold duplicate rows 
+        tbl_node                = metadata.tables["tbl_node"]
+        tbl_link                = metadata.tables["tbl_link"]
         conn = engine.connect()
 
-        # All data statistics are fetched from BioProject. We want every datatype (database + unit) in its own column but do not know the datatypes a priori.
-        # Column headers will be formed from database name and units. 
-        unique_cols = set(); data_stats = defaultdict(dict)
-        s = select([tbl_stats.c.bp_id, tbl_stats.c.db, tbl_stats.c.unit, tbl_stats.c.val]).distinct()
-        for line in conn.execute(s):
-            col_header = str(line[1])+": "+str(line[2]) 
-            data_stats[str(line[0])][col_header] = line[3]  
-            unique_cols.add(col_header)
+        # All data statistics are fetched from BioProject. Every datatype (database + unit) has its own REAL column in tbl_stats_wide, 
+        # which the saver keeps up to date; tbl_stats_columns gives the column headers ("database: unit"). Values stay numeric. 
+        stats_cols  = conn.execute('SELECT col_name, label FROM tbl_stats_columns ORDER BY rowid').fetchall()
+        unique_cols = [label for col_name, label in stats_cols]
+        data_stats  = defaultdict(dict)
+        if stats_cols:
+            for line in conn.execute('SELECT bp_id, {0} FROM tbl_stats_wide'.format(', '.join(col_name for col_name, label in stats_cols))):
+                data_stats[str(line[0])] = dict((label, val) for label, val in zip(unique_cols, line[1:]) if val is not None)
 
         
         # Get all genome (organism) nodes and transform to a dictionary 
         atts_genome = {}
-        s = select([tbl_node], tbl_node.c.project_type == 'Organism Overview')
+        node_cols = [col for col in tbl_node.c if col.name not in bp_database.bookkeeping_columns]
+        s = select(node_cols, tbl_node.c.project_type == 'Organism Overview')
         for line in conn.execute(s):
             tmp_hash = {}
             for col in line.keys():
@@ -82,7 +198,7 @@ class db_export:
 
         # Get all non-Genome BioProject nodes and transform into a dictionary 
         atts_bp = {}
-        s = select([tbl_node], tbl_node.c.project_type != 'Organism Overview')
+        s = select(node_cols, tbl_node.c.project_type != 'Organism Overview')
         for line in conn.execute(s):
             tmp_hash = {}
             for col in line.keys():
@@ -92,15 +208,13 @@ class db_export:
                     if line['project_type'] is not None:    tmp_hash[col] = unicode(line['project_type'])
                     else:                                   tmp_hash[col] = None 
             
-            if bp_id in data_stats:
-                for stat in data_stats[bp_id].keys():
-                    tmp_hash[stat] = str(data_stats[bp_id][stat])
+            if bp_id in data_stats: tmp_hash.update(data_stats[bp_id])
                     
             # Append most recent BioProject 
             atts_bp[bp_id] = tmp_hash
             
         # Get all edges and transform into a dictionary 
-        s = select([tbl_link.c.id_from, tbl_link.c.id_to]).distinct()
+        s = select([tbl_link.c.id_from, tbl_link.c.id_to])     # (id_from, id_to) is unique 
         edges = [[str(row[0]), str(row[1])] for row in conn.execute(s)]
         
         # Exports - all values are exported to class variables instead of being returned. 
@@ -108,7 +222,63 @@ class db_export:
         self._atts_bp           = atts_bp
         self._edges             = edges            
         self._data_stats_cols   = unique_cols 
+        self._stats_cols        = stats_cols        # (column of tbl_stats_wide, header) pairs 
+        self._engine            = engine 
+
 
+    def get_columns(self):
+        """Return nodes, data statistics and edges as typed column lists, all in bp_id order, for columnar exports (see lib/snapshot.py)."""
+        engine = bp_database.make_engine(self._db_file)
+        metadata = bp_database.make_metadata()
+        bp_database.migrate_schema(engine, metadata)
+        tbl_node                = metadata.tables["tbl_node"]
+        conn = engine.connect()
+
+        # Nodes: one list per column. Integer columns are flagged so they can be stored as integers. 
+        node_cols   = [col for col in tbl_node.c if col.name not in bp_database.bookkeeping_columns]
+        rows        = conn.execute(select(node_cols).order_by(tbl_node.c.bp_id)).fetchall()
+        nodes       = dict((col.name, [row[i] for row in rows]) for i, col in enumerate(node_cols))
+        node_types  = dict((col.name, 'int' if isinstance(col.type, Integer) else 'text') for col in node_cols)
+
+        # Data statistics straight from the wide table, aligned with the nodes (None where a project has no value) 
+        stats_cols  = conn.execute('SELECT col_name, label FROM tbl_stats_columns ORDER BY rowid').fetchall()
+        stats       = dict((label, []) for col_name, label in stats_cols)
+        if stats_cols:
+            s = 'SELECT {0} FROM tbl_node n LEFT JOIN tbl_stats_wide w ON w.bp_id = n.bp_id ORDER BY n.bp_id'.format(', '.join('w.' + col_name for col_name, label in stats_cols))
+            for line in conn.execute(s):
+                for (col_name, label), val in zip(stats_cols, line): stats[label].append(val)
+
+        # Edges, including the links to organism (genome) projects 
+        edges = {'id_from':[], 'id_to':[], 'link_genome_id':[]}
+        for id_from, id_to, link_genome_id in conn.execute('SELECT id_from, id_to, link_genome_id FROM tbl_link ORDER BY id_from, id_to'):
+            edges['id_from'].append(id_from); edges['id_to'].append(id_to)
+            edges['link_genome_id'].append(int(link_genome_id) if link_genome_id is not None else None)
+        conn.close()
+
+        return {'nodes':nodes, 'node_types':node_types, 'node_order':[col.name for col in node_cols], 
+                'stats':stats, 'stats_order':[label for col_name, label in stats_cols], 'edges':edges}
+
+    def get_subtree_totals(self, bp_ids=None):
+        """Return {bp_id: {column header: total}}: the data statistics summed over each project and everything below it, each 
+        descendant counted once however many paths lead to it. Read from the precomputed roll-up table; bp_ids limits the lookup."""
+        engine = bp_database.make_engine(self._db_file)
+        metadata = bp_database.make_metadata()
+        bp_database.migrate_schema(engine, metadata)
+        conn = engine.connect()
+        stats_cols  = conn.execute('SELECT col_name, label FROM tbl_stats_columns ORDER BY rowid').fetchall()
+        totals      = {}
+        if stats_cols:
+            s = 'SELECT bp_id, {0} FROM tbl_stats_rollup'.format(', '.join(col_name for col_name, label in stats_cols))
+            if bp_ids is None:  rows = conn.execute(s).fetchall()
+            else:
+                bp_ids, rows = [int(x) for x in bp_ids], []
+                for i in range(0, len(bp_ids), 500):
+                    chunk = bp_ids[i:i + 500]
+                    rows.extend(conn.execute(s + ' WHERE bp_id IN ({0})'.format(','.join('?' * len(chunk))), *chunk).fetchall())
+            for line in rows:
+                totals[str(line[0])] = dict((label, val) for (col_name, label), val in zip(stats_cols, line[1:]) if val is not None)
+        conn.close()
+        return totals
 
     # Starting with a table of edges, group BioProjects under Genomes 
     def parse_genome_hierarchy(self):
@@ -118,20 +288,21 @@ class db_export:
             if line[0] in self._atts_genome:
                 hierarchy_genome[line[0]].add(line[1])
         
-        # We have the hierarchy structure. Now we want to add _report_values to the top-level genomes. 
-        for genome_id, bp_list in hierarchy_genome.items():
-            #tmp_report_dict = defaultdict(dict)   # Dict of dicts 
-            tmp_att_dict    = dict()   
-
-            for col in self._data_stats_cols:
-                tmp_att_dict[col] = 0 
-                for bp_id in bp_list:
-                    if col in self._atts_bp[bp_id]:
-                        try:    tmp_att_dict[col] = tmp_att_dict[col] + float(self._atts_bp[bp_id][col])
-                        except: logger.error("Data statistics found, but could not be used. BioProject: {0}".format(bp_id))
-
-            # Add the new Genome data to the report_values 
-            self._atts_genome[genome_id].update(tmp_att_dict)
+        # We have the hierarchy structure. Now we want to add the data statistics of the child projects to the top-level genomes. 
+        # One GROUP BY over the links out of organism nodes, joined to the wide statistics table, sums every column at once. 
+        # SUM() skips missing values and is NULL when no child has a value; such totals are set to 0 explicitly. 
+        # Children that were never downloaded have no statistics row and add nothing. 
+        if self._stats_cols:
+            s = ("SELECT l.id_from, {0} FROM tbl_link l "
+                 "JOIN tbl_node g ON g.bp_id = l.id_from AND g.project_type = 'Organism Overview' "
+                 "LEFT JOIN tbl_stats_wide w ON w.bp_id = l.id_to "
+                 "GROUP BY l.id_from").format(', '.join('SUM(w.{0})'.format(col_name) for col_name, label in self._stats_cols))
+            conn = self._engine.connect()
+            for line in conn.execute(s):
+                genome_id = str(line[0])
+                if genome_id not in hierarchy_genome: continue 
+                self._atts_genome[genome_id].update((label, 0 if total is None else total) for label, total in zip(self._data_stats_cols, line[1:]))
+            conn.close()
         
         self._hierarchy_genome = hierarchy_genome 
     
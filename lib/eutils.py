@@ -4,62 +4,316 @@
 import threading            # Run multiple downloads. Multithreading not needed since downloads are the main time sink. 
 import Queue                # Pass tasks between threads 
 import time                 # Manage the number of downloads per second 
+import random               # Jitter for retry backoff 
+import urllib               # Measure the length of encoded queries 
+import collections          # Deque of IDs waiting to be batched 
+import multiprocessing      # Optional parsing stage in separate processes, away from the GIL held by the download threads 
 import urllib3              # Download files from NCBI 
 import logging              # Log progress 
 
 import eutils_parser        # Parsers for eutils data  
-import eutils               # Enables use of the regulate_rate class 
 
 logger = logging.getLogger(__name__)
 
+def group_ids(id_list, group_size):
+    """Split a list of IDs into strings of the appropiate size, ready to search. Return a list of the search strings."""
+    id_list = list(id_list)
+    return [','.join(map(str, id_list[i:i + group_size])) for i in range(0, len(id_list), group_size)] # Combine all ids with commas between them but no spaces.
+
 def combine_ids(id_list, group_size):
     """Split a list of IDs into strings of the appropiate size, ready to search. Return a queue of the search IDs."""
-    total_items = len(id_list)
-    gp = []; output = Queue.Queue()     # Queue is used to be thread-friendly 
-    i = 0 
-    for item in id_list:
-        i += 1
-        gp.append(item)
-        if ( (len(gp) >= group_size) or (i == total_items)): 
-            output.put(','.join(map(str, gp)))      # Combine all ids with commas between them but no spaces.
-            del gp[:]                               # Delete all elements from the list, but not the list itself 
+    output = Queue.Queue()     # Queue is used to be thread-friendly 
+    for search_string in group_ids(id_list, group_size): output.put(search_string)
     return output
     
+# Requests per second allowed by NCBI, with and without an API key 
+RATE_DEFAULT    = 3.0
+RATE_API_KEY    = 10.0
+
+# Records of a stream-parsed response written to the cache at a time, so only this many are held in memory 
+CACHE_PUT_RECORDS = 50
+
 class regulate_rate:
-    """Regulate the rate of hits to the NCBI web server. Intended for use with Eutilities."""
-    def __init__(self, min_gap=0.34):
-        self._min_gap               = min_gap           # Amount of time between hits. Default is a third of a second. 
-        self._last_hit_time         = time.time()       # Track the last hit time 
-        self._last_hit_time_lock    = threading.Lock()  # Lock to maintain consistency  
+    """Regulate the rate of hits to the NCBI web server with a token bucket. Intended for use with Eutilities.
+    
+    Tokens refill at "rate" per second up to "burst". A caller that finds the bucket empty reserves the next token and sleeps 
+    outside the lock, so waiting threads do not serialize behind each other."""
+    def __init__(self, rate=None, burst=1, api_key=None, min_gap=None, name='eutils'):
+        if rate is None:
+            if min_gap is not None: rate = 1.0 / min_gap                       # Older callers gave the gap between hits 
+            elif api_key:           rate = RATE_API_KEY
+            else:                   rate = RATE_DEFAULT
+        self._name              = name                  # Used in log messages 
+        self._rate              = float(rate)           # Tokens added per second 
+        self._burst             = float(burst)          # Maximum number of tokens held 
+        self._tokens            = float(burst)          # Start full so the first hits go out immediately 
+        self._last_hit_time     = time.time()           # Time of the last refill 
+        self._last_hit_time_lock = threading.Lock()     # Lock to maintain consistency; never held while sleeping 
+
+        # Wait statistics, to tell whether the limiter or the network is the bottleneck 
+        self._count_hits        = 0
+        self._count_waits       = 0
+        self._total_wait        = 0.0
+        self._max_wait          = 0.0
     
     def check_rate(self):
-        """Sleep if necessary so that we do not send queries too quickly to NCBI."""
-        self._last_hit_time_lock.acquire()              # Acquire the lock so that multiple threads do not conflict 
-        time_gap = time.time() - self._last_hit_time    # Find the amount of time since the last website hit to NCBI
-        if time_gap < self._min_gap:                    # If the time gap was less than the minimum set...
-            time.sleep(self._min_gap - time_gap)        # Sleep at least until min_time has passed 
-            logger.info('Sleep triggered for {sec} seconds'.format(sec=self._min_gap - time_gap))
-        self._last_hit_time = time.time()               # Update the last hit time to now. 
-        self._last_hit_time_lock.release()              # Release the lock so the next thread can start. 
+        """Take one token, sleeping if necessary so that we do not send queries too quickly to NCBI. Return the time waited."""
+        with self._last_hit_time_lock:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._last_hit_time) * self._rate)  # Refill since the last call 
+            self._last_hit_time = now
+            self._tokens -= 1                           # Reserve a token; a negative balance is a queue of waiting callers 
+            wait = max(0.0, -self._tokens / self._rate)
+
+            self._count_hits += 1
+            if wait > 0:
+                self._count_waits += 1
+                self._total_wait  += wait
+                self._max_wait     = max(self._max_wait, wait)
+
+        if wait > 0:
+            logger.debug('Rate limiter {name} sleeping for {sec:.3f} seconds'.format(name=self._name, sec=wait))
+            time.sleep(wait)
+        return wait
         
     def get_last_hit_time(self):
         """Return the last_hit_time. Should not typically be needed."""
         return self._last_hit_time
 
+    def get_wait_stats(self):
+        """Return a dictionary of how often and how long callers waited on the limiter."""
+        with self._last_hit_time_lock:
+            return {'name':self._name, 'rate':self._rate, 'burst':self._burst, 'hits':self._count_hits, 'waits':self._count_waits, 
+                    'total_wait':self._total_wait, 'max_wait':self._max_wait, 
+                    'mean_wait':(self._total_wait / self._count_hits) if self._count_hits else 0.0}
+
+    def log_wait_stats(self):
+        logger.info('Rate limiter {name}: {hits} hits, {waits} waited, {total_wait:.1f} s total wait, {max_wait:.2f} s longest wait'.format(**self.get_wait_stats()))
+
+
+# NCBI limits requests per API key (or per IP without one), whatever the tool, so every downloader with the same key 
+# shares one budget 
+_regulators         = {}
+_regulators_lock    = threading.Lock()
+
+def get_regulator(api_key=None, rate=None, burst=1):
+    """Return the shared rate regulator for an API key (None for requests without one), creating it on first use.
+
+    Later callers get the existing regulator; a warning is logged if they asked for a different rate or burst."""
+    if rate is None: rate = RATE_API_KEY if api_key else RATE_DEFAULT
+    with _regulators_lock:
+        if api_key not in _regulators:
+            _regulators[api_key] = regulate_rate(rate=rate, burst=burst, name='api key' if api_key else 'no api key')  # The key itself is not logged 
+        regulator = _regulators[api_key]
+    stats = regulator.get_wait_stats()
+    if ( float(rate) != stats['rate'] ) or ( float(burst) != stats['burst'] ):
+        logger.warning('Rate limiter {name} already runs at {rate} requests per second with burst {burst}; ignoring rate {0} and burst {1}'.format(rate, burst, **stats))
+    return regulator
+
+# Parsers in pool processes, one per (db, tool), created on first use in each process 
+_process_parsers = {}
+
+def parse_in_process(job):
+    """Parse one response in a pool process. job is (db, tool, xml_string, capture_links_down, capture_links_up). Never raises."""
+    db, tool, xml_string, capture_links_down, capture_links_up = job
+    try:
+        if (db, tool) not in _process_parsers: _process_parsers[(db, tool)] = eutils_parser.parser(db=db, tool=tool)
+        return _process_parsers[(db, tool)].parse(xml_string, capture_links_down=capture_links_down, capture_links_up=capture_links_up)
+    except Exception as e:
+        logger.error("Error while parsing in a pool process: {0}".format(e))
+        return None 
+
+class batch_sizer:
+    """Tune the number of IDs per request from observed response latency and payload size, within configured bounds."""
+    def __init__(self, initial, min_size=1, max_size=None, target_latency=10.0, max_bytes=16*1024**2, smoothing=0.3):
+        self._min_size          = max(1, min_size)
+        self._max_size          = max_size if max_size is not None else initial
+        self._size              = min(max(initial, self._min_size), self._max_size)
+        self._target_latency    = target_latency    # Seconds per request we aim for; well below the server timeout 
+        self._max_bytes         = max_bytes         # Largest response we want to hold in memory at once 
+        self._smoothing         = smoothing         # Weight of the newest observation in the moving averages 
+        self._latency_per_id    = None              # Moving averages, per ID requested 
+        self._bytes_per_id      = None
+        self._lock              = threading.Lock()
+
+    def get_size(self):
+        return self._size
+
+    def record(self, n_ids, latency, n_bytes):
+        """Record a successful request and resize. Growth is capped at doubling per observation."""
+        if n_ids < 1: return 
+        with self._lock:
+            a = self._smoothing
+            lat, size = float(latency) / n_ids, float(n_bytes) / n_ids
+            self._latency_per_id = lat  if self._latency_per_id is None else a * lat  + (1 - a) * self._latency_per_id
+            self._bytes_per_id   = size if self._bytes_per_id   is None else a * size + (1 - a) * self._bytes_per_id
+
+            wanted = min(self._target_latency / max(self._latency_per_id, 1e-6), self._max_bytes / max(self._bytes_per_id, 1.0))
+            self._size = int(min(max(wanted, self._min_size), self._max_size, self._size * 2))
+
+    def record_failure(self):
+        """Halve the batch size after a timeout or server error."""
+        with self._lock:
+            self._size = max(self._min_size, self._size // 2)
+            logger.info('Batch size reduced to {0} after a failed request'.format(self._size))
+
+class id_batches:
+    """Hand out batches of IDs whose size is decided by a batch_sizer at the moment each batch is taken.
+
+    The source sits on the task queue while it holds IDs. It can be refilled with add(), which tells the caller when 
+    the source has to be put back on the queue."""
+    def __init__(self, id_list, sizer, on_take=None):
+        self._ids       = collections.deque(id_list)
+        self._sizer     = sizer
+        self._on_take   = on_take               # Optional function called with each batch as a worker takes it (e.g. to journal IDs as in flight) 
+        self._queued    = len(self._ids) > 0    # The creator puts a non-empty source on the queue 
+        self._lock      = threading.Lock()
+
+    def take(self):
+        """Return (batch of IDs, whether the source still holds IDs and must be put back on the queue)."""
+        with self._lock:
+            n = min(self._sizer.get_size(), len(self._ids))
+            ids = [self._ids.popleft() for i in range(n)]
+            self._queued = len(self._ids) > 0
+            requeue = self._queued
+        if ids and ( self._on_take is not None ): self._on_take(ids)
+        return ids, requeue
+
+    def add(self, id_list):
+        """Add IDs. Return True if the source is off the queue and must be put back on it."""
+        with self._lock:
+            self._ids.extend(id_list)
+            if self._queued or ( len(self._ids) == 0 ): return False 
+            self._queued = True
+            return True
+
+    def empty(self):
+        with self._lock:
+            return len(self._ids) == 0
+
+class frontier:
+    """A download source that keeps accepting IDs, for crawlers that schedule new IDs while downloads are running."""
+    def __init__(self, queue_search, sizer, task_rest, on_take=None, history=None):
+        self._queue_search  = queue_search
+        self._batches       = id_batches([], sizer, on_take)
+        self._task_rest     = task_rest         # (result queue, parse, link options, url kwargs) 
+        self._on_take       = on_take
+        self._history       = history           # Optional eutils_download.history_download, which takes large additions through epost 
+
+    def add(self, id_list):
+        """Add IDs. Large additions (the seeds, or all the children of an umbrella project) go to the history server."""
+        if ( self._history is not None ) and self._history(id_list, self._task_rest, self.add_batches, self._on_take): return 
+        self.add_batches(id_list)
+
+    def add_batches(self, id_list):
+        """Add IDs to be downloaded by ID list."""
+        if self._batches.add(id_list): self._queue_search.put((self._batches,) + self._task_rest)
+
+class stream_tee:
+    """File-like wrapper around a streamed HTTP response that counts the bytes read, for batch sizing."""
+    def __init__(self, response):
+        self._response      = response
+        self.bytes_read     = 0
+
+    def read(self, size=-1):
+        data = self._response.read(size) if size >= 0 else self._response.read()
+        self.bytes_read += len(data)
+        return data
+
+class history_upload:
+    """A set of IDs to upload to the Entrez history server with epost and download in pages against the WebEnv.
+
+    The upload sits on the task queue until a worker posts it and queues its pages. It keeps track of the pages still 
+    out, so the last one to finish can hand the IDs that did not come back to "on_missing"."""
+    def __init__(self, id_list, on_missing, on_take=None):
+        self.ids            = [str(x) for x in id_list]
+        self.on_missing     = on_missing        # Function called with IDs to download by ID list instead 
+        self.on_take        = on_take           # Optional function called with the IDs as a worker takes the upload 
+        self._posted        = set()             # IDs uploaded successfully 
+        self._returned      = set()             # IDs that came back from a page 
+        self._pending       = 1                 # Pages still out, plus one held by the worker posting the upload 
+        self._lock          = threading.Lock()
+
+    def add_pages(self, id_list, count):
+        """Record IDs uploaded under one query_key, and the number of pages queued for them."""
+        with self._lock:
+            self._posted.update(id_list)
+            self._pending += count
+
+    def page_done(self, returned_ids):
+        """Record a finished page (or the end of posting) and the IDs it returned. After the last one, return the uploaded IDs 
+        that never came back; otherwise return None."""
+        with self._lock:
+            self._returned.update(returned_ids)
+            self._pending -= 1
+            if self._pending > 0: return None 
+            return sorted(self._posted - self._returned)
+
+    def __str__(self):
+        return 'upload of {0} IDs'.format(len(self.ids))
+
+class history_page:
+    """One page of a set of IDs uploaded to the Entrez history server with epost."""
+    def __init__(self, webenv, query_key, retstart, retmax, upload):
+        self.webenv     = webenv
+        self.query_key  = query_key
+        self.retstart   = retstart
+        self.retmax     = retmax
+        self.upload     = upload            # The history_upload the page belongs to 
+
+    def __str__(self):
+        return 'query_key {0}, records {1}-{2}'.format(self.query_key, self.retstart, self.retstart + self.retmax - 1)
+
 class eutils_download():
-    def __init__(self, tool='efetch', db='bioproject', group_size=1, max_connections=10, max_threads=10, email='chris.wellington@nih.gov', tool_id='threaded_downloader', **kwargs):
+    def __init__(self, tool='efetch', db='bioproject', group_size=1, max_connections=10, max_threads=10, email='chris.wellington@nih.gov', tool_id='threaded_downloader', api_key=None, rate=None, burst=1, cache=None, cache_only=False, cache_read=True, max_retries=4, backoff_base=1.0, backoff_max=60.0, min_group_size=None, max_group_size=None, target_latency=10.0, max_response_bytes=16*1024**2, max_url_length=2000, stream_parse=False, parse_processes=0, parse_pool=None, parse_timeout=300, history_threshold=None, history_chunk=10000, history_page_size=200, base_url='http://eutils.ncbi.nlm.nih.gov', **kwargs):
         self._db                    = db                        # Database being queried 
         self._tool                  = tool                      # Tool being used 
-        self._group_size            = group_size                # Number of ids to download at once.
-        self._max_threads           = max_threads               # Maximum number of threads to spawn. Does not control maximum number of urllib connections. 
+        self._group_size            = group_size                # Number of ids to download at once (starting value when adaptive).
+        self._max_url_length        = max_url_length            # Longer queries are sent as POST instead of GET 
+        self._stream_parse          = stream_parse              # Parse responses while they download instead of reading them whole first 
+        self._parse_processes       = parse_processes           # Parse in this many separate processes (0 parses in the download threads). Takes precedence over stream_parse. 
+        self._parse_pool            = parse_pool                # multiprocessing.Pool of parse_processes. Best created by the caller before any thread starts; otherwise started with the workers. 
+        self._own_parse_pool        = parse_pool is None        # Only a pool started here is closed here 
+        self._parse_timeout         = parse_timeout             # Seconds to wait for a parser process before giving up on its response 
+        self._parse_slots           = threading.BoundedSemaphore(max(1, 2 * parse_processes))  # Limits raw responses waiting for a parser 
+        self._parse_pending         = Queue.Queue()             # (AsyncResult, task) for responses handed to the parser processes, in order 
+        self._parse_collector       = None                      # Thread delivering the parsed results 
+        self._max_threads           = max_threads               # Number of long-lived download workers, i.e. the maximum number of requests in flight. 
         self._kwargs                = kwargs                    # Individual tools can have specific paramaters 
+        self._cache                 = cache                     # Optional eutils_cache.response_cache; responses are looked up here before going to NCBI 
+        self._cache_only            = cache_only                # Never touch the network; cache misses are skipped 
+        self._cache_read            = cache_read                # False still stores responses but never serves them from the cache (refreshing stale records) 
+        self._max_retries           = max_retries               # Retries per request after a timeout or server error 
+        self._backoff_base          = backoff_base              # Seconds before the first retry; doubles on each attempt 
+        self._backoff_max           = backoff_max               # Upper limit on the backoff before jitter 
+        self._dead_letter           = []                        # IDs that still failed after retries and bisection 
+        self._dead_letter_lock      = threading.Lock()
+        self._history_threshold     = history_threshold         # Use epost and WebEnv paging when at least this many IDs are requested. None turns it off. 
+        self._history_chunk         = history_chunk             # IDs per epost upload 
+        self._history_page_size     = history_page_size         # Records per efetch/esummary page (retmax) 
+
+        if stream_parse and ( parse_processes > 0 ):
+            logger.warning('Both stream_parse and parse_processes are set for {0}; responses are read whole and parsed in the processes'.format(tool))
+
+        # Batch size is tuned from observed responses when bounds are given; otherwise it stays at group_size 
+        self._sizer = batch_sizer(group_size, 
+                min_size=group_size if min_group_size is None else min_group_size, 
+                max_size=group_size if max_group_size is None else max_group_size, 
+                target_latency=target_latency, max_bytes=max_response_bytes)
 
-        # urllib3 connection pool for more efficient downloads 
+        # urllib3 connection pool for more efficient downloads. Kept for the lifetime of the object so connections persist across crawl iterations. 
         pool_headers    = {'accept-encoding':'gzip,deflate', 'connection':'keep-alive'}
-        self._pool      = urllib3.connectionpool.connection_from_url('http://eutils.ncbi.nlm.nih.gov', timeout=60, maxsize=max_connections, block=True, headers=pool_headers)
+        self._pool      = urllib3.connectionpool.connection_from_url(base_url, timeout=60, maxsize=max_connections, block=True, headers=pool_headers)
         
         # Parameters to be sent to NCBI in all requests (ids being requested are added later) 
         self._url_fields = {'db':db, 'email':email, 'tool':tool_id}
+        if api_key: self._url_fields['api_key'] = api_key      # Moves us to NCBI's higher rate tier 
+
+        # Download workers are started once (on first use) and then wait on the task queue between iterations 
+        self._regulate_rate     = get_regulator(api_key=api_key, rate=rate, burst=burst)  # Regulate the rate of hits to NCBI; one budget per API key 
+        self._queue_search      = Queue.Queue()                 # Tasks: (search string, result queue, parse, link options, url kwargs) 
+        self._workers           = []                            # Worker threads, kept so they can be stopped 
+        self._workers_lock      = threading.Lock()              # Prevent two callers from starting the workers twice 
 
     
 
@@ -68,62 +322,387 @@ class eutils_download():
     #############################################
     
     def threaded_download(self, id_list, queue_result, parse=True, get_links_down=True, get_links_up=True, **kwargs): 
-        """Perform a high-level download, starting from a list of IDs"""
-        regulate_rate   = eutils.regulate_rate()                    # Regulate the rate of hits to NCBI 
-        queue_search    = combine_ids(id_list, self._group_size)    # Generate the queue of search strings.
+        """Perform a high-level download, starting from a list of IDs. Blocks until every search string has been handled."""
+        self.start_workers()
         self._kwargs.update(kwargs)                                 # Add any keyword arguments received here to the earlier string (overwrite if pre-existing) 
+        url_kwargs = self._kwargs.copy()                            # Snapshot so later calls do not change queued tasks 
 
-        # Run the download threads 
-        thread_names = []       # Track the threads created here so they can be joined.
-        for i in range(self._max_threads):
-            thr_name = 'bp-' + str(i)
-            logger.info('Thread being launched to do efetch. Name: {0}'.format(thr_name))
-            t = threading.Thread(
-                target=self.manage_download_queue, 
-                args=(queue_search, queue_result, get_links_down, get_links_up, regulate_rate, parse, self._kwargs))
-            t.start()
-            t.name = thr_name
-            thread_names.append(thr_name) # List of the names of the threads we want to join at the end of this cycle 
+        # Batches are cut by the workers as they go, so each one uses the current batch size 
+        task_rest = (queue_result, parse, get_links_down, get_links_up, url_kwargs)
+        def queue_batches(ids):
+            self._queue_search.put((id_batches(ids, self._sizer),) + task_rest)
+        if self.history_download(id_list, task_rest, queue_batches):   # IDs the history server misses are queued before its last page is done 
+            pass 
+        elif len(id_list) > 0:
+            logger.info('Queueing {0} IDs for {1}; batch size {2}'.format(len(id_list), self._tool, self._sizer.get_size()))
+            queue_batches(id_list)
         
         # Wait for all downloads to complete before moving on 
-        logger.info("All efetch threads launched; waiting to join threads now.")
-        main_thread = threading.currentThread()
-        for t in threading.enumerate():
-            if t.name in thread_names: 
-                logger.debug("Download thread being joined: %s", t.name) 
-                t.join()
-        logger.info("Current round of efetch completed and all download threads joined.")
-
-
-    def manage_download_queue(self, queue_search, queue_result, capture_links_down, capture_links_up, regulate_rate, parse, kwargs):
-        """Manage multiple low-level downloads, using queues to identify work to be done and results collected."""
-        if parse: parser = eutils_parser.parser(db=self._db, tool=self._tool) 
-        
-        while not queue_search.empty():
-            search_string = queue_search.get()          # Get the search string from the queue 
-            regulate_rate.check_rate()                  # Prevent too many hits per second to NCBI 
-            xml_string = self.download(search_string, **kwargs)   # Download the XML from NCBI 
-            if xml_string is not None:
-                if parse:   final_result = parser.parse(xml_string, capture_links_down=capture_links_down, capture_links_up=capture_links_up) 
-                else:       final_result = xml_string 
-                queue_result.put(final_result)
-            
-            queue_search.task_done() # Signal that queue item is completed  
+        self._queue_search.join()
+        logger.info("Current round of {0} completed.".format(self._tool))
+        self._regulate_rate.log_wait_stats()
+
+    def open_frontier(self, queue_result, parse=True, get_links_down=True, get_links_up=True, on_take=None, **kwargs):
+        """Return a frontier: IDs added to it are downloaded by the workers as soon as they are free. Does not block.
+        "on_take" is called from the worker thread with each batch of IDs it is about to download."""
+        self.start_workers()
+        url_kwargs = self._kwargs.copy()
+        url_kwargs.update(kwargs)
+        return frontier(self._queue_search, self._sizer, (queue_result, parse, get_links_down, get_links_up, url_kwargs), on_take, self.history_download)
+
+    def join(self):
+        """Block until every queued task, including those added through a frontier, has been handled."""
+        self._queue_search.join()
+
+    def is_idle(self):
+        """Return True if no task is queued or in progress. Results are put on their queue before a task is marked done."""
+        return self._queue_search.unfinished_tasks == 0
+
+    def start_workers(self):
+        """Launch the long-lived download workers if they are not already running."""
+        with self._workers_lock:
+            if self._workers: return 
+            if ( self._parse_processes > 0 ) and ( self._parse_pool is None ):
+                # Forked before our threads start. Threads started elsewhere (e.g. a database writer) may already run; pass parse_pool to avoid that. 
+                logger.info('Starting {0} parser processes'.format(self._parse_processes))
+                self._parse_pool = multiprocessing.Pool(self._parse_processes)
+            if self._parse_pool is not None:
+                self._parse_collector = threading.Thread(target=self.collect_parsed, name='{0}-parsed'.format(self._db[:2]))
+                self._parse_collector.daemon = True
+                self._parse_collector.start()
+            for i in range(self._max_threads):
+                thr_name = '{0}-{1}'.format(self._db[:2], i)
+                logger.info('Download worker being launched. Name: {0}'.format(thr_name))
+                t = threading.Thread(target=self.manage_download_queue, name=thr_name)
+                t.daemon = True     # Workers idle on the queue between iterations and must not keep the program alive 
+                t.start()
+                self._workers.append(t)
+
+    def stop_workers(self):
+        """Stop the download workers once the queue is drained. They are relaunched on the next download."""
+        with self._workers_lock:
+            for t in self._workers: self._queue_search.put(None)     # One sentinel per worker 
+            for t in self._workers: t.join()
+            self._workers = []
+            if self._parse_collector is not None:
+                self._parse_pending.put(None)                       # After everything the workers handed off 
+                self._parse_collector.join()
+                self._parse_collector = None 
+            if ( self._parse_pool is not None ) and self._own_parse_pool:
+                self._parse_pool.close()
+                self._parse_pool.join()
+                self._parse_pool = None
+
+    def manage_download_queue(self):
+        """Take tasks from the shared search queue, download them and put the results on each task's result queue."""
+        parser = eutils_parser.parser(db=self._db, tool=self._tool) 
         
-        return  # Only triggered once the queue is empty 
+        while True:
+            task = self._queue_search.get()             # Block until there is work to do 
+            if task is None:                            # Sentinel from stop_workers 
+                self._queue_search.task_done()
+                return 
+            if isinstance(task[0], id_batches):         # Cut the next batch, then pass the batch source on before working on it 
+                ids, requeue = task[0].take()
+                if requeue: self._queue_search.put(task)
+                if not ids:
+                    self._queue_search.task_done()
+                    continue 
+                task = (','.join(map(str, ids)),) + task[1:]
+            if isinstance(task[0], basestring):         # Serve what the cache holds, then download only the rest 
+                try:
+                    missing = self.serve_cached(task, parser)
+                except Exception as e:
+                    logger.error("Unexpected error while reading the cache for search string {0}: {1}".format(task[0], e))
+                    missing = task[0].split(',')
+                if not missing:
+                    self._queue_search.task_done()
+                    continue 
+                task = (','.join(missing),) + task[1:]
+            if isinstance(task[0], history_upload):
+                try:                    self.handle_history_upload(task, parser)
+                except Exception as e:  logger.error("Unexpected error while handling history {0}: {1}".format(task[0], e))
+                self._queue_search.task_done()
+                continue 
+            if isinstance(task[0], history_page):
+                try:                    self.handle_history_page(task, parser)
+                except Exception as e:  logger.error("Unexpected error while handling history page {0}: {1}".format(task[0], e))
+                self._queue_search.task_done()
+                continue 
+            search_string, queue_result, parse, capture_links_down, capture_links_up, kwargs = task
+            if parse and ( self._parse_pool is not None ):
+                self.hand_off(task)                     # collect_parsed marks the task done once the parser process returns 
+                continue 
+            try:
+                final_result = None 
+                if parse and self._stream_parse:
+                    final_result = self.fetch_parsed_stream(search_string, parser, capture_links_down=capture_links_down, capture_links_up=capture_links_up, **kwargs)
+                else:
+                    xml_string = self.fetch(search_string, **kwargs)      # Get the XML from NCBI 
+                    if xml_string is not None:
+                        if parse:   final_result = parser.parse(xml_string, capture_links_down=capture_links_down, capture_links_up=capture_links_up) 
+                        else:       final_result = xml_string 
+            except Exception as e:
+                logger.error("Unexpected error while handling search string {0}: {1}".format(search_string, e))
+                final_result = None 
+
+            if final_result is not None:    queue_result.put(final_result)
+            elif not self._cache_only:      self.bisect_failed(task)   # Without the network, a cache miss cannot be retried 
+            self._queue_search.task_done() # Signal that queue item is completed. Any bisected halves were queued first, so join() still waits for them. 
+
+    def hand_off(self, task):
+        """Download a task's XML and pass the raw bytes to the parser processes. collect_parsed delivers the result."""
+        search_string, queue_result, parse, capture_links_down, capture_links_up, kwargs = task
+        try:
+            xml_string = self.fetch(search_string, **kwargs)
+        except Exception as e:
+            logger.error("Unexpected error while handling search string {0}: {1}".format(search_string, e))
+            xml_string = None 
+        if xml_string is None:
+            if not self._cache_only: self.bisect_failed(task)
+            self._queue_search.task_done()
+            return 
+
+        self._parse_slots.acquire()             # Wait if the parsers are behind, so raw responses do not pile up in memory 
+        try:
+            async_result = self._parse_pool.apply_async(parse_in_process, ((self._db, self._tool, xml_string, capture_links_down, capture_links_up),))
+        except Exception as e:
+            logger.error("Could not hand search string {0} to the parser processes: {1}".format(search_string, e))
+            async_result = None 
+        self._parse_pending.put((async_result, task))
+
+    def collect_parsed(self):
+        """Wait for each response handed to the parser processes and deliver its result, or bisect it if the parser failed, 
+        died or timed out. Only then is the task marked done, so join() cannot hang on a lost result."""
+        while True:
+            item = self._parse_pending.get()
+            if item is None: return                 # Sentinel from stop_workers 
+            async_result, task = item
+            try:
+                final_result = None 
+                if async_result is not None: final_result = async_result.get(self._parse_timeout)
+            except Exception as e:
+                logger.error("Parser process failed for search string {0}: {1!r}".format(task[0], e))
+            try:
+                if final_result is not None:    task[1].put(final_result)
+                elif not self._cache_only:      self.bisect_failed(task)
+            except Exception as e:
+                logger.error("Unexpected error while delivering search string {0}: {1}".format(task[0], e))
+            finally:
+                self._parse_slots.release()
+                self._queue_search.task_done()
+
+    def serve_cached(self, task, parser):
+        """Put the result for the cached records of a task's IDs on its result queue. Return the IDs still to download 
+        (none in cache-only mode, where they are skipped)."""
+        search_string, queue_result, parse, capture_links_down, capture_links_up, kwargs = task
+        ids = search_string.split(',')
+        if ( self._cache is None ) or ( not self._cache_read ): return ids 
+        xml_string, missing = self._cache.get(self._tool, self._db, ids, kwargs)
+        if xml_string is not None:
+            if parse:   final_result = parser.parse(xml_string, capture_links_down=capture_links_down, capture_links_up=capture_links_up)
+            else:       final_result = xml_string 
+            if final_result is None: return ids         # Download them again rather than lose them 
+            queue_result.put(final_result)
+        if missing and self._cache_only:
+            logger.info("{0} IDs not in cache and cache-only mode is set; skipping: {1}".format(len(missing), ','.join(missing)))
+            return []
+        return missing 
+
+    def bisect_failed(self, task):
+        """Split a failed group of IDs in two and queue each half, so one bad record does not sink its batch-mates. Single IDs go to the dead-letter list."""
+        ids = task[0].split(',')
+        if len(ids) > 1:
+            half = len(ids) // 2
+            logger.info("Bisecting failed search string into groups of {0} and {1}: {2}".format(half, len(ids) - half, task[0]))
+            for part in (ids[:half], ids[half:]):
+                self._queue_search.put((','.join(part),) + task[1:])
+        else:
+            logger.warning("ID failed after retries and bisection; added to the dead-letter list: {0}".format(task[0]))
+            with self._dead_letter_lock: self._dead_letter.append(task[0])
+
+    def get_dead_letter(self):
+        """Return the IDs that could not be downloaded and parsed."""
+        with self._dead_letter_lock: return list(self._dead_letter)
 
     
+    #############################################
+    ###  History server (epost + WebEnv)  #######
+    #############################################
+    def use_history(self, n_ids):
+        """Return True if this many IDs should go through epost and the history server."""
+        return ( self._history_threshold is not None ) and ( n_ids >= self._history_threshold ) and ( not self._cache_only )
+
+    def history_download(self, id_list, task_rest, on_missing, on_take=None):
+        """Queue the IDs for upload with epost and paging against the history server, if there are enough of them. Does not block.
+        Return False, queueing nothing, for lists below the threshold.
+
+        "task_rest" is (result queue, parse, link options, url kwargs). IDs that cannot be posted, or that no page returned, 
+        are passed to "on_missing" to be downloaded by ID list; "on_take" is called with the IDs when a worker takes the upload."""
+        if not self.use_history(len(id_list)): return False 
+        logger.info('Queueing {0} IDs for {1} through the history server'.format(len(id_list), self._tool))
+        self._queue_search.put((history_upload(id_list, on_missing, on_take),) + tuple(task_rest))
+        return True 
+
+    def handle_history_upload(self, task, parser):
+        """Post the IDs of an upload that are not cached, and queue pages against the WebEnv. Small remainders go by ID list."""
+        upload, queue_result, parse, get_links_down, get_links_up, url_kwargs = task
+        if upload.on_take is not None: upload.on_take(upload.ids)
+        ids = self.serve_cached((','.join(upload.ids),) + task[1:], parser)
+        if not self.use_history(len(ids)):
+            if ids: upload.on_missing(ids)
+            ids = []
+        webenv = None 
+        try:
+            for chunk_start in range(0, len(ids), self._history_chunk):
+                chunk = ids[chunk_start:chunk_start + self._history_chunk]
+                webenv, query_key = self.epost(chunk, webenv)       # Later uploads join the first WebEnv 
+                if query_key is None:
+                    logger.warning('epost failed; falling back to ID lists for {0} IDs'.format(len(chunk)))
+                    upload.on_missing(chunk)
+                    continue 
+                pages = range(0, len(chunk), self._history_page_size)
+                upload.add_pages(chunk, len(pages))
+                for retstart in pages:
+                    self._queue_search.put((history_page(webenv, query_key, retstart, self._history_page_size, upload),) + task[1:])
+        finally:
+            self.history_page_done(upload, parse, [])      # Release the hold kept while posting 
+
+    def history_page_done(self, upload, parse, returned_ids):
+        # After the last page of an upload, fetch what the history server did not return. Without parsing we cannot tell. 
+        missing = upload.page_done(returned_ids)
+        if missing and parse:
+            logger.info('{0} IDs were not returned from the history server; fetching them by ID list'.format(len(missing)))
+            upload.on_missing(missing)
+
+    def epost(self, ids, webenv=None):
+        """Upload a list of IDs to the history server. Return (WebEnv, query_key), or (None, None) on failure."""
+        url_fields          = self._url_fields.copy()
+        url_fields['id']    = ','.join(ids)
+        if webenv is not None: url_fields['WebEnv'] = webenv
+        xml_string = self.request('epost', url_fields, 'epost of {0} IDs'.format(len(ids)), force_post=True)
+        if xml_string is None: return None, None 
+        return eutils_parser.parse_epost(xml_string)
+
+    def handle_history_page(self, task, parser):
+        """Download and parse one history page, recording which IDs came back and caching its records."""
+        page, queue_result, parse, capture_links_down, capture_links_up, kwargs = task
+        url_fields = self._url_fields.copy()
+        url_fields.update(kwargs)
+        url_fields.update({'WebEnv':page.webenv, 'query_key':page.query_key, 'retstart':page.retstart, 'retmax':page.retmax})
+        returned_ids = []
+        try:
+            xml_string = self.request(self._tool, url_fields, str(page), n_ids=page.retmax)
+            if xml_string is None: return       # Missing IDs are picked up after all pages are done 
+            if self._cache is not None: self._cache.put(self._tool, self._db, xml_string, kwargs)
+            if not parse:
+                queue_result.put(xml_string)
+                return 
+
+            final_result = parser.parse(xml_string, capture_links_down=capture_links_down, capture_links_up=capture_links_up)
+            if final_result is None: return 
+            returned_ids = parser.get_returned_ids(final_result)
+            queue_result.put(final_result)
+        finally:
+            self.history_page_done(page.upload, parse, returned_ids)
+
+    def reparse_cached(self, queue_result, get_links_down=True, get_links_up=True):
+        """Parse every cached response for this tool and database into queue_result, without using the network."""
+        if self._cache is None: raise ValueError('reparse_cached requires a response cache')
+        count = 0
+        jobs = ((self._db, self._tool, xml_string, get_links_down, get_links_up) for search_string, xml_string in self._cache.iter_bodies(self._tool, self._db))
+        pool = self._parse_pool
+        if ( pool is None ) and ( self._parse_processes > 0 ):     # Parsing is the whole workload here, so spread it over the cores 
+            pool = multiprocessing.Pool(self._parse_processes)
+        if pool is not None:    results = pool.imap_unordered(parse_in_process, jobs, chunksize=8)
+        else:                   results = (parse_in_process(job) for job in jobs)
+        for final_result in results:
+            if final_result is not None: queue_result.put(final_result)
+            count += 1
+        if ( pool is not None ) and ( pool is not self._parse_pool ):
+            pool.close()
+            pool.join()
+        logger.info('Reparsed {0} cached {1} responses from {2}'.format(count, self._tool, self._db))
+        return count 
+
+    def fetch(self, search_string, **kwargs):
+        """Return the XML for a search string from NCBI, storing its records in the cache. Cached records were served by serve_cached."""
+        xml_string = self.download(search_string, **kwargs)
+        if ( xml_string is not None ) and ( self._cache is not None ):
+            self._cache.put(self._tool, self._db, xml_string, kwargs)
+        return xml_string 
+
+    def fetch_parsed_stream(self, search_string, parser, capture_links_down=True, capture_links_up=True, **kwargs):
+        """Return the parsed result for a search string, parsing the response while it downloads. 
+        
+        Records go to the cache CACHE_PUT_RECORDS at a time as the parser finishes them, so the response is never held whole."""
+        url_fields       = self._url_fields.copy()
+        url_fields.update(kwargs)
+        url_fields['id'] = search_string
+        start_time  = time.time()
+        response    = self.request(self._tool, url_fields, 'Search string: {0}'.format(search_string), stream=True)
+        if response is None: return None 
+        to_cache    = []        # Parsed records not written to the cache yet 
+        on_record   = None 
+        if self._cache is not None:
+            def on_record(xml_string):
+                to_cache.append(xml_string)
+                if len(to_cache) >= CACHE_PUT_RECORDS:
+                    self._cache.put(self._tool, self._db, ''.join(to_cache), kwargs)
+                    del to_cache[:]
+        try:
+            tee             = stream_tee(response)
+            final_result    = parser.parse_stream(tee, capture_links_down=capture_links_down, capture_links_up=capture_links_up, on_record=on_record)
+        finally:
+            response.release_conn()
+        self._sizer.record(str(search_string).count(',') + 1, time.time() - start_time, tee.bytes_read)
+        if to_cache: self._cache.put(self._tool, self._db, ''.join(to_cache), kwargs)     # Records that parsed are kept even if the response broke off later 
+        return final_result 
+
     def download(self, search_string, **kwargs):
-        """Perform a low-level Efetch download."""
+        """Perform a low-level Efetch download of a list of IDs."""
         url_fields       = self._url_fields.copy()      # Create a copy because it will be modified 
         url_fields.update(kwargs)                       # Add any other keyword args received 
         url_fields['id'] = search_string                # Prepare the fields to be sent to NCBI 
-        logger.debug("Preparing to fetch search string: {0}".format(search_string))
+        return self.request(self._tool, url_fields, 'Search string: {0}'.format(search_string), n_ids=str(search_string).count(',') + 1)
+
+    def request(self, tool, url_fields, label, n_ids=None, force_post=False, stream=False):
+        """Send one request to an Eutility, retrying timeouts and server errors with exponential backoff and jitter. 
         
-        try:
-            url_path    = '/entrez/eutils/{tool_name}.fcgi'.format(tool_name=self._tool) # Form the URL 
-            url_request = self._pool.request('GET', url_path, url_fields)
-            return url_request.data
-        except urllib3.exceptions.TimeoutError: logger.warning("Timeout error during download from NCBI. Search string: {0}".format(id_string))
+        If n_ids is given, the response is used to tune the batch size. With stream=True the open response is returned 
+        instead of its body; the caller reads it and then calls release_conn()."""
+        url_path         = '/entrez/eutils/{tool_name}.fcgi'.format(tool_name=tool) # Form the URL 
+        use_post         = force_post or ( len(url_path) + 1 + len(urllib.urlencode(url_fields)) > self._max_url_length )   # Long ID lists go in the request body 
+        logger.debug("Preparing to fetch. {0}".format(label))
+        
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                delay = random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** (attempt - 1)))  # "Full jitter" backoff 
+                logger.info("Retry {0} of {1} in {2:.1f} seconds. {3}".format(attempt, self._max_retries, delay, label))
+                time.sleep(delay)
+
+            self._regulate_rate.check_rate()            # Prevent too many hits per second to NCBI. Retries use the budget too. 
+            start_time = time.time()
+            try:
+                if use_post:    url_request = self._pool.request('POST', url_path, fields=url_fields, encode_multipart=False, retries=False, preload_content=not stream)
+                else:           url_request = self._pool.request('GET', url_path, url_fields, retries=False, preload_content=not stream)
+            except (urllib3.exceptions.TimeoutError, urllib3.exceptions.HTTPError) as e:
+                logger.warning("Error during download from NCBI: {0}. {1}".format(e, label))
+                if n_ids is not None: self._sizer.record_failure()
+                continue 
+
+            if ( url_request.status == 200 ) and stream: return url_request 
+            if url_request.status == 200: 
+                if n_ids is not None: self._sizer.record(n_ids, time.time() - start_time, len(url_request.data))
+                return url_request.data
+            if stream: 
+                url_request.read()              # Drain the error body so the connection can be reused 
+                url_request.release_conn()
+            if ( url_request.status == 429 ) or ( url_request.status >= 500 ):     # Too many requests or server trouble: worth retrying 
+                logger.warning("HTTP status {0} from NCBI. {1}".format(url_request.status, label))
+                if ( url_request.status >= 500 ) and ( n_ids is not None ): self._sizer.record_failure()
+                continue 
+            logger.warning("HTTP status {0} from NCBI; not retrying. {1}".format(url_request.status, label))
+            break 
         
-        return None # Only triggered on exception 
+        return None # Only triggered on failure 
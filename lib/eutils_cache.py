@@ -0,0 +1,194 @@
+# Persistent on-disk cache of responses from NCBI Eutilities
+# Responses are split into their records (one per ID), which are stored compressed in an SQLite file, keyed on the tool,
+# database, ID and any other request parameters. A later request is served from the records whatever batches they came in.
+
+import sqlite3              # Storage for the cache
+import re                   # Split responses into records
+import threading            # Downloads run in several threads; one connection is shared under a lock
+import hashlib              # Build cache keys
+import zlib                 # Compress record bodies
+import time                 # Entry ages and last access times
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION   = 2         # 1 stored whole responses keyed on their set of IDs; 2 stores one record per ID
+GET_CHUNK       = 500       # IDs looked up per query, below SQLite's limit on bound parameters
+SWEEP_INTERVAL  = 60        # Seconds between deletions of expired entries; the size cap is checked on every put
+
+# Record element, the ID within it, and the document wrapped around records, for each (tool, db) that can be cached
+record_formats = {
+    ('efetch',   'bioproject'): (re.compile(r'<DocumentSummary[\s>].*?</DocumentSummary>', re.S), re.compile(r'<DocumentSummary[^>]*\suid="(\d+)"'),
+                                 '<?xml version="1.0"?>\n<RecordSet>', '</RecordSet>'),
+    ('esummary', 'genome'):     (re.compile(r'<DocSum>.*?</DocSum>', re.S), re.compile(r'<Id>\s*(\d+)\s*</Id>'),
+                                 '<?xml version="1.0"?>\n<eSummaryResult>', '</eSummaryResult>'),
+}
+
+def make_key(tool, db, record_id, params=None):
+    """Return the cache key for one record."""
+    params      = sorted((str(k), str(v)) for k, v in (params or {}).items())
+    key_string  = '|'.join([tool, db, str(record_id), repr(params)])
+    return hashlib.sha1(key_string).hexdigest()
+
+def split_records(tool, db, body):
+    """Return a list of (ID, record) for the records in a response. Error and empty responses have none."""
+    if (tool, db) not in record_formats: raise ValueError('No record format for {0} {1}'.format(tool, db))
+    record_re, id_re, head, tail = record_formats[(tool, db)]
+    records = []
+    for match in record_re.finditer(body):
+        record_id = id_re.search(match.group(0))
+        if record_id is not None: records.append((record_id.group(1), match.group(0)))
+    return records
+
+def join_records(tool, db, records):
+    """Return a document holding a list of records, as a response with those records would be."""
+    record_re, id_re, head, tail = record_formats[(tool, db)]
+    return head + ''.join(records) + tail
+
+class response_cache:
+    """Store Eutilities records on disk with a per-entry TTL and a total size cap enforced by LRU eviction."""
+    def __init__(self, cache_file, ttl=30*24*3600, max_bytes=2*1024**3, compress_level=6):
+        self._cache_file        = cache_file
+        self._ttl               = ttl               # Default lifetime of an entry in seconds. None means entries never expire.
+        self._max_bytes         = max_bytes         # Size cap for the compressed bodies. None means no cap.
+        self._compress_level    = compress_level
+        self._lock              = threading.Lock()  # sqlite3 connections are not safe to share without one
+
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self._conn.text_factory = str               # Records are byte strings, like the responses they came from
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        old_entries = self.read_old_version()
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS tbl_response (
+                                cache_key   TEXT PRIMARY KEY,
+                                tool        TEXT,
+                                db          TEXT,
+                                ids         TEXT,
+                                created     REAL,
+                                expires     REAL,
+                                last_access REAL,
+                                size        INTEGER,
+                                body        BLOB)""")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_response_access ON tbl_response (last_access)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_response_tool ON tbl_response (tool, db)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_response_expires ON tbl_response (expires)')
+        self._conn.execute('PRAGMA user_version = {0}'.format(CACHE_VERSION))
+        self._conn.commit()
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM tbl_response').fetchone()[0]
+
+        self._count_hits    = 0             # Records, not requests
+        self._count_misses  = 0
+        self._last_sweep    = 0             # Time expired entries were last deleted
+
+        for tool, db, body, expires in old_entries:
+            if (tool, db) in record_formats: self.put(tool, db, body, ttl=None if expires is None else max(0, expires - time.time()))
+
+    def read_old_version(self):
+        """Read and drop a cache written before CACHE_VERSION. Return its entries as (tool, db, body, expires), to be split into records.
+
+        The old keys do not say which request parameters were used; the records are stored without any, as download_data.py asks for them."""
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] >= CACHE_VERSION: return []
+        if self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tbl_response'").fetchone() is None: return []
+        entries = [(tool, db, zlib.decompress(blob), expires) for tool, db, blob, expires in self._conn.execute('SELECT tool, db, body, expires FROM tbl_response')]
+        self._conn.execute('DROP TABLE tbl_response')
+        logger.info('Converting {0} cached responses to per-record entries'.format(len(entries)))
+        return entries
+
+    ##################################################
+    ### Cache operations #############################
+    ##################################################
+    def get(self, tool, db, id_list, params=None):
+        """Look up the records for a list of IDs. Return (document of the cached records, or None if there are none; list of IDs not cached).
+
+        Expired records count as missing."""
+        ids     = [str(x) for x in id_list]
+        keys    = dict((make_key(tool, db, x, params), x) for x in ids)
+        key_list = list(keys)
+        now     = time.time()
+        found   = {}
+        with self._lock:
+            for i in range(0, len(key_list), GET_CHUNK):
+                chunk = key_list[i:i + GET_CHUNK]
+                rows  = self._conn.execute('SELECT cache_key, body FROM tbl_response WHERE cache_key IN ({0}) AND (expires IS NULL OR expires >= ?)'.format(','.join('?' * len(chunk))), chunk + [now])
+                for key, blob in rows: found[keys[key]] = blob
+            self._conn.executemany('UPDATE tbl_response SET last_access = ? WHERE cache_key = ?', [(now, key) for key in key_list if keys[key] in found])
+            self._conn.commit()
+            self._count_hits   += len(found)
+            self._count_misses += len(ids) - len(found)
+        missing = [x for x in ids if x not in found]
+        if not found: return None, missing
+        return join_records(tool, db, [zlib.decompress(found[x]) for x in ids if x in found]), missing
+
+    def put(self, tool, db, body, params=None, ttl=None):
+        """Store each record of a response under its own ID. "ttl" overrides the default lifetime. Return the number of records stored.
+
+        Responses without records (errors, or IDs that do not exist) are not stored, so a later request goes back to NCBI."""
+        records = split_records(tool, db, body)
+        if not records:
+            logger.debug('No records in {0} {1} response; not cached'.format(tool, db))
+            return 0
+        now         = time.time()
+        ttl         = self._ttl if ttl is None else ttl
+        expires     = None if ttl is None else now + ttl
+        with self._lock:
+            for record_id, record in records:
+                key  = make_key(tool, db, record_id, params)
+                blob = zlib.compress(record, self._compress_level)
+                old  = self._conn.execute('SELECT size FROM tbl_response WHERE cache_key = ?', (key,)).fetchone()
+                if old is not None: self._total_bytes -= old[0]
+                self._conn.execute('INSERT OR REPLACE INTO tbl_response VALUES (?,?,?,?,?,?,?,?,?)',
+                        (key, tool, db, record_id, now, expires, now, len(blob), sqlite3.Binary(blob)))
+                self._total_bytes += len(blob)
+            self.evict()
+            self._conn.commit()
+        return len(records)
+
+    def evict(self):
+        """Drop expired entries (at most every SWEEP_INTERVAL seconds, or when over the size cap), then the least recently used ones
+        until the cache is under its size cap. Call with the lock held."""
+        now = time.time()
+        over_cap = ( self._max_bytes is not None ) and ( self._total_bytes > self._max_bytes )
+        if over_cap or ( now - self._last_sweep >= SWEEP_INTERVAL ):
+            self._last_sweep = now
+            freed = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM tbl_response WHERE expires < ?', (now,)).fetchone()[0]
+            if freed:
+                self._conn.execute('DELETE FROM tbl_response WHERE expires < ?', (now,))
+                self._total_bytes -= freed
+        if ( self._max_bytes is None ) or ( self._total_bytes <= self._max_bytes ): return
+
+        to_delete = []
+        for key, size in self._conn.execute('SELECT cache_key, size FROM tbl_response ORDER BY last_access'):
+            if self._total_bytes <= self._max_bytes: break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany('DELETE FROM tbl_response WHERE cache_key = ?', to_delete)
+        logger.info('Evicted {0} entries from the response cache'.format(len(to_delete)))
+
+    def iter_bodies(self, tool, db, include_expired=True, group_size=200):
+        """Yield (comma-separated IDs, document) for the cached records of a tool and database, "group_size" records per document.
+        Expired records are kept for reparsing by default."""
+        conn = sqlite3.connect(self._cache_file)      # Own connection, so downloads are not blocked while we stream (WAL allows concurrent readers)
+        conn.text_factory = str
+        try:
+            if include_expired:
+                rows = conn.execute('SELECT ids, body FROM tbl_response WHERE tool = ? AND db = ?', (tool, db))
+            else:
+                rows = conn.execute('SELECT ids, body FROM tbl_response WHERE tool = ? AND db = ? AND (expires IS NULL OR expires >= ?)', (tool, db, time.time()))
+            ids, records = [], []
+            for record_id, blob in rows:
+                ids.append(record_id)
+                records.append(zlib.decompress(blob))
+                if len(records) >= group_size:
+                    yield ','.join(ids), join_records(tool, db, records)
+                    ids, records = [], []
+            if records: yield ','.join(ids), join_records(tool, db, records)
+        finally:
+            conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            count = self._conn.execute('SELECT COUNT(*) FROM tbl_response').fetchone()[0]
+        return {'entries':count, 'bytes':self._total_bytes, 'hits':self._count_hits, 'misses':self._count_misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
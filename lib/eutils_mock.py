@@ -0,0 +1,168 @@
+# Local stand-in for NCBI Eutilities, so downloads can be exercised without the network.
+# Serves efetch (bioproject), esummary (genome) and epost, including WebEnv/query_key paging, from records held in memory.
+
+import BaseHTTPServer       # HTTP server
+import SocketServer         # Handle each request in its own thread
+import threading            # Run the server in the background
+import urlparse             # Parse query strings and POST bodies
+import uuid                 # WebEnv strings
+import logging
+
+logger = logging.getLogger(__name__)
+
+##################################################
+### Record builders ##############################
+##################################################
+def bioproject_record(bp_id, name=None, title=None, project_type='Submission', organism_name=None, species=None, supergroup=None,
+                      children=(), parents=(), genome_links=(), data_stats=(), create_date='01-Jan-2012', organization=None):
+    """Return a DocumentSummary element as returned by efetch for the bioproject database.
+
+    "genome_links" are (genome BioProject ID, genome ID) pairs for "Up" links to Organism Overview projects.
+    "data_stats" are (db, unit, value) triples."""
+    name  = name  or 'Project {0}'.format(bp_id)
+    title = title or 'Title of project {0}'.format(bp_id)
+    organism = ''
+    if organism_name is not None:
+        organism = '<Organism species="{0}"><OrganismName>{1}</OrganismName><Supergroup>e{2}</Supergroup></Organism>'.format(species or '', organism_name, supergroup or 'Other')
+    relations = ''.join('<RelationData id="{0}"/>'.format(x) for x in children)
+    relation_groups = '<RelationGroup level="Down">{0}</RelationGroup>'.format(relations) if relations else ''
+    relations = ''.join('<RelationData id="{0}"/>'.format(x) for x in parents)
+    relations += ''.join('<RelationData id="{0}"><GenomeID>{1}</GenomeID></RelationData>'.format(x, g) for x, g in genome_links)
+    if relations: relation_groups += '<RelationGroup level="Up">{0}</RelationGroup>'.format(relations)
+    stats = ''.join('<Data db="{0}" unit="{1}">{2}</Data>'.format(db, unit, val) for db, unit, val in data_stats)
+    submission = '<Organization role="owner" type="institute"><Name>{0}</Name></Organization>'.format(organization) if organization else ''
+    return ('<DocumentSummary uid="{bp_id}">'
+            '<Project><ProjectID><ArchiveID accession="PRJNA{bp_id}" archive="NCBI" id="{bp_id}"/></ProjectID>'
+            '<ProjectDescr><Name>{name}</Name><Title>{title}</Title></ProjectDescr>'
+            '<ProjectType><ProjectType{project_type}><Target capture="eWhole" material="eGenome" sample_scope="eMonoisolate">{organism}</Target>'
+            '<Method method_type="eSequencing"/><Objectives><Data data_type="eRawSequenceReads"/></Objectives></ProjectType{project_type}></ProjectType></Project>'
+            '<RelationSet>{relations}</RelationSet>'
+            '<Submission>{submission}</Submission>'
+            '<DataStatistics>{stats}</DataStatistics>'
+            '<CreateDate>{create_date}</CreateDate>'
+            '</DocumentSummary>').format(bp_id=bp_id, name=name, title=title, project_type=project_type, organism=organism,
+                                         relations=relation_groups, submission=submission, stats=stats, create_date=create_date)
+
+def genome_record(genome_id, bp_id, organism_name, kingdom='Eukaryota'):
+    """Return a DocSum element as returned by esummary for the genome database."""
+    return ('<DocSum><Id>{0}</Id>'
+            '<Item Name="Organism_Name" Type="String">{2}</Item>'
+            '<Item Name="Organism_Kingdom" Type="String">{3}</Item>'
+            '<Item Name="ProjectID" Type="Integer">{1}</Item>'
+            '</DocSum>').format(genome_id, bp_id, organism_name, kingdom)
+
+# Document wrapper for each (tool, db)
+_wrappers = {
+    ('efetch',   'bioproject'): ('<?xml version="1.0"?>\n<RecordSet>', '</RecordSet>'),
+    ('esummary', 'genome'):     ('<?xml version="1.0"?>\n<eSummaryResult>', '</eSummaryResult>'),
+}
+
+##################################################
+### Server #######################################
+##################################################
+class _threaded_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # Keep-alive, like NCBI
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.respond(path, urlparse.parse_qs(query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        path, _, query = self.path.partition('?')
+        fields = urlparse.parse_qs(query)
+        fields.update(urlparse.parse_qs(body))
+        self.respond(path, fields)
+
+    def respond(self, path, fields):
+        fields = dict((k, v[-1]) for k, v in fields.items())
+        tool = path.rsplit('/', 1)[-1].replace('.fcgi', '')
+        status, body = self.server.mock.handle(tool, self.command, fields)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class mock_eutils:
+    """In-memory Eutilities server. Records are added per database, then start() returns the base URL to give eutils_download."""
+    def __init__(self, port=0):
+        self._port          = port              # 0 picks a free port
+        self._records       = {}                # {db: {id: xml}}
+        self._history       = {}                # {WebEnv: {query_key: [ids]}}
+        self._fail_ids      = set()             # Requests including these IDs get HTTP 500
+        self._lock          = threading.Lock()
+        self.request_log    = []                # (tool, method, number of IDs or records requested)
+
+    def add_record(self, db, record_id, xml):
+        self._records.setdefault(db, {})[str(record_id)] = xml
+
+    def add_failing_id(self, record_id):
+        self._fail_ids.add(str(record_id))
+
+    def start(self):
+        self._server = _threaded_server(('127.0.0.1', self._port), _handler)
+        self._server.mock = self
+        t = threading.Thread(target=self._server.serve_forever, name='mock-eutils')
+        t.daemon = True
+        t.start()
+        return self.get_base_url()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_base_url(self):
+        return 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def handle(self, tool, method, fields):
+        """Return (HTTP status, body) for one request."""
+        db = fields.get('db')
+        if tool == 'epost':
+            ids = fields.get('id', '').split(',')
+            with self._lock:
+                webenv = fields.get('WebEnv') or 'MCID_' + uuid.uuid4().hex
+                keys = self._history.setdefault(webenv, {})
+                query_key = str(len(keys) + 1)
+                keys[query_key] = ids
+                self.request_log.append((tool, method, len(ids)))
+            return 200, '<?xml version="1.0"?>\n<ePostResult><QueryKey>{0}</QueryKey><WebEnv>{1}</WebEnv></ePostResult>'.format(query_key, webenv)
+
+        if (tool, db) not in _wrappers:
+            return 400, '<ERROR>Unsupported tool or database</ERROR>'
+        if 'WebEnv' in fields:
+            with self._lock:
+                try:    ids = self._history[fields['WebEnv']][fields['query_key']]
+                except KeyError: return 400, '<ERROR>Unknown WebEnv or query_key</ERROR>'
+            retstart = int(fields.get('retstart', 0))
+            ids = ids[retstart:retstart + int(fields.get('retmax', 20))]
+        else:
+            ids = fields.get('id', '').split(',')
+
+        with self._lock: self.request_log.append((tool, method, len(ids)))
+        if self._fail_ids.intersection(ids):
+            return 500, '<ERROR>Simulated server error</ERROR>'
+        records = self._records.get(db, {})
+        head, tail = _wrappers[(tool, db)]
+        return 200, head + ''.join(records[x] for x in ids if x in records) + tail
+
+
+if __name__ == '__main__':
+    # Serve a small umbrella project with two children and a genome until interrupted
+    logging.basicConfig(level=logging.DEBUG)
+    mock = mock_eutils(port=8089)
+    mock.add_record('bioproject', 1, bioproject_record(1, project_type='TopAdmin', children=[2, 3]))
+    mock.add_record('bioproject', 2, bioproject_record(2, parents=[1], genome_links=[(10, 51)], organism_name='Homo sapiens', species='9606', supergroup='Eukaryotes', data_stats=[('SRA', 'Mbases', '1,500')]))
+    mock.add_record('bioproject', 3, bioproject_record(3, parents=[1], organism_name='Mus musculus', species='10090', supergroup='Eukaryotes'))
+    mock.add_record('genome', 51, genome_record(51, 10, 'Homo sapiens'))
+    print 'Mock Eutilities serving at', mock.start()
+    try:
+        while True: threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -4,13 +4,145 @@
 import xml.etree.cElementTree as ET  # Parse XML 
 import logging
 import datetime
+import hashlib      # Fingerprint each parsed project, so re-fetched projects that did not change can be skipped 
 
 logger = logging.getLogger(__name__)
 
+# Fields that will serve as the columns in the SQL tables. Used to populate dictionaries. 
+bp_nodes_fields = [
+        'bp_id', 'genome_id', 'create_date', 'accno', 'name', 'title', 'project_type', 'target_capture', 'target_material',
+        'target_sample_scope', 'organism_name', 'organism_supergroup', 'method', 'data_type', 'doc_hash',]
+link_fields              = ['id_from', 'id_to', 'link_genome_id', 'listed_down', 'listed_up']
+aggregated_data_fields   = ['bp_id', 'label', 'int_count', 'str_database', 'str_url']
+data_stats_fields        = ['bp_id', 'db', 'unit', 'val'] 
+sub_organization_fields  = ['org_name', 'org_type', 'org_role', 'bp_id']
+
+##################################################
+### Declarative field extraction #################
+##################################################
+TEXT    = '#text'   # Rule attribute meaning the text of the element 
+TAG     = '#tag'    # Rule attribute meaning the tag of the element 
+
+def strip_enum(value):
+    """NCBI enumerations carry a leading "e" (eGenome -> Genome)."""
+    return value[1:]
+
+def project_type_name(tag):
+    """Turn the ProjectType child tag into the project type ("ProjectTypeSubmission" -> "Submission")."""
+    return tag[11:]
+
+def text_or_empty(value):
+    """Same as findtext: an element without text gives an empty string."""
+    return value or ''
+
+# Rules are (field, path, attribute, transform, default). Paths are relative to the element being extracted. 
+project_rules = [
+    ('accno',               'ProjectID/ArchiveID',                          'accession',    None,               None),
+    ('name',                'ProjectDescr/Name',                            TEXT,           text_or_empty,      None),
+    ('title',               'ProjectDescr/Title',                           TEXT,           text_or_empty,      None),
+    ('organism_name',       'ProjectType/*/Target/Organism/OrganismName',   TEXT,           text_or_empty,      None),
+    ('project_type',        'ProjectType/*',                                TAG,            project_type_name,  None),
+    ('project_subtype',     'ProjectType/*',                                'subtype',      None,               None),
+    ('target_capture',      'ProjectType/*/Target',                         'capture',      strip_enum,         None),
+    ('target_material',     'ProjectType/*/Target',                         'material',     strip_enum,         None),
+    ('target_sample_scope', 'ProjectType/*/Target',                         'sample_scope', strip_enum,         None),
+    ('genome_id',           'ProjectType/*/Target/Organism',                'species',      None,               None),
+    ('organism_supergroup', 'ProjectType/*/Target/Organism/Supergroup',     TEXT,           strip_enum,         None),
+    ('method',              'ProjectType/*/Method',                         'method_type',  strip_enum,         None),
+    ('data_type',           'ProjectType/*/Objectives/Data',                'data_type',    strip_enum,         None),]
+
+genome_rules = [
+    ('genome_id',           'Id',                                           TEXT,           None,               None),
+    ('bp_id',               "Item[@Name='ProjectID']",                      TEXT,           None,               None),
+    ('name',                "Item[@Name='Organism_Name']",                  TEXT,           None,               None),
+    ('title',               "Item[@Name='Organism_Name']",                  TEXT,           None,               None),
+    ('organism_name',       "Item[@Name='Organism_Name']",                  TEXT,           None,               None),
+    ('organism_supergroup', "Item[@Name='Organism_Kingdom']",               TEXT,           None,               None),]
+
+def split_path(path):
+    """Split an ElementPath into single steps. ElementTree reads "*Target" as "*/Target", so that is split too."""
+    steps = []
+    for step in path.split('/'):
+        if ( len(step) > 1 ) and step.startswith('*') and ( step[1] != '[' ):
+            steps.extend(['*', step[1:]])
+        else:
+            steps.append(step)
+    return steps
+
+class field_rules:
+    """A table of extraction rules compiled once and then applied to many elements.
+
+    Rule paths are broken into steps and every distinct sub-path is looked up once per element, so rules sharing a prefix 
+    (such as 'ProjectType/*/Target') do not repeat the search. A missing element or attribute, or a transform that 
+    raises, gives the rule's default."""
+    def __init__(self, rules):
+        prefixes        = {}    # Tuple of steps -> index in self._steps 
+        self._steps     = []    # (index of the parent step or -1 for the element itself, step) 
+        self._rules     = []    # (field, index of the step holding the element, attribute, transform, default) 
+        for field, path, attribute, transform, default in rules:
+            parent = -1
+            steps = split_path(path)
+            for i in range(len(steps)):
+                key = tuple(steps[:i + 1])
+                if key not in prefixes:
+                    prefixes[key] = len(self._steps)
+                    self._steps.append((parent, steps[i]))
+                parent = prefixes[key]
+            self._rules.append((field, parent, attribute, transform, default))
+
+    def extract(self, element):
+        """Return a dictionary of every rule's field for one element."""
+        found = []
+        for parent, step in self._steps:
+            base = element if parent < 0 else found[parent]
+            found.append(None if base is None else base.find(step))
+
+        values = {}
+        for field, index, attribute, transform, default in self._rules:
+            el = element if index < 0 else found[index]
+            if el is None:
+                values[field] = default
+                continue 
+            if attribute == TEXT:   value = el.text
+            elif attribute == TAG:  value = el.tag
+            else:                   value = el.get(attribute)
+            if transform is not None:
+                try:                value = transform(value)
+                except Exception:   value = default
+            values[field] = value
+        return values
+
+# Row lists that belong to a single DocumentSummary, besides its node 
+document_row_keys = ['links', 'data_stats', 'submission_org', 'aggregated_data']
+
+def new_bioproject_rows():
+    """Return the empty row lists filled by the BioProject parsers, keyed as the database writer expects."""
+    return {'bp_nodes':[],          # List of BioProject nodes (each node is a dictionary) 
+            'links':[],             # List of links (from, to, genome id) 
+            'data_stats':[],        # Data statistics 
+            'submission_org':[],    # Submission Organizations.
+            'aggregated_data':[]}   # Aggregated Data section from BioProjects.
+
+def parse_epost(xml_string):
+    """Return (WebEnv, query_key) from an epost result, or (None, None) if the upload was refused."""
+    try:
+        xml_tree = ET.fromstring(xml_string)
+    except Exception as e:
+        logger.warning("Error parsing epost result. Error report: \n%s", e)
+        return None, None 
+    webenv      = xml_tree.findtext('WebEnv')
+    query_key   = xml_tree.findtext('QueryKey')
+    if ( webenv is None ) or ( query_key is None ):
+        logger.warning("epost returned no WebEnv. Error report: %s", xml_tree.findtext('ERROR'))
+        return None, None 
+    return webenv, query_key
+
 class parser:
     def __init__(self, db='bioproject', tool='efetch'):
         self._db    = db    # Database being queried 
         self._tool  = tool  # Tool being used 
+        self._project_fields    = field_rules(project_rules)   # Compiled once per parser 
+        self._genome_fields     = field_rules(genome_rules)
         logger.debug("Parser instantiated with database: {database} and with tool: {tool}".format(database=db, tool=tool))
 
     def parse(self, xml_string, **kwargs):
@@ -22,6 +154,21 @@ class parser:
 
         # If we reach this far without triggering "return", we know that the parser was not found. 
         logger.critical('No parser provided for the given combination of tool and database. Tool: {tool}, Database: {database}'.format(tool=self._tool, database=self._db))
+
+    def parse_stream(self, file_obj, on_record=None, **kwargs):
+        """Parse from a file-like object. BioProject efetch is parsed incrementally; other results are read whole first.
+        
+        "on_record", if given, is called with the XML of each record that was parsed, or once with the whole response when it was read whole."""
+        if ( self._db == 'bioproject' ) and ( self._tool == 'efetch' ): return self.parse_efetch_bioproject_stream(file_obj, on_record=on_record, **kwargs)
+        xml_string = file_obj.read()
+        result = self.parse(xml_string, **kwargs)
+        if ( result is not None ) and ( on_record is not None ): on_record(xml_string)
+        return result
+
+    def get_returned_ids(self, parsed):
+        """Return the IDs (as strings) of the records in a parsed result, i.e. the IDs that were requested and came back."""
+        id_field = 'genome_id' if self._db == 'genome' else 'bp_id'
+        return [str(row[id_field]) for row in parsed['bp_nodes'] if row.get(id_field) is not None]
     
     def parse_esummary_genome(self, xml_string, **kwargs):
         genome_tbl  = [] 
@@ -30,22 +177,16 @@ class parser:
             xml_tree = ET.fromstring(xml_string)
         except Exception as e:
             logger.warning("Error parsing genome results. Error report: \n%s", e)
+            return None 
         
-        for sub_el in xml_tree:
-            if sub_el.tag == "DocSum":
-                tmp_dict = {}
-                for DocSum_sub in sub_el:
-                    if DocSum_sub.tag == "Id":      genome_id = DocSum_sub.text
-                    if DocSum_sub.tag == "Item":    tmp_dict[DocSum_sub.attrib.get("Name")] = DocSum_sub.text
-                                    
-                # Add to the table of Genome records. Simple structure and everything is 1:1 mapping. 
-                genome_tbl.append({
-                    'bp_id':tmp_dict["ProjectID"], 'genome_id':genome_id, 
-                    'name':tmp_dict["Organism_Name"], 
-                    'title':tmp_dict["Organism_Name"],
-                    'organism_supergroup':tmp_dict["Organism_Kingdom"], 
-                    'organism_name':tmp_dict["Organism_Name"], 
-                    'project_type':'Organism Overview' }) 
+        for sub_el in xml_tree.findall('DocSum'):
+            # Add to the table of Genome records. Simple structure and everything is 1:1 mapping. 
+            genome_atts = self._genome_fields.extract(sub_el)
+            if genome_atts['bp_id'] is None:
+                logger.warning("Genome summary without a ProjectID skipped. Genome: %s", genome_atts['genome_id'])
+                continue 
+            genome_atts['project_type'] = 'Organism Overview'
+            genome_tbl.append(genome_atts)
         
         # Return a dictionary with a single key:value pair 
         return {'bp_nodes':genome_tbl, 'links':None, 'data_stats':None, 'submission_org':None, 'aggregated_data':None}
@@ -53,24 +194,7 @@ class parser:
     
     def parse_efetch_bioproject(self, xml_string, capture_links_down=True, capture_links_up=True, **kwargs):
         logger.debug("Parsing bioProject")
-        
-        # Data lists (each element will be a dictionary and will correspond to one row)
-        bp_nodes            = []   # List of BioProject nodes (each node is a dictionary) 
-        links               = []   # List of links (each link is a list: [from, to, other info] )
-        aggregated_data     = []   # Aggregated Data section from BioProjects.
-        data_stats          = []   # Data statistics 
-        submission_org      = []   # Submission Organizations.
-
-        
-        # Fields that will serve as the columns in the SQL tables. Used to populate dictionaries. 
-        bp_nodes_fields = [
-                'bp_id', 'genome_id', 'create_date', 'accno', 'name', 'title', 'project_type', 'target_capture', 'target_material',
-                'target_sample_scope', 'organism_name', 'organism_supergroup', 'method', 'data_type',]
-        link_fields              = ['id_from', 'id_to', 'link_genome_id']
-        aggregated_data_fields   = ['bp_id', 'label', 'int_count', 'str_database', 'str_url']
-        data_stats_fields        = ['bp_id', 'db', 'unit', 'val'] 
-        sub_organization_fields  = ['org_name', 'org_type', 'org_role', 'bp_id']
-
+        rows = new_bioproject_rows()    # Data lists (each element will be a dictionary and will correspond to one row)
 
         # Parsing is wrapped in a "try" statement. There should not be errors here.
         i = 0
@@ -81,128 +205,147 @@ class parser:
             return None # This avoids running the post-parsing steps and sends something back to the calling function. 
         # For each DocumentSummary
         for DocSum_tag in xml_tree.findall('DocumentSummary'):
-            bp_atts = dict.fromkeys(bp_nodes_fields) # Create a dictionary of attributes to be captured
-
-            try: # Wrap the entire Document Summary extraction in a try statement to catch errors
-                # Iterate through top-level nodes under DocSum, almost stream-style 
-                bp_atts['bp_id'] = DocSum_tag.find('Project/ProjectID/ArchiveID').attrib["id"] # Get ProjectID 
-                for sub_el in DocSum_tag:
-                    # Project Information 
-                    if sub_el.tag == "Project":
-                        bp_atts['accno']            = sub_el.find('ProjectID/ArchiveID').attrib.get("accession") 
-                        bp_atts['name']             = sub_el.findtext('ProjectDescr/Name')
-                        bp_atts['title']            = sub_el.findtext('ProjectDescr/Title')
-                        bp_atts['organism_name']    = sub_el.findtext('ProjectType/*Target/Organism/OrganismName')
-                        
-                        catch_errors = [
-                            "bp_atts['project_type']        = sub_el.find('ProjectType/*').tag[11:]",
-                            "bp_atts['target_capture']      = sub_el.find('ProjectType/*/Target').attrib.get('capture')[1:]",
-                            "bp_atts['target_material']     = sub_el.find('ProjectType/*/Target').attrib.get('material')[1:]",
-                            "bp_atts['target_sample_scope'] = sub_el.find('ProjectType/*/Target').attrib.get('sample_scope')[1:]",
-                            "bp_atts['genome_id']           = sub_el.find('ProjectType/*Target/Organism').attrib.get('species')",
-                            "bp_atts['organism_supergroup'] = sub_el.find('ProjectType/*Target/Organism/Supergroup').text[1:]",
-                            "bp_atts['method']              = sub_el.find('ProjectType/*/Method').attrib.get('method_type')[1:]",
-                            "bp_atts['data_type']           = sub_el.find('ProjectType/*/Objectives/Data').attrib.get('data_type')[1:]",]
-                        for c in catch_errors: # Should the "exec" be compiled? Is the exec even a good idea? 
-                            try: exec c
-                            except: pass
-
-                        p_type = sub_el.find('ProjectType/*') 
-                        if p_type is not None:
-                            if p_type.attrib.get('subtype') == 'eAuthorizedAccess':
-                                bp_atts['project_type'] = 'TopAdmin: Authorized Access'
-
-                    # Relation Set information (edges in the graph)
-                    elif sub_el.tag == "RelationSet":
-                        for RelationGroup in sub_el.findall('RelationGroup'):  # Only capture RelationGroup tags (summary tags can be present) 
-                            rg_level = RelationGroup.attrib.get('level')
-                            if rg_level == 'same': continue # Do not parse if the level is "same" 
-                            
-                            for RelationData in RelationGroup.findall('RelationData'):
-                                link_atts = dict.fromkeys(link_fields) # Initialize, adding each key (null values)
-                                bp_target = RelationData.get('id') # The other project involved; could be source or target
-                                
-                                try:    link_atts['link_genome_id'] = RelationData.find('GenomeID').text  
-                                except: pass 
-                                
-                                # Get the order right for relationships (the "from" --> "to" part) 
-                                if ( ( rg_level == 'Up' ) and ( capture_links_up ) ):
-                                    link_atts['id_from'] = bp_target
-                                    link_atts['id_to']   = bp_atts['bp_id']
-                                    links.append(link_atts)
-                                elif ( ( rg_level == 'Down' ) and ( capture_links_down ) ):  
-                                    link_atts['id_from'] = bp_atts['bp_id']
-                                    link_atts['id_to']   = bp_target
-                                    links.append(link_atts)
-
-                                # Add to the list of links
-
-                    # Aggregated Data Sets: Create dictionary and add to list 
-                    elif sub_el.tag == "AggregatedDataSet":
-                        for data_gp in sub_el:
-                            if data_gp.tag != 'AggregatedData': continue
-                            aggregated_data_atts = dict.fromkeys(aggregated_data_fields)
-                            aggregated_data_atts['bp_id']        = bp_atts['bp_id']
-                            aggregated_data_atts['label']        = data_gp.attrib.get('label') 
-                            aggregated_data_atts['int_count']    = data_gp.attrib.get('count')
-                            aggregated_data_atts['str_database'] = data_gp.find('DB').text
-                            aggregated_data_atts['str_url']      = data_gp.find('URL').text
-                            aggregated_data.append(aggregated_data_atts)
-                    # Submission / Submitter Information 
-                    elif sub_el.tag == "Submission":
-                        for sub_gp in sub_el.findall('Organization'):
-                            sub_atts = dict.fromkeys(sub_organization_fields)
-                            try: 
-                                sub_atts['bp_id']       = bp_atts['bp_id']
-                                sub_atts['org_name']    = sub_gp.attrib.get('role')
-                                sub_atts['org_type']    = sub_gp.attrib.get('type')
-                                sub_atts['org_role']    = sub_gp.find('Name').text
-                                submission_org.append(sub_atts)
-                            except Exception as e:
-                                logger.info("Failed to process submitter string. BioProject: %s; error report: \n%s", bp_atts['bp_id'], e)
-                    # Data Statistics
-                    elif sub_el.tag == 'DataStatistics': 
-                        for data_gp in sub_el.findall('Data'):
-                            if bp_atts['project_type'] == 'TopAdmin: Authorized Access': continue # If this is an Authorized Access project, do not capture statistics 
-                            data_stats_atts = dict.fromkeys(data_stats_fields)
-                            data_stats_atts['bp_id']     = bp_atts['bp_id']
-                            data_stats_atts['db']        = data_gp.attrib.get('db')
-                            data_stats_atts['unit']      = data_gp.attrib.get('unit')
-                            data_stats_atts['val']       = data_gp.text.replace(',','') # Remove commas
-
-                            # Standardize SRA units to Gigabases and Terabytes 
-                            if data_stats_atts['db'] == 'SRA':
-                                if data_stats_atts['unit'] == 'Mbases':
-                                    try:
-                                        data_stats_atts['val']       = ( float(data_stats_atts['val']) / 1000 )
-                                        data_stats_atts['unit']      = 'Gbases'
-                                    except: logger.info("Error in converting megabases to gigabases")
-                                elif data_stats_atts['unit'] == 'Mbytes':
-                                    try:
-                                        data_stats_atts['val']       = ( float(data_stats_atts['val']) / 1000000 )
-                                        data_stats_atts['unit']      = 'Tbytes'
-                                    except Exception as e: logger.info("Error in converting megabytes to Terabytes, %s", e)
-                                    
-
-                            data_stats.append(data_stats_atts)
-                    # Creation date, most common date in document 
-                    elif sub_el.tag == "CreateDate":
-                        try:    
-                            date = datetime.datetime.strptime(sub_el.text,'%d-%b-%Y')
-                            bp_atts['create_date'] = date.strftime("%Y-%m-%d") 
-                        except Exception as e:
-                            logger.info("Failed to get and parse the CreateDate. BioProject: %s; error report: \n%s", bp_atts['bp_id'], e)
-                    else: pass 
-                # Push most recent dictionary of values to list, adding one row of data 
-                bp_nodes.append(bp_atts)
-                i =+ 1
-            # If DocumentSummary fails 
-            except Exception as e: 
-                logger.warning('Failed to parse individual Document Summary')
-                logger.debug("DocSum error report: \n\t%s", e)
+            if self.parse_document_summary(DocSum_tag, rows, capture_links_down, capture_links_up): i += 1
         if i == 0:
             logger.warning('No DocSum parsed from current document.')
             logger.debug('XML from which no DocSum was parsed: \n%s', xml_string)
         
-        return {'bp_nodes':bp_nodes, 'links':links, 'data_stats':data_stats, 'submission_org':submission_org, 'aggregated_data':aggregated_data}
+        return rows
+
+    def parse_efetch_bioproject_stream(self, file_obj, capture_links_down=True, capture_links_up=True, on_record=None, **kwargs):
+        """Parse BioProject efetch XML from a file-like object (such as an HTTP response) as it is read. 
+        
+        Each DocumentSummary is turned into rows as soon as it closes and is then freed, so memory does not grow with the response. 
+        "on_record", if given, is called with the XML of each DocumentSummary that was parsed, before it is freed."""
+        logger.debug("Stream-parsing bioProject")
+        rows = new_bioproject_rows()
+        i = 0
+        try:
+            for event, elem in ET.iterparse(file_obj):
+                if elem.tag == 'DocumentSummary':
+                    if self.parse_document_summary(elem, rows, capture_links_down, capture_links_up): 
+                        i += 1
+                        if on_record is not None: on_record(ET.tostring(elem))
+                    elem.clear()    # Drop the finished DocumentSummary; only an empty shell stays under the root 
+        except Exception as e: 
+            logger.warning('Error parsing BioProject XML stream: %s', e)
+            return None 
+        if i == 0:
+            logger.warning('No DocSum parsed from current document.')
         
+        return rows
+
+    def parse_document_summary(self, DocSum_tag, rows, capture_links_down=True, capture_links_up=True):
+        """Add the rows for one DocumentSummary element to "rows". Return True if the project itself was parsed."""
+        bp_nodes        = rows['bp_nodes']
+        links           = rows['links']
+        aggregated_data = rows['aggregated_data']
+        data_stats      = rows['data_stats']
+        submission_org  = rows['submission_org']
+        bp_atts = dict.fromkeys(bp_nodes_fields) # Create a dictionary of attributes to be captured
+        row_counts = [len(rows[key]) for key in document_row_keys]     # Rows before this document, to find the rows it adds 
+
+        try: # Wrap the entire Document Summary extraction in a try statement to catch errors
+            # Iterate through top-level nodes under DocSum, almost stream-style 
+            bp_atts['bp_id'] = DocSum_tag.find('Project/ProjectID/ArchiveID').attrib["id"] # Get ProjectID 
+            for sub_el in DocSum_tag:
+                # Project Information 
+                if sub_el.tag == "Project":
+                    project_atts = self._project_fields.extract(sub_el)
+                    if project_atts.pop('project_subtype') == 'eAuthorizedAccess':
+                        project_atts['project_type'] = 'TopAdmin: Authorized Access'
+                    bp_atts.update(project_atts)
+
+                # Relation Set information (edges in the graph)
+                elif sub_el.tag == "RelationSet":
+                    for RelationGroup in sub_el.findall('RelationGroup'):  # Only capture RelationGroup tags (summary tags can be present) 
+                        rg_level = RelationGroup.attrib.get('level')
+                        if rg_level == 'same': continue # Do not parse if the level is "same" 
+                        
+                        for RelationData in RelationGroup.findall('RelationData'):
+                            link_atts = dict.fromkeys(link_fields) # Initialize, adding each key (null values)
+                            bp_target = RelationData.get('id') # The other project involved; could be source or target
+                            
+                            try:    link_atts['link_genome_id'] = RelationData.find('GenomeID').text  
+                            except: pass 
+                            
+                            # Get the order right for relationships (the "from" --> "to" part) 
+                            if ( ( rg_level == 'Up' ) and ( capture_links_up ) ):
+                                link_atts['id_from'] = bp_target
+                                link_atts['id_to']   = bp_atts['bp_id']
+                                link_atts['listed_up']   = 1     # Reported by the child's document 
+                                links.append(link_atts)
+                            elif ( ( rg_level == 'Down' ) and ( capture_links_down ) ):  
+                                link_atts['id_from'] = bp_atts['bp_id']
+                                link_atts['id_to']   = bp_target
+                                link_atts['listed_down'] = 1     # Reported by the parent's document 
+                                links.append(link_atts)
+
+                            # Add to the list of links
+
+                # Aggregated Data Sets: Create dictionary and add to list 
+                elif sub_el.tag == "AggregatedDataSet":
+                    for data_gp in sub_el:
+                        if data_gp.tag != 'AggregatedData': continue
+                        aggregated_data_atts = dict.fromkeys(aggregated_data_fields)
+                        aggregated_data_atts['bp_id']        = bp_atts['bp_id']
+                        aggregated_data_atts['label']        = data_gp.attrib.get('label') 
+                        aggregated_data_atts['int_count']    = data_gp.attrib.get('count')
+                        aggregated_data_atts['str_database'] = data_gp.find('DB').text
+                        aggregated_data_atts['str_url']      = data_gp.find('URL').text
+                        aggregated_data.append(aggregated_data_atts)
+                # Submission / Submitter Information 
+                elif sub_el.tag == "Submission":
+                    for sub_gp in sub_el.findall('Organization'):
+                        sub_atts = dict.fromkeys(sub_organization_fields)
+                        try: 
+                            sub_atts['bp_id']       = bp_atts['bp_id']
+                            sub_atts['org_name']    = sub_gp.attrib.get('role')
+                            sub_atts['org_type']    = sub_gp.attrib.get('type')
+                            sub_atts['org_role']    = sub_gp.find('Name').text
+                            submission_org.append(sub_atts)
+                        except Exception as e:
+                            logger.info("Failed to process submitter string. BioProject: %s; error report: \n%s", bp_atts['bp_id'], e)
+                # Data Statistics
+                elif sub_el.tag == 'DataStatistics': 
+                    for data_gp in sub_el.findall('Data'):
+                        if bp_atts['project_type'] == 'TopAdmin: Authorized Access': continue # If this is an Authorized Access project, do not capture statistics 
+                        data_stats_atts = dict.fromkeys(data_stats_fields)
+                        data_stats_atts['bp_id']     = bp_atts['bp_id']
+                        data_stats_atts['db']        = data_gp.attrib.get('db')
+                        data_stats_atts['unit']      = data_gp.attrib.get('unit')
+                        data_stats_atts['val']       = data_gp.text.replace(',','') # Remove commas
+
+                        # Standardize SRA units to Gigabases and Terabytes 
+                        if data_stats_atts['db'] == 'SRA':
+                            if data_stats_atts['unit'] == 'Mbases':
+                                try:
+                                    data_stats_atts['val']       = ( float(data_stats_atts['val']) / 1000 )
+                                    data_stats_atts['unit']      = 'Gbases'
+                                except: logger.info("Error in converting megabases to gigabases")
+                            elif data_stats_atts['unit'] == 'Mbytes':
+                                try:
+                                    data_stats_atts['val']       = ( float(data_stats_atts['val']) / 1000000 )
+                                    data_stats_atts['unit']      = 'Tbytes'
+                                except Exception as e: logger.info("Error in converting megabytes to Terabytes, %s", e)
+                                
+
+                        data_stats.append(data_stats_atts)
+                # Creation date, most common date in document 
+                elif sub_el.tag == "CreateDate":
+                    try:    
+                        date = datetime.datetime.strptime(sub_el.text,'%d-%b-%Y')
+                        bp_atts['create_date'] = date.strftime("%Y-%m-%d") 
+                    except Exception as e:
+                        logger.info("Failed to get and parse the CreateDate. BioProject: %s; error report: \n%s", bp_atts['bp_id'], e)
+                else: pass 
+            # Fingerprint everything the document produced, then push most recent dictionary of values to list, adding one row of data 
+            content = [sorted(bp_atts.items())] + [sorted(row.items()) for key, n in zip(document_row_keys, row_counts) for row in rows[key][n:]]
+            bp_atts['doc_hash'] = hashlib.sha1(repr(content)).hexdigest()
+            bp_nodes.append(bp_atts)
+            return True 
+        # If DocumentSummary fails 
+        except Exception as e: 
+            logger.warning('Failed to parse individual Document Summary')
+            logger.debug("DocSum error report: \n\t%s", e)
+            return False 
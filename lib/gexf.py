@@ -3,21 +3,147 @@
 # For GEXF, this creates meta-nodes for each organism.
 # Chris Wellington, Dec 12, 2012 
 
+import os 
 import xml.etree.cElementTree as ET     # Write out XML
+from xml.sax.saxutils import quoteattr  # Escape attribute values for the streaming writer 
+import gzip                             # Optional compressed output 
+import multiprocessing                  # Write several files at once 
 from collections import defaultdict     # Quick way to get a dictionary of lists
+import bp_database                      # The streaming writer reads the database directly 
+import graph_model                      # The graph given to gexf_create 
+import graph_json                       # Compact JSON copies for the browser viewer 
+
+VIZ_NAMESPACE = 'http://www.gexf.net/1.2draft/viz'     # Positions, sizes and colours read by Gephi and sigma.js 
+ET.register_namespace('viz', VIZ_NAMESPACE)
+
+# Node attributes declared in every GEXF file: (id, title, type). Field names match those in the database for simplicity. 
+gexf_atts = [
+        ('genome_id',           'Genome_id',        'string'),
+        ('create_date',         'create_date',      'string'),
+        ('accno',               'Accno',            'string'),
+        ('title',               'Title',            'string'),
+        ('project_type',        'Project_type',     'string'),
+        ('target_capture',      'Target_capture',   'string'),
+        ('target_material',     'Target_material',  'string'),
+        ('target_sample_scope', 'Target_scope',     'string'),
+        ('organism_name',       'Organism_name',    'string'),
+        ('organism_supergroup', 'Kingdom',          'string'),
+        ('method',              'Method',           'string'),
+        ('data_type',           'Data_type',        'string')]
+
+# Write one GEXF file from a graph_model.graph with gexf_create. With layout_options (keyword arguments of layout.layout_viz), 
+# the nodes are laid out first; the layout is kept next to the file to seed the next export of the same file. With write_json, 
+# the graph is also written in the compact JSON format of lib/graph_json.py (".json", plus a gzip copy) for the browser viewer. 
+def write_gexf(filename, graph, layout_options=None, write_json=False):
+    viz = None
+    if layout_options is not None:
+        import layout       # Needs numpy, which is only required for layouts 
+        viz = layout.layout_viz(graph, layout_file=os.path.splitext(filename)[0] + '.layout.json', **layout_options)
+    gexf_output = gexf_create(filename, graph, viz)
+    gexf_output.prepare_gexf()
+    gexf_output.add_hierarchy()
+    gexf_output.add_edges()
+    gexf_output.write_out()
+    if write_json: graph_json.write_json(os.path.splitext(filename)[0] + '.json', graph_json.graph_data(graph, viz))
+
+# Writing parts of one graph to separate files in a pool of processes. The graph reaches each worker once, through the initializer. 
+_pool_graph = None
+_pool_layout_options = None
+_pool_write_json = False
+
+def init_part_worker(graph, layout_options=None, write_json=False):
+    global _pool_graph, _pool_layout_options, _pool_write_json
+    _pool_graph, _pool_layout_options, _pool_write_json = graph, layout_options, write_json
+
+def write_part(job):
+    filename, nodes = job
+    part = _pool_graph.subgraph(nodes)
+    write_gexf(filename, part, _pool_layout_options, _pool_write_json)
+    return filename, len(part), len(part.out_idx)
+
+def write_parts(graph, jobs, processes=4, layout_options=None, write_json=False):
+    """Write one GEXF file for each (filename, node indices) job. Return (filename, nodes, edges) for each file."""
+    jobs = sorted(jobs, key=lambda job: len(job[1]), reverse=True)     # Largest first, so one big part does not finish last 
+    if processes <= 1:
+        init_part_worker(graph, layout_options, write_json)
+        return [write_part(job) for job in jobs]
+    pool = multiprocessing.Pool(processes, initializer=init_part_worker, initargs=(graph, layout_options, write_json))
+    try:
+        return pool.map(write_part, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# Level-of-detail tiles for the browser viewer. The top file holds one meta-node per organism group (with the totals of its 
+# projects' statistics), the projects that are in no group, and edges between them weighted by the number of links they stand 
+# for. Each group's own nodes and edges go to a detail file named in the meta-node's "tile" attribute, which the viewer loads 
+# when the group is clicked or zoomed into. Edges leaving a group are kept in its detail file with the meta-node ("group") 
+# of their other end, so the viewer can attach them to whichever of the two is shown. 
+TILE_ATTS = [('tile', 'Tile', 'string'), ('projects', 'Projects', 'integer')]
+
+def write_tiles(tiles_dir, graph, layout_options=None, top_file='index.gexf'):
+    """Write the top file and one detail file per organism group to tiles_dir. Return (nodes in the top file, detail files)."""
+    if not os.path.exists(tiles_dir): os.makedirs(tiles_dir)
+    viz = None
+    if layout_options is not None:
+        import layout       # Positions come from a layout of the whole graph, so detail nodes land around their meta-node 
+        viz = layout.layout_viz(graph, layout_file=os.path.join(tiles_dir, 'tiles.layout.json'), **layout_options)
+
+    # Node shown in the top file for every node: its group's meta-node, itself for projects in no group, None if not exported 
+    bp_ids  = graph.bp_ids
+    shown   = [None] * len(graph)
+    groups  = graph.groups()
+    for i in groups: shown[i] = 'group_' + str(bp_ids[i])
+    for i in range(len(graph)):
+        if not graph.is_project(i): continue 
+        g = graph.group_of[i]
+        shown[i] = str(bp_ids[i]) if g == graph_model.MISSING_CODE else 'group_' + str(bp_ids[g])
+
+    # Top file 
+    top = gexf_create(os.path.join(tiles_dir, top_file), graph, viz)
+    top.prepare_gexf()
+    top.add_tile_atts()
+    for i in groups:
+        node = top.create_genome_node(i, True)
+        top.add_attvalues(node, {'tile':str(bp_ids[i]) + '.gexf', 'projects':str(len(graph.members(i)))})
+        top._nodes.append(node)
+    for i in range(len(graph)):
+        if graph.is_project(i) and ( graph.group_of[i] == graph_model.MISSING_CODE ):
+            top._nodes.append(top.create_bp_node(i))
+    weights = defaultdict(int)          # (source, target) in the top file -> number of links 
+    for i, j in graph.edges():
+        if ( shown[i] is not None ) and ( shown[j] is not None ) and ( shown[i] != shown[j] ): weights[(shown[i], shown[j])] += 1
+    for (source, target), weight in sorted(weights.items()):
+        ET.SubElement(top._edges, 'edge', {'source':source, 'target':target, 'weight':str(weight)})
+    top.write_out()
+
+    # One detail file per group: the organism, its projects, the links among them and the links leaving the group 
+    for i in groups:
+        detail = gexf_create(os.path.join(tiles_dir, str(bp_ids[i]) + '.gexf'), graph, viz)
+        detail.prepare_gexf()
+        detail.add_tile_atts()
+        detail._nodes.append(detail.create_genome_node(i, False))
+        inside = set([i])
+        for j in graph.members(i):
+            detail._nodes.append(detail.create_bp_node(j))
+            inside.add(j)
+        for j in sorted(inside):
+            for k in graph.out_neighbors(j): detail.add_tile_edge(j, k, inside, shown)
+            for k in graph.in_neighbors(j):
+                if k not in inside: detail.add_tile_edge(k, j, inside, shown)
+        detail.write_out()
+    return len(groups) + sum(1 for i in range(len(graph)) if graph.is_project(i) and graph.group_of[i] == graph_model.MISSING_CODE), len(groups)
 
 # Primary class for assembling XML files
 class gexf_create:
     "Create a GEXF graph file to import to Gephi"
 
     ###############################################
-    def __init__(self, filename, atts_genome, atts_bp, h_genome, edges, data_stats_cols):
-        self._atts_genome       = atts_genome
-        self._atts_bp           = atts_bp
-        self._hierarchy_genome  = h_genome
-        self._edge_data         = edges
+    def __init__(self, filename, graph, viz=None):
+        self._graph             = graph             # graph_model.graph, from db_export.get_graph() 
+        self._viz               = viz               # Optional layout.layout_viz() arrays: position, size and color by node index 
         self._filename          = filename
-        self._data_stats_cols   = data_stats_cols
+        self._data_stats_cols   = graph.stats_order
 
 
     # Create the framework for the XML (root node), and add the metadata node, nodes node, and edges node 
@@ -29,21 +155,8 @@ class gexf_create:
         # Start of the actual graph section. Currently dynamic.
         graph_info = ET.SubElement(root, 'graph', {'defaultedgetype':'directed','mode':'static','timeformat':'date'})
 
-        # Set the fields avaialble to the nodes. Each field goes into a separate subelement. Field names match those in the database for simplicity.
+        # Set the fields avaialble to the nodes. Each field goes into a separate subelement. 
         node_atts = ET.SubElement(graph_info, 'attributes', {'class':'node', 'type':'static'})
-        gexf_atts = [
-                ('genome_id',           'Genome_id',        'string'),
-                ('create_date',         'create_date',      'string'),
-                ('accno',               'Accno',            'string'),
-                ('title',               'Title',            'string'),
-                ('project_type',        'Project_type',     'string'),
-                ('target_capture',      'Target_capture',   'string'),
-                ('target_material',     'Target_material',  'string'),
-                ('target_sample_scope', 'Target_scope',     'string'),
-                ('organism_name',       'Organism_name',    'string'),
-                ('organism_supergroup', 'Kingdom',          'string'),
-                ('method',              'Method',           'string'),
-                ('data_type',           'Data_type',        'string')]
         # Add standard fields 
         for field in gexf_atts:
             ET.SubElement(node_atts, 'attribute', {'id':field[0], 'title':field[1], 'type':field[2]})
@@ -66,31 +179,31 @@ class gexf_create:
     ##  Begin creating XML nodes  ############################################################
     ##########################################################################################
     def add_hierarchy(self):
-
-        for genome_id, bp_list in self._hierarchy_genome.items():
+        graph = self._graph
+        for i in graph.groups():
             # Create the group container node. Parent node is just the top level node container in this case. 
-            genome_group_node = self.create_genome_node(genome_id, True)
+            genome_group_node = self.create_genome_node(i, True)
 
             # Create the sub-nodes for that group, add the genome node, then add all related bioproject nodes.  
             nested_nodes_container = ET.SubElement(genome_group_node, 'nodes')
-            genome_node = self.create_genome_node(genome_id, False) 
+            genome_node = self.create_genome_node(i, False) 
             nested_nodes_container.append(genome_node) 
 
-            for bp_id in bp_list:
-                try:  nested_nodes_container.append(self.create_bp_node(bp_id))
-                except Exception as e:  print "Error adding BioProject data node under the organism. Moving on. ", str(e)
-                del self._atts_bp[bp_id]     # This prevents duplicate BioProject nodes 
+            for j in graph.members(i):
+                nested_nodes_container.append(self.create_bp_node(j))
 
             # Add to the parent "_nodes" 
             self._nodes.append(genome_group_node) 
 
-        # Add the remaining flat BioProjects
-        for bp_id in self._atts_bp:
-            self._nodes.append(self.create_bp_node(bp_id))
+        # Add the remaining flat BioProjects (each project is placed in at most one group) 
+        for i in range(len(graph)):
+            if graph.is_project(i) and ( graph.group_of[i] == graph_model.MISSING_CODE ):
+                self._nodes.append(self.create_bp_node(i))
 
     def add_edges(self):
-        for edge in self._edge_data:
-            ET.SubElement(self._edges, 'edge', {'source':edge[0],'target':edge[1]})
+        bp_ids = self._graph.bp_ids
+        for i, j in self._graph.edges():
+            ET.SubElement(self._edges, 'edge', {'source':str(bp_ids[i]),'target':str(bp_ids[j])})
 
     def write_out(self):
         xml_file = open(self._filename,"w")
@@ -100,35 +213,213 @@ class gexf_create:
     ##########################################################################################
     ##  Functions used internally only  ######################################################
     ##########################################################################################
-    def create_genome_node(self, bp_id, group): 
-        if group: node_atts = { 'label':self._atts_genome[bp_id]['name'], 'id':'group_'+str(bp_id) }
-        else:     node_atts = { 'label':self._atts_genome[bp_id]['name'], 'id':str(bp_id) }
+    def create_genome_node(self, i, group): 
+        atts = self._graph.genome_attributes(i)
+        bp_id = str(self._graph.bp_ids[i])
+        if group: node_atts = { 'label':atts['name'], 'id':'group_'+bp_id }
+        else:     node_atts = { 'label':atts['name'], 'id':bp_id }
     
         genome_node     = ET.Element('node', node_atts)
         attvalues_node  = ET.SubElement(genome_node, 'attvalues') 
 
         # For every attribute, add an attvalue node 
-        for key, value in self._atts_genome[bp_id].items():
-            ET.SubElement(attvalues_node, 'attvalue', {'for':key,'value':str(value)})
+        for key, value in atts.items():
+            ET.SubElement(attvalues_node, 'attvalue', {'for':key,'value':unicode(value)})
 
         # For the other attributes, fill in with "Organism Overview" 
         for att_set in self._gexf_atts:
-            if ( ( att_set[0] not in self._atts_genome[bp_id] ) and ( att_set[2] == 'string' ) ):
+            if ( ( att_set[0] not in atts ) and ( att_set[2] == 'string' ) ):
                 ET.SubElement(attvalues_node, 'attvalue', {'for':att_set[0],'value':'Organism Overview'})
         
+        self.add_viz(genome_node, i)    # The group node sits where its organism is 
         return genome_node 
 
     # Create a BioProject node (these are not currently used as containers) 
-    def create_bp_node(self, bp_id):
-        try:    bp_name = self._atts_bp[bp_id]['name']
-        except: bp_name = "none"
+    def create_bp_node(self, i):
+        atts = self._graph.bp_attributes(i)
+        bp_name = atts.get('name', "none")
         
-        node_atts       =  {'label':bp_name, 'id':bp_id}
+        node_atts       =  {'label':bp_name, 'id':str(self._graph.bp_ids[i])}
         bp_node         = ET.Element('node', node_atts)
         attvalues_node  = ET.SubElement(bp_node, 'attvalues') 
 
         # For every attribute, add an attvalue node 
-        for key, value in self._atts_bp[bp_id].items():
+        for key, value in atts.items():
+            if isinstance(value, float): value = unicode(value)     # Data statistics are numeric 
             ET.SubElement(attvalues_node, 'attvalue', {'for':key,'value':value})
         
-        return bp_node 
+        self.add_viz(bp_node, i)
+        return bp_node
+
+    # Used by write_tiles 
+    def add_tile_atts(self):
+        node_atts = self._root.find('graph/attributes')
+        for att_id, title, att_type in TILE_ATTS:
+            ET.SubElement(node_atts, 'attribute', {'id':att_id, 'title':title, 'type':att_type})
+        edge_atts = ET.Element('attributes', {'class':'edge', 'type':'static'})
+        ET.SubElement(edge_atts, 'attribute', {'id':'group', 'title':'Group', 'type':'string'})
+        self._root.find('graph').insert(1, edge_atts)
+
+    def add_attvalues(self, node, atts):
+        attvalues_node = node.find('attvalues')
+        for key, value in sorted(atts.items()):
+            ET.SubElement(attvalues_node, 'attvalue', {'for':key,'value':value})
+
+    def add_tile_edge(self, i, j, inside, shown):
+        # A link from a detail file. For a link leaving the group, "group" is the top-file node of the end outside it. 
+        outside = j if i in inside else i
+        if ( outside not in inside ) and ( shown[outside] is None ): return     # The other end is not exported 
+        bp_ids = self._graph.bp_ids
+        edge = ET.SubElement(self._edges, 'edge', {'source':str(bp_ids[i]),'target':str(bp_ids[j])})
+        if outside not in inside:
+            attvalues_node = ET.SubElement(edge, 'attvalues')
+            ET.SubElement(attvalues_node, 'attvalue', {'for':'group','value':shown[outside]})
+
+    def add_viz(self, node, i):
+        if self._viz is None: return 
+        x, y = self._viz['position'][i]
+        r, g, b = self._viz['color'][i]
+        ET.SubElement(node, '{%s}size' % VIZ_NAMESPACE, {'value':'%.3f' % self._viz['size'][i]})
+        ET.SubElement(node, '{%s}position' % VIZ_NAMESPACE, {'x':'%.3f' % x, 'y':'%.3f' % y, 'z':'0.0'})
+        ET.SubElement(node, '{%s}color' % VIZ_NAMESPACE, {'r':str(r), 'g':str(g), 'b':str(b)})
+
+
+# Write a GEXF file straight from the database, without building the document in memory 
+class gexf_stream:
+    """Stream the same graph as gexf_create to a file: the header and attribute declarations, one group per organism with its 
+    projects, the remaining projects, then the edges. Rows are written as the database cursors return them, so memory use does 
+    not grow with the graph. With compress=True the file is written with gzip."""
+
+    ###############################################
+    def __init__(self, filename, db_file, compress=False):
+        self._filename          = filename
+        self._db_file           = db_file
+        self._compress          = compress
+        self._count_nodes       = 0
+        self._count_edges       = 0
+
+    def write_out(self):
+        engine = bp_database.make_engine(self._db_file)
+        metadata = bp_database.make_metadata()
+        bp_database.migrate_schema(engine, metadata)
+        conn = engine.connect()     # One connection: the temporary table below is only visible to it 
+
+        self._node_cols     = [col.name for col in metadata.tables['tbl_node'].c if col.name not in bp_database.bookkeeping_columns]
+        self._stats_cols    = conn.execute('SELECT col_name, label FROM tbl_stats_columns ORDER BY rowid').fetchall()
+        self._stats_labels  = [label for col_name, label in self._stats_cols]
+
+        # Each project linked from an organism goes under one organism (the lowest ID if there are several), as in gexf_create 
+        conn.execute('DROP TABLE IF EXISTS temp.gexf_member')
+        conn.execute("""CREATE TEMP TABLE gexf_member AS 
+                        SELECT l.id_to AS bp_id, MIN(l.id_from) AS group_id FROM tbl_link l 
+                        JOIN tbl_node g ON g.bp_id = l.id_from AND g.project_type = 'Organism Overview' 
+                        JOIN tbl_node c ON c.bp_id = l.id_to AND c.project_type != 'Organism Overview' 
+                        GROUP BY l.id_to""")
+        conn.execute('CREATE INDEX temp.idx_gexf_member_group ON gexf_member (group_id, bp_id)')
+
+        if self._compress:  f = gzip.open(self._filename, 'wb')
+        else:               f = open(self._filename, 'wb')
+        try:
+            self.write_header(f)
+            f.write('<nodes>')
+            self.write_groups(f, conn)
+            self.write_flat(f, conn)
+            f.write('</nodes><edges>')
+            self.write_edges(f, conn)
+            f.write('</edges></graph></gexf>\n')
+        finally:
+            f.close()
+            conn.close()
+        return self._count_nodes, self._count_edges
+
+    ##########################################################################################
+    ##  Sections of the file  ################################################################
+    ##########################################################################################
+    def write_header(self, f):
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gexf><graph defaultedgetype="directed" mode="static" timeformat="date">')
+        f.write('<attributes class="node" type="static">')
+        for att_id, title, att_type in gexf_atts:
+            f.write(self.element('attribute', {'id':att_id, 'title':title, 'type':att_type}))
+        for col in self._stats_labels:     # Data statistics columns, known only once the database is read 
+            f.write(self.element('attribute', {'id':col, 'title':col, 'type':'float'}))
+        f.write('</attributes>')
+
+    def write_groups(self, f, conn):
+        # Organisms and their projects come from two cursors in the same (organism ID) order and are merged as they are read 
+        bp_cols     = self.select_columns('n')
+        s_children  = ('SELECT m.group_id, {0} FROM gexf_member m JOIN tbl_node n ON n.bp_id = m.bp_id '
+                       'LEFT JOIN tbl_stats_wide w ON w.bp_id = n.bp_id ORDER BY m.group_id, m.bp_id').format(bp_cols)
+        # Organism totals: statistics summed over every project linked from the organism (see db_export.parse_genome_hierarchy) 
+        totals      = ''.join(', SUM(w.{0})'.format(col_name) for col_name, label in self._stats_cols)
+        s_genomes   = ('SELECT {0}{1} FROM tbl_node g JOIN tbl_link l ON l.id_from = g.bp_id LEFT JOIN tbl_stats_wide w ON w.bp_id = l.id_to '
+                       'WHERE g.bp_id IN (SELECT group_id FROM gexf_member) GROUP BY g.bp_id ORDER BY g.bp_id').format(
+                       ', '.join('g.' + col for col in self._node_cols), totals)
+
+        children = conn.execute(s_children)
+        child = children.fetchone()
+        for genome in conn.execute(s_genomes):
+            bp_id, label, atts = self.genome_atts(genome)
+            f.write(self.node_xml('group_' + bp_id, label, atts, close=False) + '<nodes>')
+            f.write(self.node_xml(bp_id, label, atts))
+            self._count_nodes += 2
+            while ( child is not None ) and ( child[0] == genome[0] ):
+                f.write(self.node_xml(*self.bp_atts(child[1:])))
+                self._count_nodes += 1
+                child = children.fetchone()
+            f.write('</nodes></node>')
+        children.close()
+
+    def write_flat(self, f, conn):
+        s = ('SELECT {0} FROM tbl_node n LEFT JOIN tbl_stats_wide w ON w.bp_id = n.bp_id '
+             'WHERE n.project_type != \'Organism Overview\' AND n.bp_id NOT IN (SELECT bp_id FROM gexf_member)').format(self.select_columns('n'))
+        for row in conn.execute(s):
+            f.write(self.node_xml(*self.bp_atts(row)))
+            self._count_nodes += 1
+
+    def write_edges(self, f, conn):
+        for id_from, id_to in conn.execute('SELECT id_from, id_to FROM tbl_link'):
+            f.write(self.element('edge', {'source':str(id_from), 'target':str(id_to)}))
+            self._count_edges += 1
+
+    ##########################################################################################
+    ##  Functions used internally only  ######################################################
+    ##########################################################################################
+    def select_columns(self, alias):
+        return ', '.join(['{0}.{1}'.format(alias, col) for col in self._node_cols] + ['w.' + col_name for col_name, label in self._stats_cols])
+
+    def genome_atts(self, row):
+        # Organism attributes: the node's own values, the totals of its projects (0 where none has a value), and 
+        # "Organism Overview" in the string fields it has no value for 
+        atts = {}
+        for col, value in zip(self._node_cols, row):
+            if col == 'bp_id':          bp_id = str(value)
+            elif value is not None:     atts[col] = unicode(value)
+        for col, value in zip(self._stats_labels, row[len(self._node_cols):]):
+            atts[col] = unicode(0 if value is None else value)
+        for att_id, title, att_type in gexf_atts:
+            if ( att_id not in atts ) and ( att_type == 'string' ): atts[att_id] = u'Organism Overview'
+        return bp_id, atts.get('name', u'none'), atts
+
+    def bp_atts(self, row):
+        # Project attributes as in db_export.get_db_rows: empty fields take the project type 
+        values = dict(zip(self._node_cols, row))
+        atts = {}
+        for col in self._node_cols:
+            if col == 'bp_id': continue 
+            value = values[col] if values[col] is not None else values['project_type']
+            if value is not None: atts[col] = unicode(value)
+        for col, value in zip(self._stats_labels, row[len(self._node_cols):]):
+            if value is not None: atts[col] = unicode(value)
+        return str(values['bp_id']), atts.get('name', u'none'), atts
+
+    def node_xml(self, node_id, label, atts, close=True):
+        # A node with its attribute values. Group nodes are left open (close=False) so their nested nodes can follow. 
+        attvalues = ''.join(self.element('attvalue', {'for':key, 'value':value}) for key, value in atts.items())
+        return '<node id={0} label={1}><attvalues>{2}</attvalues>{3}'.format(self.quote(node_id), self.quote(label), attvalues, '</node>' if close else '')
+
+    def element(self, tag, atts):
+        return '<{0} {1} />'.format(tag, ' '.join('{0}={1}'.format(key, self.quote(value)) for key, value in atts.items()))
+
+    def quote(self, value):
+        value = quoteattr(value, {'\n':'&#10;', '\r':'&#13;', '\t':'&#9;'})
+        return value.encode('utf-8') if isinstance(value, unicode) else value 
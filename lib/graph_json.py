@@ -0,0 +1,150 @@
+# Compact JSON form of a graph for the browser viewer (browser_vis_demo), read by graph_settings.js without any XML parsing.
+# GEXF repeats every attribute name in an attvalue element for every node. Here each attribute is one column (a list with
+# one value per node), and strings that repeat, such as project types, are dictionary-encoded as a list of categories plus
+# integer codes. Filler values (empty fields given the project type, which the viewer hides anyway) are left out. Next to
+# each file, a gzip copy (".json.gz") is written for web servers that serve precompressed files (nginx "gzip_static on").
+#
+# Layout of a file:
+#   {"version": 1,
+#    "nodes":      [column, ...]     id, label, and if the graph is laid out x, y, size and color ("#RRGGBB")
+#    "attributes": [column, ...]     one per node attribute, with null where a node has no value
+#    "edges":      {"source": [...], "target": [...]}        node positions in the columns, plus "weight" if edges have weights
+#   }
+# A column is {"id": name, "values": [...]} or {"id": name, "categories": [...], "codes": [...]} (code -1 is null).
+
+import os
+import sys
+import json
+import gzip                                 # Precompressed copy
+import logging
+import xml.etree.cElementTree as ET         # Read GEXF files to convert
+import graph_model
+
+logger = logging.getLogger(__name__)
+
+JSON_VERSION    = 1
+VIZ_NAMESPACE   = 'http://www.gexf.net/1.2draft/viz'
+numeric_types   = ['float', 'double', 'integer', 'long']     # GEXF attribute types written as JSON numbers
+shown_fillers   = ['title', 'project_type']                  # The viewer shows these even when they equal the project type
+
+##################################################
+### Encoding #####################################
+##################################################
+def encode_column(col_id, values):
+    """Return a column; strings are dictionary-encoded when that saves space (each distinct value used at least twice on average)."""
+    strings = [v for v in values if isinstance(v, basestring)]
+    if strings and ( len(strings) == len([v for v in values if v is not None]) ) and ( 2 * len(set(strings)) <= len(strings) ):
+        categories  = sorted(set(strings))
+        index       = dict((c, k) for k, c in enumerate(categories))
+        return {'id':col_id, 'categories':categories, 'codes':[graph_model.MISSING_CODE if v is None else index[v] for v in values]}
+    return {'id':col_id, 'values':list(values)}
+
+def compact_number(value, digits=None):
+    # None for NaN (no value), whole numbers without ".0"
+    if ( value is None ) or ( value != value ): return None
+    if digits is not None: value = round(value, digits)
+    return int(value) if value == int(value) else value
+
+def hex_color(r, g, b):
+    return '#%02X%02X%02X' % (int(r), int(g), int(b))     # As sigma.tools.rgbToHex
+
+def write_json(filename, data, compress=True):
+    """Write a graph built by graph_data or gexf_data to filename, and a gzip copy to filename + '.gz' if compress is set."""
+    text = json.dumps(data, separators=(',', ':'))
+    with open(filename, 'wb') as f: f.write(text)
+    if compress:
+        f = gzip.GzipFile(filename + '.gz', 'wb', 9, mtime=0)     # No time stamp: the same graph gives the same file
+        try:        f.write(text)
+        finally:    f.close()
+    logger.info('Wrote {0} nodes to {1} ({2} bytes)'.format(len(data['nodes'][0]['values']), filename, len(text)))
+
+##################################################
+### From the graph model #########################
+##################################################
+def graph_data(graph, viz=None):
+    """Return the JSON data of a graph_model.graph: the nodes of gexf_create (organisms with projects, and projects), once each.
+
+    viz holds layout.layout_viz() arrays by node index."""
+    nodes       = [i for i in range(len(graph)) if graph.is_project(i) or ( graph.group_ptr[i + 1] > graph.group_ptr[i] )]
+    position    = dict((i, k) for k, i in enumerate(nodes))
+    node_cols   = [encode_column('id', [graph.bp_ids[i] for i in nodes]),
+                   encode_column('label', [graph.value('name', i) or u'none' for i in nodes])]
+    if viz is not None:
+        node_cols.append(encode_column('x', [compact_number(float(viz['position'][i][0]), 3) for i in nodes]))
+        node_cols.append(encode_column('y', [compact_number(float(viz['position'][i][1]), 3) for i in nodes]))
+        node_cols.append(encode_column('size', [compact_number(float(viz['size'][i]), 3) for i in nodes]))
+        node_cols.append(encode_column('color', [hex_color(*viz['color'][i]) for i in nodes]))
+
+    # The raw columns: the filler GEXF puts in empty fields is not written. "name" is the label.
+    attributes = [encode_column(col, [graph.value(col, i) for i in nodes]) for col in graph.column_order[1:] if col != 'name']
+    attributes += [encode_column(col, [compact_number(graph.stats[col][i]) for i in nodes]) for col in graph.stats_order]
+    edges = [(position[i], position[j]) for i, j in graph.edges() if ( i in position ) and ( j in position )]
+    return {'version':JSON_VERSION, 'nodes':node_cols, 'attributes':attributes,
+            'edges':{'source':[i for i, j in edges], 'target':[j for i, j in edges]}}
+
+##################################################
+### From a GEXF file #############################
+##################################################
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]       # Tag without its namespace
+
+def gexf_data(gexf_file):
+    """Return the JSON data of a GEXF file, such as one laid out in Gephi: every node (nested ones included, as sigma.parseGexf
+    reads them), its viz size, position and colour, its attribute values, and the edges between nodes of the file."""
+    root = ET.parse(gexf_file).getroot()
+
+    # Declared node attributes, in order. Undeclared ones found on nodes are added after them.
+    att_order, att_types = [], {}
+    for element in root.iter():
+        if ( local_name(element.tag) == 'attributes' ) and ( element.get('class') == 'node' ):
+            for att in element:
+                att_order.append(att.get('id'))
+                att_types[att.get('id')] = att.get('type')
+
+    ids, labels, viz, values = [], [], {'x':[], 'y':[], 'size':[], 'color':[]}, []
+    for node in root.iter():
+        if local_name(node.tag) != 'node': continue
+        ids.append(node.get('id'))
+        labels.append(node.get('label') or node.get('id'))
+        atts, node_viz = {}, {}
+        for child in node:              # The node's own elements only; nested nodes come separately 
+            if local_name(child.tag) == 'attvalues':
+                for attvalue in child: atts.setdefault(attvalue.get('for'), attvalue.get('value'))
+            elif child.tag == '{%s}size' % VIZ_NAMESPACE:
+                node_viz['size'] = compact_number(float(child.get('value')), 3)
+            elif child.tag == '{%s}position' % VIZ_NAMESPACE:
+                node_viz['x'], node_viz['y'] = compact_number(float(child.get('x')), 3), compact_number(float(child.get('y')), 3)
+            elif child.tag == '{%s}color' % VIZ_NAMESPACE:
+                node_viz['color'] = hex_color(child.get('r'), child.get('g'), child.get('b'))
+        for key in viz: viz[key].append(node_viz.get(key))
+        for key in sorted(atts):
+            if key not in att_types: att_order.append(key); att_types[key] = 'string'
+        values.append(atts)
+
+    attributes = []
+    for att_id in att_order:
+        column = []
+        for atts in values:
+            value = atts.get(att_id)
+            if ( value is not None ) and ( att_types[att_id] in numeric_types ):
+                value = compact_number(float(value))
+            elif ( value is not None ) and ( att_id not in shown_fillers ) and ( value == atts.get('project_type') ):
+                value = None                # Filler
+            column.append(value)
+        attributes.append(encode_column(att_id, column))
+
+    node_cols   = [encode_column('id', [int(v) if v.isdigit() and str(int(v)) == v else v for v in ids]), encode_column('label', labels)]
+    node_cols  += [encode_column(key, viz[key]) for key in ('x', 'y', 'size', 'color') if any(v is not None for v in viz[key])]
+    position    = dict((node_id, k) for k, node_id in enumerate(ids))
+    edges       = [edge for edge in root.iter() if local_name(edge.tag) == 'edge' and edge.get('source') in position and edge.get('target') in position]
+    edge_data   = {'source':[position[edge.get('source')] for edge in edges], 'target':[position[edge.get('target')] for edge in edges]}
+    if any(edge.get('weight') is not None for edge in edges):
+        edge_data['weight'] = [compact_number(float(edge.get('weight', 1))) for edge in edges]
+    return {'version':JSON_VERSION, 'nodes':node_cols, 'attributes':attributes, 'edges':edge_data}
+
+
+if __name__ == '__main__':
+    # Convert GEXF files, e.g. the demo graphs laid out in Gephi: python lib/graph_json.py browser_vis_demo/gexf/*.gexf
+    logging.basicConfig(level=logging.INFO)
+    for gexf_file in sys.argv[1:]:
+        write_json(os.path.splitext(gexf_file)[0] + '.json', gexf_data(gexf_file))
@@ -0,0 +1,208 @@
+# Compact model of the BioProject graph, shared by the exporters.
+# Nodes are numbered 0..n-1 in bp_id order. Attributes are columns: repeated strings are dictionary-encoded, data statistics are
+# float arrays, and the edges are stored as CSR adjacency (an offsets array plus a neighbour array for each direction), so
+# neighbour and organism group lookups are array slices. Only the standard library "array" module is used.
+
+import array                # Typed, compact columns
+import bisect               # Node index of a bp_id (the bp_id column is sorted)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Node columns with few distinct values, stored as codes into a list of categories. Other text columns are plain lists.
+categorical_columns = ['project_type', 'data_type', 'organism_supergroup', 'organism_name', 'target_capture', 'target_material',
+                       'target_sample_scope', 'method']
+MISSING_CODE        = -1                    # Code for NULL in categorical columns, and "no group" in group_of
+GENOME_TYPE         = 'Organism Overview'   # Project type of organism (genome) nodes
+
+class category_column:
+    """Dictionary-encoded strings: codes[i] indexes categories, and -1 is NULL."""
+    def __init__(self, values=()):
+        self.codes      = array.array('i')
+        self.categories = []
+        self._index     = {}            # Category -> code, while the column is being built
+        for value in values: self.append(value)
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(MISSING_CODE)
+            return
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.categories)
+            self.categories.append(value)
+        self.codes.append(code)
+
+    def code(self, value):
+        """Return the code of a value, or None if it does not occur."""
+        return self._index.get(value)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code == MISSING_CODE else self.categories[code]
+
+    def take(self, nodes):
+        """Return a column of the given rows, sharing this column's categories."""
+        column = category_column()
+        column.codes        = array.array('i', (self.codes[i] for i in nodes))
+        column.categories   = self.categories
+        column._index       = self._index
+        return column
+
+def make_csr(count_nodes, pairs):
+    # CSR adjacency from (node, neighbour) pairs sorted by node: the neighbours of node i are idx[ptr[i]:ptr[i + 1]]
+    ptr = array.array('l', [0]) * (count_nodes + 1)
+    idx = array.array('l')
+    for i, j in pairs:
+        ptr[i + 1] += 1
+        idx.append(j)
+    for i in range(count_nodes): ptr[i + 1] += ptr[i]
+    return ptr, idx
+
+class graph:
+    """The BioProject graph as typed columns and CSR adjacency. Built by db_export.get_graph().
+
+    Every ID that appears in tbl_node or at either end of a link is a node; saved[i] is 0 for link ends that were never downloaded.
+    Organism (genome) nodes carry the totals of their projects' data statistics in the stats columns."""
+    def __init__(self, bp_ids, saved, columns, column_order, stats, stats_order, edges):
+        self.bp_ids         = bp_ids            # array('l'), sorted
+        self.saved          = saved             # array('b'): 1 if the node has a row in tbl_node
+        self.columns        = columns           # Column name -> category_column or list of unicode
+        self.column_order   = column_order      # Node columns in database order (bp_id first)
+        self.stats          = stats             # Header ("db: unit") -> array('d'), NaN where there is no value
+        self.stats_order    = stats_order
+
+        # Adjacency, both directions. edges are (from, to) node index pairs.
+        count = len(bp_ids)
+        self.out_ptr, self.out_idx  = make_csr(count, sorted(edges))
+        self.in_ptr, self.in_idx    = make_csr(count, sorted((j, i) for i, j in edges))
+
+        # Organism groups: every project linked from an organism goes under one of them (the lowest index if several link to it)
+        genome_code         = columns['project_type'].code(GENOME_TYPE)
+        self._genome_code   = MISSING_CODE if genome_code is None else genome_code
+        self.group_of       = array.array('l', [MISSING_CODE]) * count
+        for i in range(count):
+            if not self.is_project(i): continue
+            for j in self.in_neighbors(i):
+                if self.is_genome(j):
+                    self.group_of[i] = j
+                    break
+        self.group_ptr, self.group_members = make_csr(count, sorted((g, i) for i, g in enumerate(self.group_of) if g != MISSING_CODE))
+
+    ##################################################
+    ### Lookups ######################################
+    ##################################################
+    def __len__(self):
+        return len(self.bp_ids)
+
+    def index(self, bp_id):
+        """Return the node index of a bp_id. Raises KeyError if it is not in the graph."""
+        bp_id = int(bp_id)
+        i = bisect.bisect_left(self.bp_ids, bp_id)
+        if ( i == len(self.bp_ids) ) or ( self.bp_ids[i] != bp_id ): raise KeyError(bp_id)
+        return i
+
+    def out_neighbors(self, i):
+        return self.out_idx[self.out_ptr[i]:self.out_ptr[i + 1]]
+
+    def in_neighbors(self, i):
+        return self.in_idx[self.in_ptr[i]:self.in_ptr[i + 1]]
+
+    def members(self, i):
+        """Projects placed in the group of organism i."""
+        return self.group_members[self.group_ptr[i]:self.group_ptr[i + 1]]
+
+    def is_genome(self, i):
+        return self.columns['project_type'].codes[i] == self._genome_code
+
+    def is_project(self, i):
+        # Saved projects that are not organisms. Projects with no type are left out, as in the database exports.
+        code = self.columns['project_type'].codes[i]
+        return ( code != MISSING_CODE ) and ( code != self._genome_code )
+
+    def groups(self):
+        """Node indices of the organisms that have at least one project in their group."""
+        return [i for i in range(len(self.bp_ids)) if self.group_ptr[i + 1] > self.group_ptr[i]]
+
+    def edges(self):
+        """Yield every edge as (from, to) node indices."""
+        for i in range(len(self.bp_ids)):
+            for j in self.out_neighbors(i): yield i, j
+
+    def value(self, column, i):
+        return self.columns[column][i]
+
+    ##################################################
+    ### Parts of the graph ###########################
+    ##################################################
+    def components(self):
+        """Return the weakly connected component of every node, labelled by its lowest node index. Union-find with path compression."""
+        parent = array.array('l', range(len(self.bp_ids)))
+        def find(i):
+            root = i
+            while parent[root] != root: root = parent[root]
+            while parent[i] != root: parent[i], i = root, parent[i]
+            return root
+        for i, j in self.edges():
+            root_i, root_j = find(i), find(j)
+            if root_i < root_j:     parent[root_j] = root_i     # The lower index becomes the root, so labels do not depend on edge order 
+            elif root_j < root_i:   parent[root_i] = root_j
+        return array.array('l', (find(i) for i in range(len(self.bp_ids))))
+
+    def crawl_nodes(self, seed):
+        """Return the nodes the crawler reaches from a seed: everything below it, then the parents of those, followed upwards only."""
+        reached = set([seed])
+        stack   = [seed]
+        while stack:
+            for j in self.out_neighbors(stack.pop()):
+                if j not in reached: reached.add(j); stack.append(j)
+        stack = list(reached)
+        while stack:
+            for j in self.in_neighbors(stack.pop()):
+                if j not in reached: reached.add(j); stack.append(j)
+        return sorted(reached)
+
+    def subgraph(self, nodes):
+        """Return the graph induced by the given node indices. Organisms keep the totals computed over the whole graph."""
+        nodes = sorted(set(nodes))
+        new_index = array.array('l', [MISSING_CODE]) * len(self.bp_ids)
+        for k, i in enumerate(nodes): new_index[i] = k
+        columns = {}
+        for col, values in self.columns.items():
+            if isinstance(values, category_column): columns[col] = values.take(nodes)
+            else:                                   columns[col] = [values[i] for i in nodes]
+        stats   = dict((col, array.array('d', (values[i] for i in nodes))) for col, values in self.stats.items())
+        edges   = [(new_index[i], new_index[j]) for i in nodes for j in self.out_neighbors(i) if new_index[j] != MISSING_CODE]
+        return graph(array.array('l', (self.bp_ids[i] for i in nodes)), array.array('b', (self.saved[i] for i in nodes)),
+                     columns, self.column_order, stats, self.stats_order, edges)
+
+    ##################################################
+    ### Attribute dictionaries for exporters #########
+    ##################################################
+    def bp_attributes(self, i):
+        """Attributes of project i as exported: every column but bp_id, with empty fields taking the project type, plus its statistics."""
+        project_type = self.columns['project_type'][i]
+        atts = {}
+        for col in self.column_order[1:]:
+            value = self.columns[col][i]
+            if value is None: value = project_type
+            if value is not None: atts[col] = value
+        for col in self.stats_order:
+            value = self.stats[col][i]
+            if value == value: atts[col] = value       # NaN (no value) is the only value not equal to itself
+        return atts
+
+    def genome_attributes(self, i):
+        """Attributes of organism i as exported: the columns that have a value, plus the totals of its projects' statistics.
+        A total of 0 is the integer 0, as db_export.parse_genome_hierarchy and gexf_stream give organisms whose projects have no value."""
+        atts = {}
+        for col in self.column_order[1:]:
+            value = self.columns[col][i]
+            if value is not None: atts[col] = value
+        for col in self.stats_order:
+            value = self.stats[col][i]
+            if value == value: atts[col] = 0 if value == 0 else value
+        return atts
@@ -0,0 +1,198 @@
+# Force-directed layout of the graph model, so exported GEXF files open already laid out (viz:position, viz:size, viz:color).
+# The forces follow ForceAtlas2: repulsion between all nodes weighted by degree, linear attraction along edges, and gravity
+# towards the centre. Repulsion is approximated with a Barnes-Hut quadtree, built and walked level by level with NumPy, so an
+# iteration costs O(n log n). A previous layout of the same file can seed the next one (warm start): re-exports of a graph
+# that changed a little then keep their shape and need few iterations.
+
+import os
+import json
+import math
+import logging
+import numpy as np
+import graph_model
+
+logger = logging.getLogger(__name__)
+
+# Colours for the categories of the colour column, assigned in sorted order so a category keeps its colour across files
+palette             = [(39, 177, 118), (230, 97, 1), (94, 60, 153), (253, 184, 99), (178, 171, 210), (215, 48, 39), (69, 117, 180),
+                       (255, 255, 191), (166, 217, 106), (244, 109, 67), (116, 173, 209), (191, 129, 45)]
+genome_color        = (160, 160, 160)       # Organism nodes
+missing_color       = (90, 90, 90)          # Nodes with no value in the colour column
+
+##################################################
+### Barnes-Hut repulsion #########################
+##################################################
+def build_quadtree(pos, mass, max_depth):
+    # One entry per level: (cell key of every node, cell index of every node, cell mass, cell centre of mass, nodes per cell,
+    # cell width, children CSR). Only non-empty cells exist. Stops at the first level where every node has a cell of its own.
+    low     = pos.min(0)
+    span    = max(float((pos.max(0) - low).max()), 1e-9) * (1 + 1e-9)
+    unit    = (pos - low) / span                # In [0, 1)
+    levels  = []
+    for depth in range(max_depth + 1):
+        side    = 1 << depth
+        grid    = np.minimum((unit * side).astype(np.int64), side - 1)
+        keys    = grid[:, 0] * side + grid[:, 1]
+        cells, inverse = np.unique(keys, return_inverse=True)
+        cell_mass   = np.bincount(inverse, weights=mass, minlength=len(cells))
+        centre      = np.column_stack([np.bincount(inverse, weights=mass * pos[:, k], minlength=len(cells)) for k in (0, 1)]) / cell_mass[:, None]
+        count       = np.bincount(inverse, minlength=len(cells))
+        levels.append({'cells':cells, 'node_cell':inverse, 'mass':cell_mass, 'centre':centre, 'count':count, 'width':span / side})
+        if count.max() == 1: break
+
+    # Children of each cell among the cells of the next level
+    for depth in range(len(levels) - 1):
+        child_keys  = levels[depth + 1]['cells']
+        side        = 1 << (depth + 1)
+        parent_keys = (child_keys // side // 2) * (side // 2) + (child_keys % side) // 2
+        parents     = np.searchsorted(levels[depth]['cells'], parent_keys)
+        order       = np.argsort(parents, kind='mergesort')
+        levels[depth]['child_idx'] = order
+        levels[depth]['child_ptr'] = np.concatenate([[0], np.cumsum(np.bincount(parents, minlength=len(levels[depth]['cells'])))])
+    return levels
+
+def repulsion(pos, mass, theta=1.2, max_depth=16):
+    """Return the repulsive force on every node: the sum over other nodes j of mass_i mass_j (p_i - p_j) / |p_i - p_j|^2.
+    A cell far enough away (width / distance < theta) counts as one body at its centre of mass."""
+    force   = np.zeros_like(pos)
+    levels  = build_quadtree(pos, mass, max_depth)
+    nodes   = np.arange(len(pos))               # (node, cell) pairs still to resolve, starting with the root
+    cells   = np.zeros(len(pos), dtype=np.int64)
+    for depth, level in enumerate(levels):
+        last        = ( depth == len(levels) - 1 )
+        cell_mass   = level['mass'][cells]
+        centre      = level['centre'][cells]
+        own         = ( level['node_cell'][nodes] == cells )    # The node is inside the cell
+        if last:
+            # Nodes sharing a cell at the deepest level: take the node itself out of the cell's totals
+            rest        = cell_mass - np.where(own, mass[nodes], 0)
+            keep        = rest > 0
+            centre      = np.where(own[:, None], (centre * cell_mass[:, None] - pos[nodes] * mass[nodes][:, None]) / np.maximum(rest, 1e-12)[:, None], centre)
+            cell_mass   = rest
+            accept      = keep
+        else:
+            delta       = pos[nodes] - centre
+            dist2       = (delta ** 2).sum(1)
+            single      = ( level['count'][cells] == 1 )
+            accept      = ~own & ( single | ( level['width'] ** 2 < theta * theta * dist2 ) )
+        delta   = pos[nodes[accept]] - centre[accept]
+        dist2   = np.maximum((delta ** 2).sum(1), 1e-6)
+        np.add.at(force, nodes[accept], delta * (mass[nodes[accept]] * cell_mass[accept] / dist2)[:, None])
+        if last: break
+
+        # Open the remaining cells: pair each node with the children of its cell. Cells holding only the node itself are done.
+        expand  = ~accept & ~( own & ( level['count'][cells] == 1 ) )
+        nodes, cells = nodes[expand], cells[expand]
+        if not len(nodes): break
+        start   = level['child_ptr'][cells]
+        counts  = level['child_ptr'][cells + 1] - start
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        nodes   = np.repeat(nodes, counts)
+        cells   = level['child_idx'][np.repeat(start, counts) + offsets]
+    return force
+
+##################################################
+### Layout #######################################
+##################################################
+def edge_arrays(graph, group_weight):
+    # Edge ends and weights: the links, plus a link from every project to the organism whose group it is placed in, so
+    # groups stay together
+    count   = len(graph)
+    src     = np.repeat(np.arange(count), np.diff(np.asarray(graph.out_ptr)))
+    dst     = np.asarray(graph.out_idx, dtype=np.int64)
+    weight  = np.ones(len(src))
+    group_of = np.asarray(graph.group_of, dtype=np.int64)
+    grouped = np.nonzero(group_of != graph_model.MISSING_CODE)[0]
+    if group_weight and len(grouped):
+        src     = np.concatenate([src, grouped])
+        dst     = np.concatenate([dst, group_of[grouped]])
+        weight  = np.concatenate([weight, np.repeat(float(group_weight), len(grouped))])
+    return src, dst, weight
+
+def initial_positions(graph, previous, scaling, random):
+    # Nodes with a previous position keep it; new nodes start next to a placed neighbour, or anywhere if they have none
+    count   = len(graph)
+    radius  = scaling * math.sqrt(count + 1)
+    pos     = random.uniform(-radius, radius, (count, 2))
+    placed  = np.zeros(count, dtype=bool)
+    for i in range(count):
+        xy = previous.get(str(graph.bp_ids[i]))
+        if xy is not None: pos[i], placed[i] = xy, True
+    if placed.any():
+        for i in np.nonzero(~placed)[0]:
+            neighbours = [j for j in list(graph.in_neighbors(i)) + list(graph.out_neighbors(i)) if placed[j]]
+            if neighbours: pos[i] = pos[neighbours[0]] + random.normal(0, scaling, 2)
+    return pos, placed
+
+def force_layout(graph, iterations=200, previous=None, scaling=2.0, gravity=1.0, group_weight=2.0, theta=1.2, seed=1):
+    """Return node positions (an n x 2 array, in node index order) after a fixed number of iterations.
+
+    previous maps bp_id (string) to (x, y) from an earlier layout; those nodes start where they were, and the moves allowed per
+    iteration start small so the layout stays recognisable."""
+    count = len(graph)
+    if count == 0: return np.zeros((0, 2))
+    random  = np.random.RandomState(seed)       # Same input, same layout
+    pos, placed = initial_positions(graph, previous or {}, scaling, random)
+    src, dst, weight = edge_arrays(graph, group_weight)
+    mass    = 1.0 + np.bincount(src, minlength=count) + np.bincount(dst, minlength=count)
+
+    # Cooling: the largest move allowed per iteration falls linearly to zero. A warm start begins at a tenth of the usual value.
+    extent  = float(np.abs(pos).max()) or 1.0
+    start   = extent * ( 0.01 if placed.mean() > 0.5 else 0.1 )
+    for it in range(iterations):
+        force   = scaling * repulsion(pos, mass, theta)
+        pull    = (pos[dst] - pos[src]) * weight[:, None]       # Linear attraction along each edge
+        np.add.at(force, src, pull)
+        np.add.at(force, dst, -pull)
+        norm    = np.sqrt((pos ** 2).sum(1))
+        force  -= gravity * mass[:, None] * pos / np.maximum(norm, 1e-9)[:, None]
+
+        limit   = start * (1.0 - float(it) / iterations)
+        size    = np.sqrt((force ** 2).sum(1))
+        pos    += force * np.minimum(1.0, limit / np.maximum(size, 1e-12))[:, None]
+    return pos
+
+##################################################
+### Size and colour ##############################
+##################################################
+def node_sizes(graph, column, min_size=2.0, max_size=20.0):
+    """Size by data volume: log-scaled values of a statistics column (organisms hold their projects' totals)."""
+    if column not in graph.stats: return np.repeat(min_size, len(graph))
+    volume  = np.log1p(np.nan_to_num(np.maximum(np.asarray(graph.stats[column]), 0)))
+    top     = volume.max() if len(volume) else 0
+    if top <= 0: return np.repeat(min_size, len(graph))
+    return min_size + (max_size - min_size) * volume / top
+
+def node_colors(graph, column):
+    """An (r, g, b) row per node from the categories of a node column. Organisms are grey."""
+    colors  = np.tile(np.array(missing_color), (len(graph), 1))
+    values  = graph.columns.get(column)
+    if isinstance(values, graph_model.category_column):
+        rank    = dict((c, k) for k, c in enumerate(sorted(values.categories)))
+        lookup  = np.array([palette[rank[c] % len(palette)] for c in values.categories] + [missing_color])
+        colors  = lookup[np.asarray(values.codes)]                  # Code -1 picks missing_color
+    genomes = np.array([graph.is_genome(i) for i in range(len(graph))], dtype=bool)
+    colors[genomes] = genome_color
+    return colors
+
+##################################################
+### Saved layouts ################################
+##################################################
+def load_positions(layout_file):
+    # Return {bp_id: (x, y)} from a layout saved by save_positions, or {} if there is none
+    if ( layout_file is None ) or ( not os.path.exists(layout_file) ): return {}
+    with open(layout_file) as f: return json.load(f)
+
+def save_positions(layout_file, graph, pos):
+    with open(layout_file, 'w') as f:
+        json.dump(dict((str(bp_id), [round(x, 3), round(y, 3)]) for bp_id, (x, y) in zip(graph.bp_ids, pos.tolist())), f)
+
+def layout_viz(graph, layout_file=None, iterations=200, warm_iterations=30, size_column='SRA: Gbases', color_column='data_type', **kwargs):
+    """Lay out a graph and return {'position', 'size', 'color'} arrays in node index order, for gexf.gexf_create.
+
+    If layout_file holds an earlier layout, it seeds this one and only warm_iterations are run. The new layout is saved there."""
+    previous = load_positions(layout_file)
+    pos = force_layout(graph, warm_iterations if previous else iterations, previous, **kwargs)
+    if layout_file is not None: save_positions(layout_file, graph, pos)
+    logger.info('Layout of {0} nodes ({1} start)'.format(len(graph), 'warm' if previous else 'cold'))
+    return {'position':pos, 'size':node_sizes(graph, size_column), 'color':node_colors(graph, color_column)}
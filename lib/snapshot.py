@@ -0,0 +1,211 @@
+# Columnar snapshot of the BioProject database: typed NumPy arrays on disk, one file per column, described by a JSON manifest.
+# Repeated strings (project type, data type, ...) are dictionary-encoded; numbers and dates keep their types. Uncompressed
+# snapshots are memory-mapped when read, so opening one costs almost nothing and only the columns used are paged in.
+
+import os
+import json
+import datetime
+import logging
+import numpy as np
+import db_export                # Reads the database for exporters
+import graph_model              # Shares its list of categorical columns
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION    = 1
+MANIFEST            = 'manifest.json'
+COMPRESSED_FILE     = 'snapshot.npz'
+
+# Node columns stored as dictionary codes plus a list of categories. Other text columns are stored as UTF-8 bytes plus offsets.
+categorical_columns = graph_model.categorical_columns
+date_columns        = ['create_date']       # 'YYYY-MM-DD' strings, stored as datetime64[D]
+MISSING_INT         = -1                    # Stands in for NULL in integer columns (IDs are positive)
+MISSING_CODE        = -1                    # Dictionary code for NULL in categorical columns
+
+##################################################
+### Encoding #####################################
+##################################################
+def encode_int(values):
+    return {'values':np.array([MISSING_INT if v in (None, '') else int(v) for v in values], dtype=np.int64)}     # Some IDs are saved as empty text 
+
+def encode_float(values):
+    return {'values':np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)}
+
+def encode_date(values):
+    return {'values':np.array([v if v else 'NaT' for v in values], dtype='datetime64[D]')}
+
+def encode_category(values):
+    """Return the codes array and the categories (sorted, so snapshots of the same data are identical)."""
+    categories  = sorted(set(v for v in values if v is not None))
+    index       = dict((c, i) for i, c in enumerate(categories))
+    dtype       = np.int8 if len(categories) < 127 else ( np.int16 if len(categories) < 32767 else np.int32 )
+    codes       = np.array([MISSING_CODE if v is None else index[v] for v in values], dtype=dtype)
+    return {'codes':codes}, categories
+
+def encode_text(values):
+    """Concatenate the UTF-8 encoded strings; string i is data[offsets[i]:offsets[i+1]]. "valid" is False for NULL."""
+    encoded = [u'' if v is None else unicode(v) for v in values]
+    encoded = [v.encode('utf-8') for v in encoded]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+    data    = np.frombuffer(''.join(encoded), dtype=np.uint8) if offsets[-1] else np.zeros(0, dtype=np.uint8)
+    return {'offsets':offsets, 'data':data, 'valid':np.array([v is not None for v in values], dtype=np.bool_)}
+
+##################################################
+### Writer #######################################
+##################################################
+def write_snapshot(db_file, out_dir, compress=False):
+    """Write a snapshot of the database to out_dir and return the manifest.
+
+    With compress=True, all arrays go into one zlib-compressed .npz file: smaller, but it is read into memory instead of
+    being memory-mapped."""
+    columns = db_export.db_export(db_file).get_columns()
+    if not os.path.exists(out_dir): os.makedirs(out_dir)
+
+    arrays      = {}        # File key -> array
+    manifest    = {'version':SNAPSHOT_VERSION, 'created':datetime.datetime.now().isoformat(), 'storage':'npz' if compress else 'npy', 'tables':{}}
+
+    def add_table(table, names, values, kinds):
+        length  = len(values[names[0]]) if names else 0
+        entry   = {'rows':length, 'columns':[]}
+        for i, name in enumerate(names):
+            kind = kinds[name]
+            col  = {'name':name, 'kind':kind, 'files':{}}
+            if   kind == 'int':         parts = encode_int(values[name])
+            elif kind == 'float':       parts = encode_float(values[name])
+            elif kind == 'date':        parts = encode_date(values[name])
+            elif kind == 'category':    parts, col['categories'] = encode_category(values[name])
+            else:                       parts = encode_text(values[name])
+            for part, array in parts.items():
+                key = '{0}.{1}.{2}'.format(table, i, part)      # Column names such as "SRA: Gbases" are not safe file names
+                arrays[key] = array
+                col['files'][part] = key
+            entry['columns'].append(col)
+        manifest['tables'][table] = entry
+
+    # Nodes
+    node_kinds = {}
+    for name in columns['node_order']:
+        if name in categorical_columns:         node_kinds[name] = 'category'
+        elif name in date_columns:              node_kinds[name] = 'date'
+        else:                                   node_kinds[name] = columns['node_types'][name]
+    add_table('nodes', columns['node_order'], columns['nodes'], node_kinds)
+
+    # Wide data statistics, row for row with the nodes
+    stats = dict(columns['stats'], bp_id=columns['nodes']['bp_id'])
+    stats_order = ['bp_id'] + columns['stats_order']
+    add_table('stats', stats_order, stats, dict([(name, 'float') for name in columns['stats_order']] + [('bp_id', 'int')]))
+
+    # Edges
+    add_table('edges', ['id_from', 'id_to', 'link_genome_id'], columns['edges'], {'id_from':'int', 'id_to':'int', 'link_genome_id':'int'})
+
+    # Arrays first, manifest last: a snapshot without a manifest is incomplete
+    if compress:
+        np.savez_compressed(os.path.join(out_dir, COMPRESSED_FILE), **arrays)
+    else:
+        for key, array in arrays.items(): np.save(os.path.join(out_dir, key + '.npy'), array)
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f: json.dump(manifest, f, indent=1)
+    logger.info('Snapshot written to {0}: {1} nodes, {2} edges, {3} statistics columns'.format(out_dir, manifest['tables']['nodes']['rows'],
+                manifest['tables']['edges']['rows'], len(columns['stats_order'])))
+    return manifest
+
+##################################################
+### Reader #######################################
+##################################################
+class categorical:
+    """Dictionary-encoded column: integer codes plus the list of categories. Code -1 is NULL."""
+    def __init__(self, codes, categories):
+        self.codes      = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code == MISSING_CODE else self.categories[code]
+
+    def equals(self, value):
+        """Boolean mask of the rows equal to value (compares codes, no string work)."""
+        if value not in self.categories: return np.zeros(len(self.codes), dtype=np.bool_)
+        return self.codes == self.categories.index(value)
+
+    def decode(self):
+        """Return an object array of the values (None for NULL)."""
+        lookup = np.array(list(self.categories) + [None], dtype=object)
+        return lookup[self.codes]               # Code -1 picks the trailing None
+
+class text_column:
+    """Variable-length UTF-8 strings stored as one byte array plus offsets."""
+    def __init__(self, offsets, data, valid):
+        self.offsets    = offsets
+        self.data       = data
+        self.valid      = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, i):
+        if not self.valid[i]: return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tostring().decode('utf-8')
+
+    def decode(self):
+        return np.array([self[i] for i in range(len(self))], dtype=object)
+
+class snapshot:
+    """Read a snapshot written by write_snapshot. Columns are loaded on first use and memory-mapped unless the snapshot is compressed."""
+    def __init__(self, snapshot_dir, mmap=True):
+        self._dir       = snapshot_dir
+        with open(os.path.join(snapshot_dir, MANIFEST)) as f: self._manifest = json.load(f)
+        if self._manifest['version'] != SNAPSHOT_VERSION: raise ValueError('Unsupported snapshot version: {0}'.format(self._manifest['version']))
+        self._mmap_mode = 'r' if mmap else None
+        self._npz       = np.load(os.path.join(snapshot_dir, COMPRESSED_FILE)) if self._manifest['storage'] == 'npz' else None
+        self._columns   = {}            # (table, name) -> decoded column, filled on first use
+
+    def get_manifest(self):
+        return self._manifest
+
+    def tables(self):
+        return sorted(self._manifest['tables'])
+
+    def column_names(self, table):
+        return [col['name'] for col in self._manifest['tables'][table]['columns']]
+
+    def rows(self, table):
+        return self._manifest['tables'][table]['rows']
+
+    def load_array(self, key):
+        if self._npz is not None: return self._npz[key]
+        return np.load(os.path.join(self._dir, key + '.npy'), mmap_mode=self._mmap_mode)
+
+    def column(self, table, name):
+        """Return a column: a NumPy array for int, float and date columns, a categorical or a text_column otherwise."""
+        if (table, name) in self._columns: return self._columns[(table, name)]
+        for col in self._manifest['tables'][table]['columns']:
+            if col['name'] == name: break
+        else:
+            raise KeyError('No column {0} in table {1}'.format(name, table))
+        parts = dict((part, self.load_array(key)) for part, key in col['files'].items())
+        if   col['kind'] == 'category':     value = categorical(parts['codes'], col['categories'])
+        elif col['kind'] == 'text':         value = text_column(parts['offsets'], parts['data'], parts['valid'])
+        else:                               value = parts['values']
+        self._columns[(table, name)] = value
+        return value
+
+    def table(self, table):
+        """Return {column name: column} for a whole table."""
+        return dict((name, self.column(table, name)) for name in self.column_names(table))
+
+    def to_dataframe(self, table):
+        """Return a table as a pandas DataFrame with categorical columns. Requires pandas."""
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError('to_dataframe requires pandas; the columns themselves are available through table()')
+        data = {}
+        for name in self.column_names(table):
+            col = self.column(table, name)
+            if isinstance(col, categorical):        data[name] = pandas.Categorical.from_codes(np.asarray(col.codes), categories=col.categories)
+            elif isinstance(col, text_column):      data[name] = col.decode()
+            else:                                   data[name] = np.asarray(col)
+        return pandas.DataFrame(data, columns=self.column_names(table))
@@ -2,6 +2,9 @@
 # A key feature is the creation of meta-nodes (groups) for each organism.
 # Chris Wellington, October, 2012 
 import os 
+import re 
+import csv 
+import logging 
 import lib.db_export as db_export
 import lib.gexf as gexf
 
@@ -13,35 +16,92 @@ gexf_file           = 'BioProject.gexf'           # Output GEXF filename
 
 db_dir              = 'bioproject_files'
 db_file             = 'BioProjects.sqlite'     # input SQLite database file 
+export_cache        = 'export_cache.pickle'    # Exported data is reused from this file (with the kind of export added to the name) until the database changes; None to always read the database 
+stream_gexf         = True                     # Write the file straight from the database in constant memory; False builds it in memory (gexf_create) 
+compress_gexf       = False                    # Write gzip (".gz" is added to the file name). Streaming only. 
+split_by            = None                     # None: one file. 'component': one file per connected sub-network. 'seed': one file per project in bp_list_file. 
+split_min_nodes     = 2                        # Sub-networks smaller than this are not written 
+split_processes     = 4                        # Files are written by this many processes at once 
+bp_list_file        = 'top-level_bps.csv'      # Seed projects (ID and title), as for download_data.py 
+layout_iterations   = 0                        # Lay the nodes out (force-directed, needs numpy) in this many iterations; 0 leaves the layout to Gephi 
+layout_warm_iterations = 30                    # Iterations when the previous layout of the same file (saved as *.layout.json) is there to start from 
+layout_size_by      = 'SRA: Gbases'            # Statistics column that sets node size 
+layout_color_by     = 'data_type'              # Node column that sets node colour 
+json_graph          = False                    # Also write each graph as compact JSON for the browser viewer (".json", plus a gzip copy ".json.gz") 
+tiles_dir           = None                     # Also write level-of-detail tiles for the browser viewer (a top file of organism groups plus one file per group) to this directory in output_dir 
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Construct paths 
 if not os.path.exists(output_dir): os.mkdir(output_dir) # Create the output directory if it does not exist. This step is not done for input files. 
 gexf_file_path  = os.path.join(output_dir, gexf_file)   # Path for the output GEXF file 
 db_file_path    = os.path.join(db_dir, db_file)         # Input path for the database 
+if stream_gexf and compress_gexf: gexf_file_path += '.gz'
+layout_options  = None                                  # Keyword arguments of lib.layout.layout_viz 
+if layout_iterations: layout_options = {'iterations':layout_iterations, 'warm_iterations':layout_warm_iterations, 'size_column':layout_size_by, 'color_column':layout_color_by}
+
 
+#################################################################
+###  Stream the GEXF file  ######################################
+#################################################################
+if stream_gexf and ( split_by is None ) and ( layout_options is None ) and ( tiles_dir is None ) and ( not json_graph ):     # Layouts, tiles and JSON need the whole graph in memory 
+    count_nodes, count_edges = gexf.gexf_stream(gexf_file_path, db_file_path, compress=compress_gexf).write_out()
+    logger.info('Wrote {0} nodes and {1} edges to {2}'.format(count_nodes, count_edges, gexf_file_path))
+    raise SystemExit
 
 #################################################################
 ###  Get the data to use for file creation ######################
 #################################################################
 # use lib.db_export to get the information from the database and NCBI report  
-bp_data     = db_export.db_export(db_file_path)
-graph_data  = bp_data.run_all()
+bp_data     = db_export.db_export(db_file_path, cache_file=os.path.join(db_dir, export_cache) if export_cache else None)
+graph       = bp_data.get_graph()
+
+#################################################################
+###  Level-of-detail tiles for the browser viewer  ##############
+#################################################################
+if tiles_dir is not None:
+    count_nodes, count_tiles = gexf.write_tiles(os.path.join(output_dir, tiles_dir), graph, layout_options)
+    logger.info('Wrote {0} top-level nodes and {1} group files to {2}'.format(count_nodes, count_tiles, os.path.join(output_dir, tiles_dir)))
 
 #################################################################
 ###  Create the GEXF file  ######################################
 #################################################################
 # use lib.gexf to create the GEXF file 
-gexf_output = gexf.gexf_create(gexf_file_path, 
-                                        graph_data['attributes_genome'], 
-                                        graph_data['attributes_bp'],
-                                        graph_data['hierarchy_genome'],
-                                        graph_data['edges'],
-                                        graph_data['data_stats_cols'])
-
-# Push information to the GEXF XML object 
-gexf_output.prepare_gexf()
-gexf_output.add_hierarchy()
-gexf_output.add_edges()
-
-# Write out information 
-gexf_output.write_out()
+if split_by is None:
+    gexf.write_gexf(gexf_file_path, graph, layout_options, json_graph)
+    raise SystemExit
+
+#################################################################
+###  Split into one file per sub-network or seed  ###############
+#################################################################
+def file_name(label, bp_id, used):
+    # File name from a project's label, e.g. "Homo sapiens" -> "Homo_sapiens.gexf"; the ID is added if the name is taken 
+    name = re.sub(r'[^A-Za-z0-9]+', '_', label or '').strip('_') or 'BioProject'
+    if name in used: name = '{0}_{1}'.format(name, bp_id)
+    used.add(name)
+    return os.path.join(output_dir, name + '.gexf')
+
+jobs, used = [], set()
+if split_by == 'component':
+    # Each sub-network is named after its top project: a project (not an organism) without parents, with the most children 
+    parts = {}
+    for i, root in enumerate(graph.components()): parts.setdefault(root, []).append(i)
+    for nodes in parts.values():
+        if len(nodes) < split_min_nodes: continue 
+        top = max(nodes, key=lambda i: ( not graph.is_genome(i), len(graph.in_neighbors(i)) == 0, len(graph.out_neighbors(i)), -i ))
+        jobs.append((file_name(graph.value('name', top), graph.bp_ids[top], used), nodes))
+elif split_by == 'seed':
+    with open(os.path.join(db_dir, bp_list_file), 'rb') as f:
+        for line in csv.reader(f, skipinitialspace=True):
+            try:                i = graph.index(line[0])
+            except (KeyError, ValueError, IndexError): continue     # Header row, or a seed that was never downloaded 
+            nodes = graph.crawl_nodes(i)
+            if len(nodes) < split_min_nodes: continue 
+            label = line[2] if len(line) > 2 and line[2] else graph.value('name', i)
+            jobs.append((file_name(label, graph.bp_ids[i], used), nodes))
+else:
+    raise SystemExit('Unknown value for split_by: {0}'.format(split_by))
+
+for path, count_nodes, count_edges in gexf.write_parts(graph, jobs, split_processes, layout_options, json_graph):
+    logger.info('Wrote {0} nodes and {1} edges to {2}'.format(count_nodes, count_edges, path))
@@ -0,0 +1,30 @@
+# Extract data from the BioProject database into a columnar snapshot (typed NumPy arrays plus a manifest) for analysis.
+# Read it back with lib.snapshot.snapshot('outputs/snapshot'); columns are memory-mapped, so loading is nearly instant.
+import os 
+import logging
+import lib.snapshot as snapshot
+
+#################################################################
+### Assign values to variables ##################################
+#################################################################
+output_dir          = 'outputs'
+snapshot_dir        = 'snapshot'                # Output directory for the snapshot (one .npy file per column and manifest.json) 
+compress            = False                     # True writes one compressed .npz file instead; smaller, but read into memory rather than memory-mapped 
+
+db_dir              = 'bioproject_files'
+db_file             = 'BioProjects.sqlite'      # input SQLite database file 
+
+# Construct paths 
+if not os.path.exists(output_dir): os.mkdir(output_dir) # Create the output directory if it does not exist. This step is not done for input files. 
+snapshot_path   = os.path.join(output_dir, snapshot_dir)    # Path for the output snapshot 
+db_file_path    = os.path.join(db_dir, db_file)             # Input path for the database 
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#################################################################
+###  Write the snapshot  ########################################
+#################################################################
+manifest = snapshot.write_snapshot(db_file_path, snapshot_path, compress=compress)
+for table in sorted(manifest['tables']):
+    logger.info('{0:<6} {1:8d} rows, {2} columns'.format(table, manifest['tables'][table]['rows'], len(manifest['tables'][table]['columns'])))
@@ -14,6 +14,8 @@ table_file          = 'BioProject-table.csv'           # Output GEXF filename
 
 db_dir              = 'bioproject_files'
 db_file             = 'BioProjects.sqlite'     # input SQLite database file 
+export_cache        = 'export_cache.pickle'    # Exported data is reused from this file (with the kind of export added to the name) until the database changes; None to always read the database 
+subtree_totals      = False                    # Add "Subtree <db>: <unit>" columns: each statistic summed over the project and all its descendants 
 
 if not os.path.exists(output_dir): os.mkdir(output_dir) # Create the output directory if it does not exist. This step is not done for input files. 
 
@@ -24,12 +26,15 @@ db_file_path    = os.path.join(db_dir, db_file)         # Input path for the dat
 ###  Get the data to use for file creation ######################
 #################################################################
 # use lib.db_export to get the information from the database and NCBI report  
-bp_data     = db_export.db_export(db_file_path)
-graph_data  = bp_data.run_all()
+bp_data     = db_export.db_export(db_file_path, cache_file=os.path.join(db_dir, export_cache) if export_cache else None)
+graph       = bp_data.get_graph()
 
 # Make the ordered list of fields to keep. 
 tbl_fields = ['bp_id', 'create_date', 'accno', 'name', 'title', 'project_type', 'target_capture', 'target_material', 'organism_name', 'organism_supergroup', 'method', 'data_type']
-tbl_fields.extend(graph_data['data_stats_cols'])
+tbl_fields.extend(graph.stats_order)
+if subtree_totals:
+    tbl_fields.extend('Subtree ' + col for col in graph.stats_order)
+    totals = bp_data.get_subtree_totals()
 
 # Copy the list to a dictionary 
 tbl_fields_dict = {}
@@ -41,7 +46,11 @@ for element in tbl_fields:
 data_table = []
 data_table.append(tbl_fields)
 
-for bp_id, value_dict in graph_data['attributes_bp'].items():
+for i in range(len(graph)):
+    if not graph.is_project(i): continue    # Organisms and link ends that were never downloaded 
+    bp_id       = str(graph.bp_ids[i])
+    value_dict  = graph.bp_attributes(i)
+    if subtree_totals: value_dict.update(('Subtree ' + col, val) for col, val in totals.get(bp_id, {}).items())
     tmp_row = [""]*len(tbl_fields)
     tmp_row[0] = unicode(bp_id)
     for col, val in value_dict.items():
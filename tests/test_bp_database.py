@@ -0,0 +1,223 @@
+# Checks of the BioProject database writer on temporary database files.
+# Run from the main directory: python -m unittest discover tests
+
+import os
+import time
+import Queue
+import sqlite3
+import shutil
+import logging
+import tempfile
+import unittest
+import lib.bp_database as bp_database
+import lib.db_export as db_export
+import lib.eutils as eutils
+import lib.eutils_mock as eutils_mock
+import lib.eutils_parser as eutils_parser
+import lib.crawler as crawler
+
+logging.getLogger('lib').addHandler(logging.NullHandler())     # Failed saves are logged as errors
+
+def parse_records(*records):
+    """Parse BioProject DocumentSummary elements as a downloaded efetch response would be."""
+    return eutils_parser.parser().parse('<?xml version="1.0"?>\n<RecordSet>' + ''.join(records) + '</RecordSet>')
+
+class database_test(unittest.TestCase):
+    """Base for tests that save parsed results into a new database."""
+    def setUp(self):
+        self.temp_dir       = tempfile.mkdtemp()
+        self.db_file        = os.path.join(self.temp_dir, 'bp.sqlite')
+        self.queue_result   = Queue.Queue()
+        self.db             = bp_database.init_db(self.db_file, queue_result=self.queue_result, batch_seconds=0.05)
+
+    def tearDown(self):
+        self.db.close_db_connection()
+        shutil.rmtree(self.temp_dir)
+
+    def save(self, *results):
+        """Hand results to the saving thread and wait until they are committed."""
+        for returned_data in results: self.queue_result.put(returned_data)
+        self.queue_result.join()
+
+    def query(self, s, *params):
+        return [tuple(row) for row in self.db._conn.execute(s, *params)]
+
+class writer_test(database_test):
+    def test_bad_row(self):
+        # Three results fill one batch; the one that cannot be saved is dropped and the other two are committed before join() returns
+        self.db.close_db_connection()
+        self.queue_result   = Queue.Queue()
+        self.db             = bp_database.init_db(self.db_file, queue_result=self.queue_result, batch_rows=4, batch_seconds=30)
+        start = time.time()
+        self.save(parse_records(eutils_mock.bioproject_record(1)), 
+                  {'bp_nodes':[{'bp_id':2, 'no_such_column':'x'}]}, 
+                  parse_records(eutils_mock.bioproject_record(3, data_stats=[('SRA', 'Gbases', '4')])))
+        self.assertTrue(time.time() - start < 30)
+        self.assertEqual(self.query('SELECT bp_id FROM tbl_node ORDER BY bp_id'), [(1,), (3,)])
+        self.assertEqual(self.query('SELECT bp_id, val FROM tbl_data_stats'), [(3, 4)])
+        self.assertEqual(self.query('SELECT crawl_id, status FROM tbl_crawl_state ORDER BY crawl_id'), [(1, 'done'), (3, 'done')])
+
+class upsert_test(database_test):
+    def stats(self):
+        return self.query('SELECT bp_id, db, unit, val FROM tbl_data_stats ORDER BY bp_id, db, unit')
+
+    def test_missing_keys(self):
+        # Statistics and organizations without a unit or role are merged on their next save like any other row
+        result = {'data_stats':[{'bp_id':1, 'db':'SRA', 'unit':None, 'val':5}, {'bp_id':1, 'db':'SRA', 'unit':'Gbases', 'val':2}],
+                  'submission_org':[{'bp_id':1, 'org_name':'owner', 'org_type':'institute', 'org_role':None}]}
+        self.save(result)
+        self.save({'data_stats':[{'bp_id':1, 'db':'SRA', 'unit':None, 'val':7}], 'submission_org':[{'bp_id':1, 'org_name':'owner', 'org_type':'consortium', 'org_role':None}]})
+        self.assertEqual(self.stats(), [(1, 'SRA', '', 7), (1, 'SRA', 'Gbases', 2)])
+        self.assertEqual(self.query('SELECT bp_id, org_name, org_type, org_role FROM tbl_submission_org'), [(1, 'owner', 'consortium', '')])
+        stats_columns = bp_database.load_stats_columns(self.db._conn)
+        self.assertEqual(sorted(stats_columns), [('SRA', ''), ('SRA', 'Gbases')])
+        self.assertEqual(self.query('SELECT {0} FROM tbl_stats_wide'.format(stats_columns[('SRA', '')])), [(7,)])
+
+    def test_migration(self):
+        # A database from before the unique indexes, and one with them but with NULL keys saved more than once
+        self.save({'data_stats':[{'bp_id':1, 'db':'SRA', 'unit':'Gbases', 'val':2}], 'submission_org':[{'bp_id':1, 'org_name':'owner', 'org_type':'institute', 'org_role':'Lab'}]})
+        self.db.close_db_connection()
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('DROP INDEX ux_data_stats')
+        conn.executemany('INSERT INTO tbl_data_stats (bp_id, db, unit, val) VALUES (?,?,?,?)', [(1, 'SRA', 'Gbases', 3), (1, 'SRA', None, 4), (1, 'SRA', None, 5), (2, None, None, 6)])
+        conn.executemany('INSERT INTO tbl_submission_org (bp_id, org_name, org_type, org_role) VALUES (?,?,?,?)', [(1, 'owner', 'institute', None), (1, 'owner', 'consortium', None)])
+        conn.commit()
+        conn.close()
+        version = bp_database.read_db_version(self.db_file)
+
+        self.db = bp_database.init_db(self.db_file, queue_result=self.queue_result, batch_seconds=0.05)
+        self.assertEqual(self.stats(), [(1, 'SRA', '', 5), (1, 'SRA', 'Gbases', 3), (2, '', '', 6)])
+        self.assertEqual(self.query('SELECT bp_id, org_name, org_type, org_role FROM tbl_submission_org ORDER BY org_role'), [(1, 'owner', 'consortium', ''), (1, 'owner', 'institute', 'Lab')])
+        self.assertTrue(bp_database.read_db_version(self.db_file) > version)
+        stats_columns = bp_database.load_stats_columns(self.db._conn)
+        self.assertEqual(self.query('SELECT {0}, {1} FROM tbl_stats_wide WHERE bp_id = 1'.format(stats_columns[('SRA', '')], stats_columns[('SRA', 'Gbases')])), [(5, 3)])
+        # The migrated rows are merged with new saves
+        self.save({'data_stats':[{'bp_id':2, 'db':None, 'unit':None, 'val':8}]})
+        self.assertEqual(self.stats()[-1], (2, '', '', 8))
+        self.assertEqual(len(self.stats()), 3)
+
+class stats_test(database_test):
+    def wide(self):
+        """Return {bp_id: {(db, unit): value}} read from tbl_stats_wide, leaving out missing values."""
+        stats_columns = bp_database.load_stats_columns(self.db._conn)
+        pairs = sorted(stats_columns)
+        rows = self.query('SELECT bp_id, {0} FROM tbl_stats_wide'.format(', '.join(stats_columns[pair] for pair in pairs)))
+        return dict((row[0], dict((pair, val) for pair, val in zip(pairs, row[1:]) if val is not None)) for row in rows)
+
+    def test_pivot(self):
+        self.save(parse_records(eutils_mock.bioproject_record(1, data_stats=[('SRA', 'Mbases', '1,500'), ('GEO', 'Samples', '3')]),
+                                eutils_mock.bioproject_record(2, data_stats=[('SRA', 'Gbases', '2')]),
+                                eutils_mock.bioproject_record(3)))
+        self.assertEqual(self.wide(), {1:{('SRA', 'Gbases'):1.5, ('GEO', 'Samples'):3}, 2:{('SRA', 'Gbases'):2}})
+        self.assertEqual(sorted(self.query('SELECT db, unit, label FROM tbl_stats_columns')), [('GEO', 'Samples', 'GEO: Samples'), ('SRA', 'Gbases', 'SRA: Gbases')])
+
+        # A changed project has its row rebuilt; statistics it no longer has are gone, the other projects are untouched 
+        self.save(parse_records(eutils_mock.bioproject_record(1, data_stats=[('SRA', 'Gbases', '4')])))
+        self.assertEqual(self.wide(), {1:{('SRA', 'Gbases'):4}, 2:{('SRA', 'Gbases'):2}})
+
+        # A full rebuild gives the same table 
+        conn = self.db._engine.connect()
+        bp_database.refresh_stats_wide(conn, bp_database.load_stats_columns(conn))
+        conn.close()
+        self.assertEqual(self.wide(), {1:{('SRA', 'Gbases'):4}, 2:{('SRA', 'Gbases'):2}})
+
+    def test_rollup_diamond(self):
+        # 1 -> 2 -> 4 and 1 -> 3 -> 4: project 4 is below 1 twice, but counts once in its total 
+        self.save(parse_records(eutils_mock.bioproject_record(1, project_type='TopAdmin', children=[2, 3]),
+                                eutils_mock.bioproject_record(2, children=[4], parents=[1], data_stats=[('SRA', 'Gbases', '1')]),
+                                eutils_mock.bioproject_record(3, children=[4], parents=[1], data_stats=[('SRA', 'Gbases', '2')]),
+                                eutils_mock.bioproject_record(4, parents=[2, 3], data_stats=[('SRA', 'Gbases', '10'), ('GEO', 'Samples', '5')])))
+        self.db.update_closure()
+        self.assertEqual(self.query('SELECT ancestor, descendant FROM tbl_closure ORDER BY ancestor, descendant'), 
+                         [(1, 1), (1, 2), (1, 3), (1, 4), (2, 2), (2, 4), (3, 3), (3, 4), (4, 4)])
+        totals = db_export.db_export(self.db_file).get_subtree_totals()
+        self.assertEqual(totals, {'1':{'SRA: Gbases':13, 'GEO: Samples':5}, '2':{'SRA: Gbases':11, 'GEO: Samples':5}, 
+                                  '3':{'SRA: Gbases':12, 'GEO: Samples':5}, '4':{'SRA: Gbases':10, 'GEO: Samples':5}})
+        self.assertEqual(db_export.db_export(self.db_file).get_subtree_totals(['3']), {'3':totals['3']})
+
+class refresh_test(database_test):
+    def test_links_of_other_documents_kept(self):
+        # Project 3 is listed by its parent 1, but does not list 1 itself; it lists a parent 5 that does not list it
+        self.save(parse_records(eutils_mock.bioproject_record(1, project_type='TopAdmin', children=[2, 3]),
+                                eutils_mock.bioproject_record(2, parents=[1]),
+                                eutils_mock.bioproject_record(3, parents=[5])))
+        self.assertEqual(self.query('SELECT id_from, id_to FROM tbl_link ORDER BY id_from, id_to'), [(1, 2), (1, 3), (5, 3)])
+
+        # Re-fetched, 3 has changed and no longer lists 5: the link only 3 reported goes, the one its parent reported stays
+        self.save(parse_records(eutils_mock.bioproject_record(3, title='New title')))
+        self.assertEqual(self.query('SELECT id_from, id_to FROM tbl_link ORDER BY id_from, id_to'), [(1, 2), (1, 3)])
+        self.assertEqual(self.query('SELECT title FROM tbl_node WHERE bp_id = 3'), [('New title',)])
+
+        # 2 changes too and stops listing its parent; 1 still lists 2, so the link stays
+        self.save(parse_records(eutils_mock.bioproject_record(2, title='New title')))
+        self.assertEqual(self.query('SELECT id_from, id_to, listed_down, listed_up FROM tbl_link ORDER BY id_from, id_to'), [(1, 2, 1, None), (1, 3, 1, None)])
+
+class journal_test(database_test):
+    # Project 10 has a child 13 and a parent 2; 2 has children 10 and 11 and a parent 12; 20 -> 21 -> 22 is a chain of children
+    records = {10:dict(parents=[2], children=[13]), 13:dict(parents=[10]), 2:dict(children=[10, 11], parents=[12]), 11:{}, 12:dict(children=[2]),
+               20:dict(children=[21]), 21:dict(children=[22]), 22:{}}
+
+    def setUp(self):
+        database_test.setUp(self)
+        self.mock       = None
+        self.downloader = None
+
+    def tearDown(self):
+        self.stop_crawl()
+        database_test.tearDown(self)
+
+    def stop_crawl(self):
+        if self.downloader is not None:
+            self.downloader.stop_workers()
+            self.downloader._pool.close()
+        if self.mock is not None: self.mock.stop()
+        self.mock, self.downloader = None, None
+
+    def crawl(self, seeds=(), fail_ids=(), resume=False):
+        """Crawl a fresh mock with the database as journal, to depth 2. Return the number of IDs resumed and the number of records downloaded."""
+        self.stop_crawl()
+        self.mock = eutils_mock.mock_eutils(port=0)
+        for bp_id, links in self.records.items(): self.mock.add_record('bioproject', bp_id, eutils_mock.bioproject_record(bp_id, **links))
+        for bp_id in fail_ids: self.mock.add_failing_id(bp_id)
+        self.mock.start()
+        self.downloader = eutils.eutils_download(db='bioproject', tool='efetch', max_threads=2, rate=1000, burst=100, max_retries=0, backoff_base=0, base_url=self.mock.get_base_url())
+        crawl = crawler.crawler(self.downloader, self.queue_result, max_depth=2, poll_interval=0.05, journal=self.db)
+        resumed = crawl.resume() if resume else 0
+        crawl.add(seeds)
+        crawl.run()
+        self.queue_result.join()
+        return resumed, sum(n for t, m, n in self.mock.request_log if t == 'efetch')
+
+    def test_resume(self):
+        # The first run stops with 2 (a parent of the seed, so followed up only) taken by a worker but never returned
+        self.crawl([10], fail_ids=[2])
+        self.assertEqual(self.query('SELECT bp_id FROM tbl_node ORDER BY bp_id'), [(10,), (13,)])
+        self.assertEqual(self.db.get_crawl_state(), [('bioproject', 2, 1, 'up')])
+        # 20 was scheduled by a document but no worker took it before the interruption
+        self.save({'crawl_state':[{'kind':'bioproject', 'crawl_id':20, 'status':'pending', 'depth':1, 'direction':'both'}]})
+
+        # Resumed at their depth and direction: 2 is followed up to 12 but not down to 11; 20 is followed down to 21, and 22 is too deep
+        self.assertEqual(self.crawl(resume=True), (2, 4))
+        self.assertEqual(self.query('SELECT bp_id FROM tbl_node ORDER BY bp_id'), [(2,), (10,), (12,), (13,), (20,), (21,)])
+        self.assertEqual(self.db.get_crawl_state(), [])
+        self.assertEqual(sorted(self.db.get_crawl_state(('done',))), [('bioproject', x, depth, direction) for x, depth, direction in 
+                         [(2, 1, 'up'), (10, 0, 'both'), (12, 2, 'up'), (13, 1, 'both'), (20, 1, 'both'), (21, 2, 'both')]])
+
+        # Seeds already saved are not downloaded again
+        self.assertEqual(self.crawl([10, 20], resume=True), (0, 0))
+
+    def test_close_and_filter(self):
+        self.crawl([20])
+        self.save({'crawl_state':[{'kind':'bioproject', 'crawl_id':30, 'status':'in-flight', 'depth':1, 'direction':'both'}]})
+        self.db.close_crawl_state()
+        # Only the ID that never came back is marked failed; saved IDs stay done
+        self.assertEqual(self.query('SELECT crawl_id, status FROM tbl_crawl_state ORDER BY crawl_id'), [(20, 'done'), (21, 'done'), (22, 'done'), (30, 'failed')])
+        self.assertEqual(self.db.filter_new('bioproject', ['20', '22', '30', '40']), ['40'])
+        self.assertEqual(self.db.filter_new('bioproject', ['20', '22', '30', '40'], check_journal=False), ['30', '40'])
+        # Saved nodes are skipped even when the journal has been reset
+        self.db.reset_crawl_state()
+        self.assertEqual(self.db.filter_new('bioproject', [20, 30]), [30])
+
+
+if __name__ == '__main__':
+    unittest.main()
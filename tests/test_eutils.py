@@ -0,0 +1,247 @@
+# Offline checks of the Eutilities downloader against the mock server in lib/eutils_mock.py.
+# Run from the main directory: python -m unittest discover tests
+
+import os
+import time
+import Queue
+import shutil
+import logging
+import tempfile
+import unittest
+import multiprocessing
+import lib.eutils as eutils
+import lib.eutils_mock as eutils_mock
+import lib.eutils_cache as eutils_cache
+import lib.crawler as crawler
+
+logging.getLogger('lib').addHandler(logging.NullHandler())     # Failures and bisection are logged as warnings
+
+def bioproject_mock(count, fail_ids=()):
+    """Start a mock serving BioProjects 1..count on a free port. Requests that include one of fail_ids get HTTP 500."""
+    mock = eutils_mock.mock_eutils(port=0)
+    for i in range(1, count + 1):
+        mock.add_record('bioproject', i, eutils_mock.bioproject_record(i, organism_name='Homo sapiens', species='9606'))
+    for i in fail_ids: mock.add_failing_id(i)
+    mock.start()
+    return mock
+
+def count_requests(mock, tool, method=None):
+    return len([1 for t, m, n in mock.request_log if ( t == tool ) and ( method is None or m == method )])
+
+def drain(queue_result):
+    """Return the bp_ids of every node in the parsed results on a queue."""
+    bp_ids = []
+    while not queue_result.empty(): bp_ids.extend(int(row['bp_id']) for row in queue_result.get()['bp_nodes'])
+    return sorted(bp_ids)
+
+class mock_test(unittest.TestCase):
+    """Base for tests that download from a mock server."""
+    def setUp(self):
+        self.mock       = None
+        self.downloader = None
+
+    def tearDown(self):
+        self.close_downloader()
+        if self.mock is not None: self.mock.stop()
+
+    def close_downloader(self):
+        # Close the kept-alive connections too, so no server thread is left waiting on them at exit 
+        if self.downloader is None: return 
+        self.downloader.stop_workers()
+        self.downloader._pool.close()
+        self.downloader = None 
+
+    def download(self, ids, **kwargs):
+        """Download ids from the mock with a fast, retry-free downloader and return the bp_ids that came back."""
+        self.close_downloader()
+        options = dict(db='bioproject', tool='efetch', max_threads=2, rate=1000, burst=100, max_retries=0, backoff_base=0, base_url=self.mock.get_base_url())
+        options.update(kwargs)
+        self.downloader = eutils.eutils_download(**options)
+        queue_result = Queue.Queue()
+        self.downloader.threaded_download(ids, queue_result)
+        return drain(queue_result)
+
+class download_test(mock_test):
+    def test_id_lists(self):
+        self.mock = bioproject_mock(20)
+        self.assertEqual(self.download(range(1, 21), group_size=5), range(1, 21))
+        self.assertEqual(count_requests(self.mock, 'efetch', 'GET'), 4)
+        self.assertEqual(self.downloader.get_dead_letter(), [])
+
+    def test_history_paging(self):
+        # 30 IDs over the threshold: one epost, then pages of 7 records against the WebEnv
+        self.mock = bioproject_mock(30)
+        self.assertEqual(self.download(range(1, 31), group_size=5, history_threshold=10, history_page_size=7), range(1, 31))
+        self.assertEqual(count_requests(self.mock, 'epost'), 1)
+        self.assertEqual(count_requests(self.mock, 'efetch'), 5)
+        self.assertEqual(self.downloader.get_dead_letter(), [])
+
+    def test_history_missing_ids(self):
+        # IDs the history server does not return are fetched again by ID list; the one that does not exist is not retried forever
+        self.mock = bioproject_mock(10)
+        self.assertEqual(self.download(range(1, 13), group_size=20, history_threshold=10, history_page_size=20), range(1, 11))
+        self.assertEqual(count_requests(self.mock, 'epost'), 1)
+        self.assertEqual(count_requests(self.mock, 'efetch'), 2)
+
+    def test_frontier_history(self):
+        # A large addition to a frontier is posted once; small ones go by ID list 
+        self.mock = bioproject_mock(40)
+        self.download([], history_threshold=10, history_page_size=20)
+        queue_result = Queue.Queue()
+        ids = self.downloader.open_frontier(queue_result)
+        ids.add(range(1, 31))
+        ids.add(range(31, 41))
+        ids.add([1000])
+        self.downloader.join()
+        self.assertEqual(drain(queue_result), range(1, 41))
+        self.assertEqual(count_requests(self.mock, 'epost'), 2)
+        self.assertEqual(sorted(n for t, m, n in self.mock.request_log if t == 'efetch'), [1, 10, 10, 20])
+
+    def test_crawl_umbrella(self):
+        # The 30 children of an umbrella project come from one document, so they are scheduled together through epost 
+        self.mock = eutils_mock.mock_eutils(port=0)
+        self.mock.add_record('bioproject', 1, eutils_mock.bioproject_record(1, project_type='TopAdmin', children=range(2, 32)))
+        for i in range(2, 32): self.mock.add_record('bioproject', i, eutils_mock.bioproject_record(i, parents=[1]))
+        self.mock.start()
+        self.download([], group_size=5, history_threshold=10, history_page_size=20)
+        queue_result = Queue.Queue()
+        crawl = crawler.crawler(self.downloader, queue_result, poll_interval=0.05)
+        crawl.add([1])
+        crawl.run()
+        self.assertEqual(drain(queue_result), range(1, 32))
+        self.assertEqual(count_requests(self.mock, 'epost'), 1)
+        self.assertEqual(sorted(n for t, m, n in self.mock.request_log if t == 'efetch'), [1, 10, 20])
+
+    def test_bisection(self):
+        # A batch of 8 with one failing ID is split 8 -> 4 -> 2 -> 1; only that ID ends up on the dead-letter list
+        self.mock = bioproject_mock(8, fail_ids=[5])
+        self.assertEqual(self.download(range(1, 9), group_size=8), [1, 2, 3, 4, 6, 7, 8])
+        self.assertEqual(self.downloader.get_dead_letter(), ['5'])
+        self.assertEqual(count_requests(self.mock, 'efetch'), 7)
+
+    def test_parse_processes(self):
+        # A record the parser cannot read is bisected down to its ID, as in the download threads 
+        pool = multiprocessing.Pool(2)                  # Forked before the mock starts its threads 
+        try:
+            self.mock = bioproject_mock(8)
+            self.mock.add_record('bioproject', 5, '<DocumentSummary uid="5"><Project>')
+            self.assertEqual(self.download(range(1, 9), group_size=8, parse_processes=2, parse_pool=pool), [1, 2, 3, 4, 6, 7, 8])
+            self.assertEqual(self.downloader.get_dead_letter(), ['5'])
+        finally:
+            pool.terminate()
+
+    def test_parse_timeout(self):
+        # A parser that never answers does not hang the download; its IDs end up on the dead-letter list 
+        pool = multiprocessing.Pool(1)
+        try:
+            pool.apply_async(time.sleep, (10,))         # Keeps the only parser process busy 
+            self.mock = bioproject_mock(2)
+            self.assertEqual(self.download([1, 2], group_size=2, parse_processes=1, parse_pool=pool, parse_timeout=0.2), [])
+            self.assertEqual(sorted(self.downloader.get_dead_letter()), ['1', '2'])
+        finally:
+            pool.terminate()
+
+    def test_post_for_long_urls(self):
+        self.mock = bioproject_mock(20)
+        self.assertEqual(self.download(range(1, 21), group_size=20, max_url_length=50), range(1, 21))
+        self.assertEqual(count_requests(self.mock, 'efetch', 'POST'), 1)
+        self.assertEqual(count_requests(self.mock, 'efetch', 'GET'), 0)
+
+class cache_test(mock_test):
+    def setUp(self):
+        mock_test.setUp(self)
+        self.temp_dir   = tempfile.mkdtemp()
+        self.cache      = eutils_cache.response_cache(os.path.join(self.temp_dir, 'cache.sqlite'))
+
+    def tearDown(self):
+        mock_test.tearDown(self)
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_rebatched_recrawl(self):
+        # Records are cached one per ID, so a second crawl in different batches needs no requests 
+        self.mock = bioproject_mock(20)
+        self.assertEqual(self.download(range(1, 21), group_size=3, cache=self.cache), range(1, 21))
+        self.assertEqual(self.cache.get_stats()['entries'], 20)
+        before = count_requests(self.mock, 'efetch')
+        self.assertEqual(self.download(range(1, 21), group_size=8, stream_parse=True, cache=self.cache), range(1, 21))
+        self.assertEqual(count_requests(self.mock, 'efetch'), before)
+
+    def test_stream_cached(self):
+        # Stream-parsed records are cached a few at a time as they are parsed, and come back from the cache the same
+        self.mock = bioproject_mock(20)
+        put_records = eutils.CACHE_PUT_RECORDS
+        eutils.CACHE_PUT_RECORDS = 3
+        try:
+            queue_result = Queue.Queue()
+            self.download([], group_size=20, stream_parse=True, cache=self.cache)
+            self.downloader.threaded_download(range(1, 21), queue_result)
+            streamed = queue_result.get()
+        finally:
+            eutils.CACHE_PUT_RECORDS = put_records
+        self.assertEqual(self.cache.get_stats()['entries'], 20)
+        before = count_requests(self.mock, 'efetch')
+        self.download([], group_size=20, cache=self.cache)
+        self.downloader.threaded_download(range(1, 21), queue_result)
+        self.assertEqual(queue_result.get(), streamed)
+        self.assertEqual(count_requests(self.mock, 'efetch'), before)
+
+    def test_partly_cached(self):
+        self.mock = bioproject_mock(20)
+        self.download(range(1, 11), group_size=20, cache=self.cache)
+        self.assertEqual(self.download(range(1, 21), group_size=20, cache=self.cache), range(1, 21))
+        self.assertEqual([n for t, m, n in self.mock.request_log], [10, 10])
+
+    def test_errors_not_cached(self):
+        # An HTTP error and a response without records (an ID that does not exist) leave nothing in the cache 
+        self.mock = bioproject_mock(4, fail_ids=[3])
+        self.assertEqual(self.download([3, 40], group_size=1, cache=self.cache, stream_parse=True), [])
+        self.assertEqual(self.cache.get_stats()['entries'], 0)
+        self.download([3, 40], group_size=1, cache=self.cache)
+        self.assertEqual(self.cache.get_stats()['entries'], 0)
+        self.assertEqual(count_requests(self.mock, 'efetch'), 4)
+
+    def test_history_cached(self):
+        # Cached records of an upload are served first; only the rest is posted 
+        self.mock = bioproject_mock(30)
+        self.download(range(1, 6), group_size=5, cache=self.cache)
+        self.assertEqual(self.download(range(1, 31), cache=self.cache, history_threshold=10, history_page_size=30), range(1, 31))
+        self.assertEqual([n for t, m, n in self.mock.request_log], [5, 25, 25])
+        self.assertEqual(self.cache.get_stats()['entries'], 30)
+
+    def test_cache_only(self):
+        self.mock = bioproject_mock(10)
+        self.download(range(1, 6), group_size=2, cache=self.cache)
+        before = len(self.mock.request_log)
+        self.assertEqual(self.download(range(1, 11), group_size=4, cache=self.cache, cache_only=True), range(1, 6))
+        self.assertEqual(len(self.mock.request_log), before)
+        self.assertEqual(self.downloader.get_dead_letter(), [])
+
+    def test_expired_sweep(self):
+        # Expired entries are found through their index, and dropped before live ones when the cache is over its cap
+        plan = ' '.join(str(row) for row in self.cache._conn.execute('EXPLAIN QUERY PLAN DELETE FROM tbl_response WHERE expires < 0'))
+        self.assertTrue('idx_response_expires' in plan)
+        body = eutils_mock.bioproject_record(1) + eutils_mock.bioproject_record(2)
+        self.cache._last_sweep = time.time()            # No timed sweep during the test
+        self.assertEqual(self.cache.put('efetch', 'bioproject', body, ttl=-1), 2)
+        self.cache._max_bytes = self.cache.get_stats()['bytes'] + 1
+        self.cache.put('efetch', 'bioproject', eutils_mock.bioproject_record(3))
+        self.assertEqual(self.cache.get_stats()['entries'], 1)
+        self.assertEqual(self.cache.get('efetch', 'bioproject', [1, 2, 3])[1], ['1', '2'])
+
+
+class regulator_test(unittest.TestCase):
+    def test_shared_per_api_key(self):
+        # efetch and esummary with the same key draw on one budget; another key gets its own 
+        efetch      = eutils.eutils_download(db='bioproject', tool='efetch',   api_key='test-key-a', rate=1000, burst=100)
+        esummary    = eutils.eutils_download(db='genome',     tool='esummary', api_key='test-key-a', rate=1000, burst=100)
+        other       = eutils.eutils_download(db='genome',     tool='esummary', api_key='test-key-b', rate=1000, burst=100)
+        self.assertTrue(efetch._regulate_rate is esummary._regulate_rate)
+        self.assertFalse(efetch._regulate_rate is other._regulate_rate)
+
+    def test_default_rates(self):
+        self.assertEqual(eutils.get_regulator(api_key='test-key-c').get_wait_stats()['rate'], eutils.RATE_API_KEY)
+
+
+if __name__ == '__main__':
+    unittest.main()
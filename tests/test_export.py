@@ -0,0 +1,200 @@
+# Checks of the exporters on a small fixture database.
+# Run from the main directory: python -m unittest discover tests
+
+import os
+import gzip
+import json
+import Queue
+import shutil
+import sqlite3
+import logging
+import tempfile
+import unittest
+import xml.etree.cElementTree as ET
+import lib.bp_database as bp_database
+import lib.db_export as db_export
+import lib.eutils_mock as eutils_mock
+import lib.eutils_parser as eutils_parser
+import lib.gexf as gexf
+import lib.graph_json as graph_json
+
+logging.getLogger('lib').addHandler(logging.NullHandler())
+
+# Organism 100 (genome 51) groups projects 2, 3 and 4; umbrella 1 has children 2 and 3. 10 -> 11 -> 12, where 12 was never
+# downloaded, is a second sub-network, and 20 stands alone.
+fixture_projects = [
+    dict(bp_id=1, project_type='TopAdmin', children=[2, 3]),
+    dict(bp_id=2, parents=[1], genome_links=[(100, 51)], organism_name='Homo sapiens', data_stats=[('SRA', 'Gbases', '1.5')]),
+    dict(bp_id=3, parents=[1], genome_links=[(100, 51)], organism_name='Homo sapiens', data_stats=[('SRA', 'Gbases', '2'), ('GEO', 'Samples', '4')]),
+    dict(bp_id=4, genome_links=[(100, 51)], organism_name='Homo sapiens'),
+    dict(bp_id=10, children=[11], data_stats=[('SRA', 'Mbytes', '3000000')]),
+    dict(bp_id=11, parents=[10], children=[12]),
+    dict(bp_id=20, title='Alone'),
+]
+
+def make_fixture(db_file):
+    """Save the fixture projects and organism into a new database, as download_data.py would."""
+    queue_result = Queue.Queue()
+    db = bp_database.init_db(db_file, queue_result=queue_result, batch_seconds=0.05)
+    bp_parser = eutils_parser.parser()
+    genome_parser = eutils_parser.parser(db='genome', tool='esummary')
+    queue_result.put(bp_parser.parse('<RecordSet>' + ''.join(eutils_mock.bioproject_record(**project) for project in fixture_projects) + '</RecordSet>'))
+    queue_result.put(genome_parser.parse('<eSummaryResult>' + eutils_mock.genome_record(51, 100, 'Homo sapiens') + '</eSummaryResult>'))
+    queue_result.join()
+    db.update_closure()
+    db.close_db_connection()
+
+def read_gexf(gexf_file):
+    """Return (set of nodes as (group node ID or None, ID, label, attribute values), sorted (source, target) edges) of a GEXF file."""
+    root = ET.parse(gexf_file).getroot()
+    nodes = set()
+    def add_nodes(container, group):
+        for node in container.findall('node'):
+            atts = frozenset((att.get('for'), att.get('value')) for att in node.findall('attvalues/attvalue'))
+            nodes.add((group, node.get('id'), node.get('label'), atts))
+            for nested in node.findall('nodes'): add_nodes(nested, node.get('id'))
+    add_nodes(root.find('graph/nodes'), None)
+    return nodes, sorted((edge.get('source'), edge.get('target')) for edge in root.iter('edge'))
+
+def decode_columns(columns):
+    """Return {column ID: list of values} of graph_json columns, as graph_settings.js decodes them (code -1 is null)."""
+    decoded = {}
+    for column in columns:
+        if 'codes' in column:   decoded[column['id']] = [None if code == -1 else column['categories'][code] for code in column['codes']]
+        else:                   decoded[column['id']] = column['values']
+    return decoded
+
+class export_test(unittest.TestCase):
+    """Base for tests that export the fixture database."""
+    def setUp(self):
+        self.temp_dir   = tempfile.mkdtemp()
+        self.db_file    = os.path.join(self.temp_dir, 'bp.sqlite')
+        make_fixture(self.db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+class cache_test(export_test):
+    def test_invalidated_by_writes(self):
+        # Node 7 of the graph is project 20
+        cache_file = self.path('export.pickle')
+        first = db_export.db_export(self.db_file, cache_file=cache_file).run_all()
+        self.assertEqual(first['attributes_bp']['20']['title'], 'Alone')
+        self.assertEqual(db_export.db_export(self.db_file, cache_file=cache_file).get_graph().value('title', 7), 'Alone')
+        self.assertTrue(os.path.exists(self.path('export.run_all.pickle')))
+        self.assertTrue(os.path.exists(self.path('export.graph.pickle')))
+
+        # A change that does not count as a write is not seen: both exports come from the cache
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("UPDATE tbl_node SET title = 'Changed' WHERE bp_id = 20")
+        conn.commit()
+        conn.close()
+        self.assertEqual(db_export.db_export(self.db_file, cache_file=cache_file).run_all()['attributes_bp']['20']['title'], 'Alone')
+        self.assertEqual(db_export.db_export(self.db_file, cache_file=cache_file).get_graph().value('title', 7), 'Alone')
+
+        # Once the write counter moves, both are read from the database again
+        conn = bp_database.make_engine(self.db_file).connect()
+        trans = conn.begin()
+        bp_database.bump_db_version(conn)
+        trans.commit()
+        conn.close()
+        self.assertEqual(db_export.db_export(self.db_file, cache_file=cache_file).run_all()['attributes_bp']['20']['title'], 'Changed')
+        self.assertEqual(db_export.db_export(self.db_file, cache_file=cache_file).get_graph().value('title', 7), 'Changed')
+
+class gexf_test(export_test):
+    def test_stream_matches_model(self):
+        # The streaming writer and the writer built on the graph model give the same nodes, groups, attributes and edges
+        gexf.gexf_stream(self.path('stream.gexf.gz'), self.db_file, compress=True).write_out()
+        gexf.write_gexf(self.path('model.gexf'), db_export.db_export(self.db_file).get_graph())
+        nodes, edges = read_gexf(gzip.open(self.path('stream.gexf.gz')))
+        self.assertEqual((nodes, edges), read_gexf(self.path('model.gexf')))
+
+        self.assertEqual(edges, [('1', '2'), ('1', '3'), ('10', '11'), ('100', '2'), ('100', '3'), ('100', '4'), ('11', '12')])
+        self.assertEqual(sorted((group, node_id) for group, node_id, label, atts in nodes),
+                         [(None, '1'), (None, '10'), (None, '11'), (None, '20'), (None, 'group_100'), ('group_100', '100'), ('group_100', '2'), ('group_100', '3'), ('group_100', '4')])
+        # The organism carries the totals of its projects, 0 where none of them has a value
+        genome = dict([atts for group, node_id, label, atts in nodes if node_id == '100'][0])
+        self.assertEqual([float(genome[col]) for col in ('SRA: Gbases', 'GEO: Samples', 'SRA: Tbytes')], [3.5, 4, 0])
+        self.assertEqual(genome['project_type'], 'Organism Overview')
+
+    def test_component_parts(self):
+        graph = db_export.db_export(self.db_file).get_graph()
+        parts = {}
+        for i, root in enumerate(graph.components()): parts.setdefault(root, []).append(i)
+        self.assertEqual(sorted(sorted(graph.bp_ids[i] for i in nodes) for nodes in parts.values()), [[1, 2, 3, 4, 100], [10, 11, 12], [20]])
+
+        # One file per sub-network of two or more nodes; written in processes or not, each holds its own nodes and edges only
+        jobs = [(self.path('part_{0}.gexf'.format(graph.bp_ids[root])), nodes) for root, nodes in parts.items() if len(nodes) > 1]
+        self.assertEqual(gexf.write_parts(graph, jobs, processes=2), [(self.path('part_1.gexf'), 5, 5), (self.path('part_10.gexf'), 3, 2)])
+        self.assertEqual(gexf.write_parts(graph, jobs, processes=1), [(self.path('part_1.gexf'), 5, 5), (self.path('part_10.gexf'), 3, 2)])
+        nodes, edges = read_gexf(self.path('part_10.gexf'))
+        self.assertEqual(sorted(node_id for group, node_id, label, atts in nodes), ['10', '11'])
+        self.assertEqual(edges, [('10', '11'), ('11', '12')])
+        nodes, edges = read_gexf(self.path('part_1.gexf'))
+        self.assertEqual(sorted(node_id for group, node_id, label, atts in nodes), ['1', '100', '2', '3', '4', 'group_100'])
+        self.assertEqual(edges, [('1', '2'), ('1', '3'), ('100', '2'), ('100', '3'), ('100', '4')])
+
+class tiles_test(export_test):
+    def test_tiles(self):
+        # Top file: the organism group as one meta-node, the projects in no group, and links between them counted as weights
+        graph = db_export.db_export(self.db_file).get_graph()
+        self.assertEqual(gexf.write_tiles(self.path('tiles'), graph), (5, 1))
+        self.assertEqual(sorted(os.listdir(self.path('tiles'))), ['100.gexf', 'index.gexf'])
+        top = ET.parse(self.path('tiles/index.gexf')).getroot()
+        self.assertEqual(sorted((edge.get('source'), edge.get('target'), edge.get('weight')) for edge in top.iter('edge')), [('1', 'group_100', '2'), ('10', '11', '1')])
+        nodes, edges = read_gexf(self.path('tiles/index.gexf'))
+        self.assertEqual(sorted(node_id for group, node_id, label, atts in nodes), ['1', '10', '11', '20', 'group_100'])
+        group_atts = dict([atts for group, node_id, label, atts in nodes if node_id == 'group_100'][0])
+        self.assertEqual((group_atts['tile'], group_atts['projects']), ('100.gexf', '3'))
+
+        # Detail file: the organism and its projects, and the links from outside marked with the top-file node they come from
+        nodes, edges = read_gexf(self.path('tiles/100.gexf'))
+        self.assertEqual(sorted(node_id for group, node_id, label, atts in nodes), ['100', '2', '3', '4'])
+        detail = ET.parse(self.path('tiles/100.gexf')).getroot()
+        groups = []
+        for edge in detail.iter('edge'):
+            att = edge.find('attvalues/attvalue')
+            groups.append((edge.get('source'), edge.get('target'), None if att is None else att.get('value')))
+        self.assertEqual(sorted(groups), [('1', '2', '1'), ('1', '3', '1'), ('100', '2', None), ('100', '3', None), ('100', '4', None)])
+
+class json_test(export_test):
+    def test_graph_data(self):
+        # Written and read back, plain and gzipped, the columns decode to the values of the graph model
+        graph = db_export.db_export(self.db_file).get_graph()
+        graph_json.write_json(self.path('graph.json'), graph_json.graph_data(graph))
+        data = json.load(open(self.path('graph.json')))
+        self.assertEqual(json.load(gzip.open(self.path('graph.json.gz'))), data)
+        nodes, attributes = decode_columns(data['nodes']), decode_columns(data['attributes'])
+        self.assertEqual(nodes['id'], [1, 2, 3, 4, 10, 11, 20, 100])
+        self.assertEqual(nodes['label'][-1], 'Homo sapiens')
+        index = [graph.index(bp_id) for bp_id in nodes['id']]
+        for col in graph.column_order[1:]:
+            if col != 'name': self.assertEqual(attributes[col], [graph.value(col, i) for i in index], col)
+
+        # Dictionary-encoded columns, with -1 for nodes without a value; stats as numbers or null
+        coded = dict((column['id'], column) for column in data['attributes'] if 'codes' in column)
+        self.assertEqual(coded['organism_name'], {'id':'organism_name', 'categories':['Homo sapiens'], 'codes':[-1, 0, 0, 0, -1, -1, -1, 0]})
+        self.assertEqual(attributes['organism_name'][0], None)
+        self.assertEqual(attributes['project_type'], ['TopAdmin'] + ['Submission'] * 6 + ['Organism Overview'])
+        self.assertEqual(attributes['SRA: Gbases'], [None, 1.5, 2, None, None, None, None, 3.5])
+        self.assertEqual(attributes['SRA: Tbytes'], [None, None, None, None, 3, None, None, 0])
+        self.assertEqual(sorted(zip(data['edges']['source'], data['edges']['target'])), [(0, 1), (0, 2), (4, 5), (7, 1), (7, 2), (7, 3)])
+
+    def test_gexf_data(self):
+        # The top file of the tiles: filler left out, numbers as numbers, and edge weights kept
+        gexf.write_tiles(self.path('tiles'), db_export.db_export(self.db_file).get_graph())
+        data = json.loads(json.dumps(graph_json.gexf_data(self.path('tiles/index.gexf'))))
+        nodes, attributes = decode_columns(data['nodes']), decode_columns(data['attributes'])
+        self.assertEqual(nodes['id'], ['group_100', 1, 10, 11, 20])
+        self.assertEqual(attributes['project_type'], ['Organism Overview', 'TopAdmin', 'Submission', 'Submission', 'Submission'])
+        self.assertEqual(attributes['genome_id'], ['51', None, None, None, None])
+        self.assertEqual(attributes['method'], [None, 'Sequencing', 'Sequencing', 'Sequencing', 'Sequencing'])
+        self.assertEqual((attributes['tile'][0], attributes['projects'][0], attributes['SRA: Gbases'][0]), ('100.gexf', 3, 3.5))
+        self.assertEqual(data['edges'], {'source':[1, 2], 'target':[0, 3], 'weight':[2, 1]})
+
+
+if __name__ == '__main__':
+    unittest.main()